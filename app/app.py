@@ -1,18 +1,27 @@
+import asyncio
+
 from . import utils
 from .utils import logger
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from .sheet import router as sheet_router, sheet_manager
 from .session import router as session_router
 from .redis import router as redis_router
+from .metrics import metrics, MetricsMiddleware, ServerTimingMiddleware
+from .shared_cache import shared_cache
+from .responses import JSONResponse
+from .settings import SERVER_TIMING_ENABLED
+from . import profiling
 
 
 # 確保日誌系統已初始化，使用配置的格式
 utils.configure_logging()
 
 # 創建 FastAPI 應用實例
-app = FastAPI()
+# 預設以 orjson 編碼回應
+app = FastAPI(default_response_class=JSONResponse)
 
 # 允許跨域請求
 app.add_middleware(
@@ -23,6 +32,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 請求延遲指標 (依路由)
+if metrics.enabled:
+    app.add_middleware(MetricsMiddleware)
+
+# 各處理階段的時間 (Server-Timing header)
+if SERVER_TIMING_ENABLED:
+    app.add_middleware(ServerTimingMiddleware)
+
+# 請求分析 (ST_LLM_PROFILING_ENABLED=true 時才安裝)
+profiling.install(app)
+
+# 請求關聯 ID (最外層，讓所有日誌都帶有 request_id)
+app.add_middleware(utils.RequestIdMiddleware)
+
 # 添加 API 路由
 # app.include_router(gemini_router, prefix="/api", tags=["gemini"])
 app.include_router(session_router, prefix="/api", tags=["session"])
@@ -39,6 +62,13 @@ async def index():
 async def ping():
     return {"status": "ok"}
 
+# Prometheus 指標 (合併所有 worker)
+@app.get("/metrics")
+async def metrics_endpoint():
+    # 讀取其他 worker 的快照 (SCAN + MGET) 會阻塞，在 threadpool 中執行
+    body = await run_in_threadpool(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 # 應用程序生命週期管理
 @app.on_event("startup")
@@ -46,6 +76,13 @@ async def startup_event():
     logger.info("==================================================")
     logger.info("API 服務器啟動")
     logger.info("==================================================")
+    # 保留背景工作的參照，避免被回收，並在 shutdown 時取消
+    app.state.background_tasks = []
+    if metrics.enabled:
+        app.state.background_tasks.append(asyncio.get_running_loop().create_task(metrics.flush_periodically()))
+    if shared_cache.enabled:
+        # 接收其他 worker 的 sheet:* 更新通知，丟棄本地副本
+        app.state.background_tasks.append(asyncio.get_running_loop().create_task(shared_cache.listen()))
     # 預熱 Google Sheet 數據到 Redis，增加重試機制
     retries = 0
     max_retries = 3
@@ -80,3 +117,12 @@ async def startup_event():
     if not success:
         logger.error("Google Sheet 預熱失敗次數已達上限，服務可能無法正常工作")
 
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    tasks = getattr(app.state, "background_tasks", [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
+    logger.info("API 服務器已關閉背景工作")
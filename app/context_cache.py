@@ -0,0 +1,107 @@
+import time
+from typing import Any, Dict, Optional
+
+from .llm import CachedContextMissError, LLMResult, get_llm_provider
+from .redis import get_redis_key, set_redis_key, delete_redis_key
+from .utils import logger
+from .settings import (
+    LLM_CONTEXT_CACHE_ENABLED,
+    LLM_CONTEXT_CACHE_TTL,
+    LLM_CONTEXT_CACHE_MIN_TOKENS,
+)
+
+# 快到期的 cache 不再重用，避免請求途中過期
+_EXPIRY_MARGIN = 30
+
+
+class ContextCacheManager:
+    """管理每個 session/search 的 context cache handle
+
+    prompt 與資料由 LLM 後端保存 (LLMProvider.create_cached_context)，handle
+    記錄在 Redis (llm_context_cache:{session_id}-{search_id})，所有 worker 共用；
+    只要資料摘要沒變且尚未過期就重用同一個 handle。
+    """
+
+    def __init__(self, ttl: int = LLM_CONTEXT_CACHE_TTL, min_tokens: int = LLM_CONTEXT_CACHE_MIN_TOKENS):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+
+    @staticmethod
+    def _registry_key(session_id: str, search_id: int) -> str:
+        return f"llm_context_cache:{session_id}-{search_id}"
+
+    def get_or_create(
+        self,
+        session_id: str,
+        search_id: int,
+        system_instruction: str,
+        context_message: str,
+        digest: str,
+        estimated_tokens: int
+    ) -> Optional[str]:
+        """取得可重用的 handle，必要時建立新的 cache
+
+        Returns:
+            cache handle；資料太小不值得緩存或建立失敗時返回 None (改走一般對話)
+        """
+        if estimated_tokens < self.min_tokens:
+            return None
+
+        provider = get_llm_provider()
+        registry_key = self._registry_key(session_id, search_id)
+        entry = get_redis_key(registry_key)
+        now = time.time()
+        if isinstance(entry, dict):
+            if (
+                entry.get("digest") == digest
+                and entry.get("backend") == provider.name
+                and entry.get("model") == provider.model
+            ):
+                # handle 為 None 表示這份資料先前建立失敗，在記錄過期前不再重試
+                if entry.get("expire_at", 0) - _EXPIRY_MARGIN > now or entry.get("handle") is None:
+                    return entry.get("handle")
+            else:
+                # 資料已變動，舊的 cache 不再需要
+                self._delete_handle(entry)
+
+        handle = None
+        try:
+            handle = provider.create_cached_context(
+                system_instruction,
+                [{"role": "user", "parts": [context_message]}],
+                self.ttl,
+            )
+            logger.info(f"建立 LLM context cache {handle} ({session_id}-{search_id}, 約 {estimated_tokens} tokens)")
+        except Exception as e:
+            logger.warning(f"建立 LLM context cache 失敗，改用一般對話: {str(e)}")
+
+        set_redis_key(registry_key, {
+            "handle": handle,
+            "digest": digest,
+            "backend": provider.name,
+            "model": provider.model,
+            "expire_at": now + self.ttl,
+        }, expire=self.ttl)
+        return handle
+
+    def generate(self, session_id: str, search_id: int, handle: str, query: str) -> Optional[LLMResult]:
+        """以 cache handle 產生回應，handle 失效時清除記錄並返回 None"""
+        try:
+            return get_llm_provider().generate_cached(handle, query)
+        except CachedContextMissError:
+            logger.info(f"LLM context cache {handle} 已失效，改用一般對話")
+            delete_redis_key(self._registry_key(session_id, search_id))
+            return None
+
+    def _delete_handle(self, entry: Dict[str, Any]) -> None:
+        provider = get_llm_provider()
+        if entry.get("backend") != provider.name or not entry.get("handle"):
+            return
+        try:
+            provider.delete_cached_context(entry.get("handle"))
+        except Exception as e:
+            logger.debug(f"刪除 LLM context cache {entry.get('handle')} 失敗: {str(e)}")
+
+
+# 全局 context cache 管理器，ST_LLM_CONTEXT_CACHE_ENABLED=false 時為 None
+context_cache = ContextCacheManager() if LLM_CONTEXT_CACHE_ENABLED else None
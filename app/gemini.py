@@ -1,62 +1,61 @@
-import google.generativeai as genai
-from google.generativeai import GenerativeModel
-import os
-
 from fastapi import APIRouter
 
 # 避免循環導入
 from . import session
+from .history import get_compacted_history
 from .utils import logger
-from .settings import GEMINI_MODEL, GEMINI_API_KEY
+from .llm import get_llm_provider
+from .prompts import prompt_registry, DEFAULT_PROMPT_NAME
 
 router = APIRouter()
 
 
-def load_prompt(prompt_path="app/prompt.txt"):
+def load_prompt(prompt_path: str = None, **variables):
     """
-    讀取 prompt 文件內容
+    讀取 prompt 模板內容 (經由 prompt_registry 緩存，檔案變動時才重新讀取)
     
     Args:
-        prompt_path: prompt 文件路徑
+        prompt_path: prompt 文件路徑，None 表示使用預設模板 (app/prompt.txt)
+        variables: 模板變數
         
     Returns:
         prompt 內容文本，如果讀取失敗則返回 None
     """
     try:
-        if not os.path.exists(prompt_path):
-            logger.warning(f"Prompt 文件不存在: {prompt_path}")
+        if prompt_path is None:
+            template = prompt_registry.get(DEFAULT_PROMPT_NAME)
+        else:
+            template = prompt_registry.get_by_path(prompt_path)
+        if template is None:
             return None
-            
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read().strip()
+        return template.render(**variables)
     except Exception as e:
         logger.error(f"讀取 prompt 文件失敗: {str(e)}")
         return None
 
 
-def gemini_chat(session_id: str = "default", search_id: int = 999, prompt_path: str = "app/prompt.txt", query: str = None) -> str:
+def gemini_chat(session_id: str = "default", search_id: int = 999, prompt_path: str = None, query: str = None) -> str:
     """
-    使用 Gemini API 進行聊天，根據會話歷史生成回應
+    使用 LLM 後端 (預設 Gemini，見 ST_LLM_BACKEND) 進行聊天，根據會話歷史生成回應
 
     Args:
         session_id: 會話 ID
         search_id: 搜索 ID，默認為 999 (主對話)
-        prompt_path: prompt 文件路徑，默認為 app/prompt.txt
+        prompt_path: prompt 文件路徑，默認為 None (使用 app/prompt.txt)
         query: 若有值則直接用 query 當成 send_message 內容
 
     Returns:
         AI 回應文本
     """
-    api_key = GEMINI_API_KEY
-    if not api_key:
+    provider = get_llm_provider()
+    if not provider.is_configured():
         error_msg = "錯誤：未設置 Gemini API 金鑰，無法使用聊天功能。"
         error_msg += "請在環境變數中設置 GEMINI_API_KEY。"
         return error_msg
 
     try:
-        genai.configure(api_key=api_key)
-        model = GenerativeModel(GEMINI_MODEL)
-        messages = session.get_messages(session_id, search_id, limit=30)
+        # 最近的訊息原樣保留，較早的訊息只留下每則開頭的節錄，大型表格換成引用
+        digest, messages = get_compacted_history(session_id, search_id)
         if not messages and not query:
             return "請輸入您的問題或指令。"
         prompt = load_prompt(prompt_path)
@@ -66,28 +65,22 @@ def gemini_chat(session_id: str = "default", search_id: int = 999, prompt_path:
                 "role": "user",
                 "parts": [{"text": prompt}]
             })
-        # 有 query 時 context 只加 messages[:-1]
-        if query:
-            for msg in messages[:-1]:
-                role = "user" if msg["role"] == "user" else "model"
-                context.append({
-                    "role": role,
-                    "parts": [{"text": msg["content"]}]
-                })
-        else:
-            for msg in messages[:-1]:
-                role = "user" if msg["role"] == "user" else "model"
-                context.append({
-                    "role": role,
-                    "parts": [{"text": msg["content"]}]
-                })
-        chat = model.start_chat(
-            history=context if context else None
-        )
+        if digest:
+            context.append({
+                "role": "user",
+                "parts": [{"text": f"較早的對話節錄 (每則訊息只保留開頭)：\n{digest}"}]
+            })
+        # 最新一筆訊息 (或 query) 會直接送出，context 只加 messages[:-1]
+        for msg in messages[:-1]:
+            role = "user" if msg["role"] == "user" else "model"
+            context.append({
+                "role": role,
+                "parts": [{"text": msg["content"]}]
+            })
         # 如果有 query 直接用 query，否則用最新一筆
         send_content = query if query else messages[-1]["content"]
-        response = chat.send_message(send_content)
-        return response.text
+        result = provider.chat(context, send_content)
+        return result.text
     except Exception as e:
         logger.error(f"Gemini 聊天出錯: {str(e)}")
         return f"Gemini API 錯誤: {str(e)}"
@@ -0,0 +1,116 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from .redis import get_redis_key, set_redis_key, delete_redis_key, scan_redis_keys
+from .utils import logger
+from .settings import (
+    SESSION_EXPIRE,
+    HISTORY_RECENT_MESSAGES,
+    HISTORY_DIGEST_MAX_CHARS,
+    HISTORY_DIGEST_LINE_CHARS,
+    HISTORY_TABLE_MIN_CHARS,
+)
+
+_ROLE_LABELS = {"user": "使用者", "bot": "助手"}
+
+
+def _digest_key(session_id: str, search_id: int) -> str:
+    return f"history_digest:{session_id}-{search_id}"
+
+
+def is_table_message(content: str) -> bool:
+    """判斷是否為 /kol-data 寫入的大型 Markdown 表格訊息"""
+    if not content or len(content) < HISTORY_TABLE_MIN_CHARS:
+        return False
+    return "| Id | KOL |" in content or content.lstrip().startswith("```markdown")
+
+
+def table_reference(message: Dict[str, Any]) -> str:
+    """把大型表格訊息換成簡短的引用文字"""
+    content = message.get("content", "")
+    rows = sum(1 for line in content.splitlines() if line.startswith("|")) - 2
+    return f"[KOL 資料表 (訊息 #{message.get('id')})：共 {max(rows, 0)} 筆貼文，內容已省略]"
+
+
+def compact_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """返回可直接放入對話紀錄的訊息，大型表格換成引用"""
+    content = message.get("content", "")
+    if is_table_message(content):
+        return dict(message, content=table_reference(message))
+    return message
+
+
+def _digest_line(message: Dict[str, Any]) -> str:
+    content = message.get("content", "") or ""
+    if is_table_message(content):
+        text = table_reference(message)
+    else:
+        text = " ".join(content.split())
+        if len(text) > HISTORY_DIGEST_LINE_CHARS:
+            text = text[:HISTORY_DIGEST_LINE_CHARS] + "..."
+    return f"{_ROLE_LABELS.get(message.get('role'), message.get('role'))}：{text}"
+
+
+def _trim_lines(lines: List[str]) -> List[str]:
+    """節錄超過長度上限時，從最舊的一行開始捨棄"""
+    total = sum(len(line) + 1 for line in lines)
+    start = 0
+    while total > HISTORY_DIGEST_MAX_CHARS and start < len(lines):
+        total -= len(lines[start]) + 1
+        start += 1
+    return lines[start:]
+
+
+def get_compacted_history(
+    session_id: str,
+    search_id: int,
+    recent: int = HISTORY_RECENT_MESSAGES
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """取得壓縮後的對話紀錄
+
+    最近 recent 則訊息原樣保留 (大型表格換成引用)，更早的訊息逐步併入
+    history_digest:{session_id}-{search_id} 的節錄：每則訊息只保留開頭
+    HISTORY_DIGEST_LINE_CHARS 個字 (大型表格換成引用)，總長度超過
+    HISTORY_DIGEST_MAX_CHARS 時捨棄最舊的行。這是截斷而非 LLM 產生的摘要，
+    不會額外呼叫 LLM；節錄只處理上次之後新增的訊息，因此每次呼叫的成本與對話長度無關。
+
+    Returns:
+        (較早訊息的節錄文字, 最近的訊息列表)
+    """
+    # 使用延遲導入避免循環導入
+    from .session import get_messages
+
+    key = _digest_key(session_id, search_id)
+    state = get_redis_key(key, default=None)
+    if not isinstance(state, dict):
+        state = {"upto_id": None, "lines": []}
+
+    messages = get_messages(session_id, search_id, since_id=state["upto_id"])
+    if len(messages) > recent:
+        folded = messages[:-recent] if recent > 0 else messages
+        messages = messages[-recent:] if recent > 0 else []
+        state["lines"] = _trim_lines(state["lines"] + [_digest_line(m) for m in folded])
+        state["upto_id"] = folded[-1]["id"]
+        set_redis_key(key, state, expire=SESSION_EXPIRE)
+        logger.info(f"對話 {session_id}-{search_id} 併入 {len(folded)} 則訊息到節錄 (至 #{state['upto_id']})")
+
+    return "\n".join(state["lines"]), [compact_message(m) for m in messages]
+
+
+def invalidate_digest(session_id: str, search_id: int, message_id: Optional[int] = None) -> None:
+    """訊息被修改或刪除時清除節錄
+
+    Args:
+        message_id: 被修改的訊息 ID；如果不在節錄範圍內則保留節錄，None 表示一律清除
+    """
+    key = _digest_key(session_id, search_id)
+    if message_id is not None:
+        state = get_redis_key(key, default=None)
+        if not isinstance(state, dict) or state.get("upto_id") is None or message_id > state["upto_id"]:
+            return
+    delete_redis_key(key)
+
+
+def delete_session_digests(session_id: str) -> None:
+    """刪除會話下所有對話節錄"""
+    for k in scan_redis_keys(f"history_digest:{session_id}-*"):
+        delete_redis_key(k)
@@ -0,0 +1,474 @@
+import re
+import math
+import uuid
+import threading
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .redis import get_redis_connection, get_redis_key
+from .shared_cache import shared_cache, version_key
+from .utils import logger
+from .settings import (
+    KOL_SEARCH_BM25_K1,
+    KOL_SEARCH_BM25_B,
+    KOL_SEARCH_ENGAGEMENT_WEIGHT,
+    KOL_SEARCH_RECENCY_WEIGHT,
+    KOL_SEARCH_RECENCY_HALF_LIFE_HOURS,
+    LLM_CONTEXT_SHARE_WEIGHT,
+)
+
+# kol_data 的版本戳記，每次從 Google Sheet 更新 sheet:kol_data 時換新
+KOL_DATA_VERSION_KEY = version_key("sheet:kol_data")
+
+# 中日韓文字 (連續的一段) 或英數字詞
+_CJK_CLASS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK_CLASS}]+|[0-9a-z_]+")
+_CJK_RE = re.compile(f"^[{_CJK_CLASS}]+$")
+# 查詢字串："片語" / 「片語」 / “片語” 或不含空白的詞
+_QUERY_TERM_RE = re.compile(r'"([^"]+)"|「([^」]+)」|“([^”]+)”|(\S+)')
+_OR_WORDS = {"or", "|", "｜"}
+_AND_WORDS = {"and", "&"}
+_EMPTY = np.empty(0, dtype=np.int32)
+
+# saved search 的 source 值 → 貼文來源 (0 為不篩選)
+SOURCE_FILTERS = {1: "facebook", 2: "threads"}
+SOURCES = ["facebook", "threads", "other"]
+
+
+def normalize_text(text: Any) -> str:
+    """全形轉半形、轉小寫、合併空白，索引與查詢使用相同的正規化"""
+    if text is None:
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", str(text)).lower().split())
+
+
+def _run_tokens(run: str) -> List[str]:
+    if _CJK_RE.match(run):
+        # 中文沒有空白分詞：單字與相鄰兩字 (bigram) 都建索引
+        if len(run) == 1:
+            return [run]
+        return list(run) + [run[i:i + 2] for i in range(len(run) - 1)]
+    return [run]
+
+
+def tokenize(text: str) -> List[str]:
+    """索引用的 token (已正規化的文字)"""
+    tokens = []
+    for run in _TOKEN_RE.findall(text):
+        tokens.extend(_run_tokens(run))
+    return tokens
+
+
+def _term_tokens(term: str) -> List[str]:
+    """查詢詞需要的最少 token：中文兩字以上只用 bigram，單字用 unigram"""
+    tokens = []
+    for run in _TOKEN_RE.findall(term):
+        if _CJK_RE.match(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def detect_source(source: Any, post_url: Any) -> str:
+    """貼文來源：有 source 欄位時依欄位，否則由 post_url 的網域判斷"""
+    value = str(source or "").lower()
+    if not value:
+        value = str(post_url or "").lower()
+    if "threads" in value:
+        return "threads"
+    if "facebook" in value or "fb.com" in value or value == "fb":
+        return "facebook"
+    return "other"
+
+
+def time_window(time_type: Any, n_days: int) -> Optional[tuple]:
+    """saved search 的時間條件 (台北時間)
+
+    Returns:
+        (ts_start, ts_end, start_datetime, end_datetime)，不篩選時間時為 None
+    """
+    tz = timezone(timedelta(hours=8))
+    now = datetime.now(tz)
+
+    if time_type == 0:
+        # 昨日 00:00:00 ~ 23:59:59 (台北)
+        y = now - timedelta(days=1)
+        start = y.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = y.replace(hour=23, minute=59, second=59, microsecond=999999)
+    elif time_type == 1:
+        # 今日 00:00:00 ~ 現在 (台北)
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = now
+    elif time_type == 2:
+        # 近 n 日 (含今日)
+        start = (now - timedelta(days=n_days-1)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        end = now
+    else:
+        return None
+
+    return (
+        int(start.timestamp()),
+        int(end.timestamp()),
+        start.strftime("%Y-%m-%d %H:%M:%S"),
+        end.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def parse_query(query: str) -> List[List[str]]:
+    """解析查詢字串為 OR 群組，每個群組內的詞為 AND
+
+    空白分隔的詞為 AND，`OR` 或 `|` 分隔 OR 群組，引號內為片語 (須連續出現)。
+    例如 `颱風 台北 OR "股市 創新高"` → [["颱風", "台北"], ["股市 創新高"]]
+    """
+    groups: List[List[str]] = [[]]
+    for match in _QUERY_TERM_RE.finditer(query or ""):
+        phrase = next((g for g in match.groups()[:3] if g), None)
+        word = match.group(4)
+        if phrase is None and word.lower() in _OR_WORDS:
+            groups.append([])
+            continue
+        if phrase is None and word.lower() in _AND_WORDS:
+            continue
+        term = normalize_text(phrase if phrase is not None else word)
+        if term:
+            groups[-1].append(term)
+    return [group for group in groups if group]
+
+
+def _numeric_column(df: pd.DataFrame, name: str) -> np.ndarray:
+    """數值欄位 (無法轉換或負數視為 0)"""
+    if name not in df.columns:
+        return np.zeros(len(df), dtype=np.float64)
+    return pd.to_numeric(df[name], errors="coerce").fillna(0).clip(lower=0).to_numpy(dtype=np.float64)
+
+
+def top_k_rows(rows: np.ndarray, values: np.ndarray, k: int) -> np.ndarray:
+    """values 最大的 k 列 (由大到小，同分時依列位置)；先以 argpartition 選出 k 列再排序"""
+    if k <= 0 or not len(rows):
+        return _EMPTY
+    if k < len(rows):
+        selected = np.argpartition(-values, k - 1)[:k]
+    else:
+        selected = np.arange(len(rows))
+    order = selected[np.lexsort((rows[selected], -values[selected]))]
+    return rows[order]
+
+
+class KolDataIndex:
+    """kol_data 的記憶體索引 (每個 worker 一份，依版本戳記重建)
+
+    - df: kol_data 的 DataFrame (列順序與 sheet 相同，index 為列位置)
+    - 內容的倒排索引：token → 排序過的列位置 (numpy int32)
+    - BM25 用的詞頻、文件長度，以及互動數/發文時間的加權 (與資料一起預先計算)
+    - 篩選用的索引：依時間排序的列位置 (searchsorted 取區間)、各來源與各 kol_id 的列位置
+    """
+
+    def __init__(self, version: str, kol_data: List[Dict[str, Any]]):
+        self.version = version
+        df = pd.DataFrame(kol_data)
+        if "timestamp" in df.columns:
+            df["timestamp"] = pd.to_numeric(df["timestamp"], errors="coerce")
+        if len(df):
+            sources = df["source"].tolist() if "source" in df.columns else [None] * len(df)
+            urls = df["post_url"].tolist() if "post_url" in df.columns else [None] * len(df)
+            df["source"] = pd.Categorical(
+                [detect_source(source, url) for source, url in zip(sources, urls)], categories=SOURCES
+            )
+        self.df = df
+        self._build_filters(df)
+
+        contents = df["content"].tolist() if "content" in df.columns else [""] * len(df)
+        # 去掉空白的正規化內容，用來確認片語是否連續出現
+        self._compact: List[str] = []
+        postings: Dict[str, List[int]] = {}
+        freqs: Dict[str, List[int]] = {}
+        doc_len = np.zeros(len(df), dtype=np.float32)
+        for row, content in enumerate(contents):
+            text = normalize_text(content)
+            self._compact.append(text.replace(" ", ""))
+            counts = Counter(tokenize(text))
+            doc_len[row] = sum(counts.values())
+            for token, count in counts.items():
+                postings.setdefault(token, []).append(row)
+                freqs.setdefault(token, []).append(count)
+        self.postings: Dict[str, np.ndarray] = {
+            token: np.asarray(rows, dtype=np.int32) for token, rows in postings.items()
+        }
+        # 與 postings 對齊的詞頻
+        self.term_freqs: Dict[str, np.ndarray] = {
+            token: np.asarray(counts, dtype=np.float32) for token, counts in freqs.items()
+        }
+        self.doc_len = doc_len
+        self.avg_doc_len = float(doc_len.mean()) if len(doc_len) and doc_len.mean() > 0 else 1.0
+        self.reactions = _numeric_column(df, "reaction_count")
+        self.shares = _numeric_column(df, "share_count")
+        self.boost = self._build_boost(df)
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def _build_boost(self, df: pd.DataFrame) -> np.ndarray:
+        """每篇貼文的加權倍數：1 + 互動數權重 × 正規化互動 + 時間權重 × 時間衰減
+
+        時間以資料中最新的一筆為基準，相同資料永遠得到相同排序。
+        """
+        n = len(df)
+        if not n:
+            return np.ones(0, dtype=np.float32)
+
+        engagement = np.log1p(self.reactions) + LLM_CONTEXT_SHARE_WEIGHT * np.log1p(self.shares)
+        max_engagement = engagement.max()
+        if max_engagement > 0:
+            engagement /= max_engagement
+
+        recency = np.zeros(n, dtype=np.float64)
+        half_life = KOL_SEARCH_RECENCY_HALF_LIFE_HOURS * 3600
+        if "timestamp" in df.columns and half_life > 0:
+            timestamps = df["timestamp"].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(timestamps)
+            if valid.any():
+                newest = timestamps[valid].max()
+                recency[valid] = 0.5 ** ((newest - timestamps[valid]) / half_life)
+
+        boost = 1.0 + KOL_SEARCH_ENGAGEMENT_WEIGHT * engagement + KOL_SEARCH_RECENCY_WEIGHT * recency
+        return boost.astype(np.float32)
+
+    def _build_filters(self, df: pd.DataFrame) -> None:
+        n = len(df)
+        self.all_rows = np.arange(n, dtype=np.int32)
+
+        # 依時間排序的列位置 (沒有時間的列排在最後，不會落入任何區間)
+        if "timestamp" in df.columns and n:
+            timestamps = df["timestamp"].to_numpy(dtype=np.float64)
+            self._time_order = np.argsort(timestamps, kind="stable").astype(np.int32)
+            self._sorted_ts = timestamps[self._time_order]
+        else:
+            self._time_order = _EMPTY
+            self._sorted_ts = np.empty(0, dtype=np.float64)
+
+        # 各來源的列位置 (categorical codes 只需比較一次)
+        self.source_rows: Dict[str, np.ndarray] = {}
+        if "source" in df.columns and n:
+            codes = df["source"].cat.codes.to_numpy()
+            for code, source in enumerate(df["source"].cat.categories):
+                self.source_rows[source] = np.flatnonzero(codes == code).astype(np.int32)
+
+        # 各 kol_id 的列位置 (tag 篩選換算成 kol_id 後使用)
+        self.kol_rows: Dict[str, np.ndarray] = {}
+        if "kol_id" in df.columns and n:
+            for kol_id, rows in df.groupby("kol_id", sort=False).indices.items():
+                self.kol_rows[kol_id] = rows.astype(np.int32)
+
+    def time_rows(self, ts_start: float, ts_end: float) -> np.ndarray:
+        """timestamp 介於 [ts_start, ts_end] 的列位置 (由小到大)"""
+        lo = np.searchsorted(self._sorted_ts, ts_start, side="left")
+        hi = np.searchsorted(self._sorted_ts, ts_end, side="right")
+        return np.sort(self._time_order[lo:hi])
+
+    def select(
+        self,
+        rows: Optional[np.ndarray] = None,
+        time_range: Optional[tuple] = None,
+        source: Optional[str] = None,
+        kol_ids: Optional[List[str]] = None,
+    ) -> np.ndarray:
+        """以索引組合篩選條件，返回符合的列位置 (由小到大)
+
+        Args:
+            rows: 候選列位置 (例如關鍵字查詢的結果)，None 為全部
+            time_range: (ts_start, ts_end)，None 為不篩選
+            source: SOURCES 之一，None 為不篩選
+            kol_ids: kol_id 列表，None 為不篩選
+        """
+        candidates = []
+        if rows is not None:
+            candidates.append(np.asarray(rows, dtype=np.int32))
+        if time_range is not None:
+            candidates.append(self.time_rows(*time_range))
+        if source is not None:
+            candidates.append(self.source_rows.get(source, _EMPTY))
+        if kol_ids is not None:
+            parts = [self.kol_rows[kol_id] for kol_id in set(kol_ids) if kol_id in self.kol_rows]
+            candidates.append(np.sort(np.concatenate(parts)) if parts else _EMPTY)
+        if not candidates:
+            return self.all_rows
+
+        # 從最小的集合開始交集
+        candidates.sort(key=len)
+        result = candidates[0]
+        for other in candidates[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, other, assume_unique=True)
+        return result.astype(np.int32, copy=False)
+
+    def _term_freq(self, token: str, rows: np.ndarray) -> np.ndarray:
+        """rows 中每一列的 token 詞頻 (postings 已排序，用 searchsorted 查找)"""
+        postings = self.postings.get(token)
+        if postings is None or not len(rows):
+            return np.zeros(len(rows), dtype=np.float32)
+        pos = np.searchsorted(postings, rows)
+        pos = np.minimum(pos, len(postings) - 1)
+        hit = postings[pos] == rows
+        return np.where(hit, self.term_freqs[token][pos], 0).astype(np.float32)
+
+    def score(self, rows: np.ndarray, query: str) -> np.ndarray:
+        """rows 的相關度分數 = BM25 × 加權倍數；沒有查詢詞時只看互動數與發文時間"""
+        rows = np.asarray(rows, dtype=np.int32)
+        tokens = {token for group in parse_query(query) for term in group for token in _term_tokens(term)}
+        if not tokens:
+            return self.boost[rows].copy()
+
+        n_docs = len(self.df)
+        norm = KOL_SEARCH_BM25_K1 * (1 - KOL_SEARCH_BM25_B + KOL_SEARCH_BM25_B * self.doc_len[rows] / self.avg_doc_len)
+        bm25 = np.zeros(len(rows), dtype=np.float32)
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                continue
+            df_token = len(postings)
+            idf = math.log(1 + (n_docs - df_token + 0.5) / (df_token + 0.5))
+            tf = self._term_freq(token, rows)
+            bm25 += idf * tf * (KOL_SEARCH_BM25_K1 + 1) / (tf + norm)
+        return bm25 * self.boost[rows]
+
+    def rank(self, rows: np.ndarray, query: str, top_k: int = 0):
+        """依相關度排序 rows (高者在前)
+
+        top_k > 0 時只保留最相關的 K 列：先以 argpartition 選出 K 列 (O(n))，
+        只對這 K 列排序。
+
+        Returns:
+            (排序後的列位置, 對應的分數)
+        """
+        rows = np.asarray(rows, dtype=np.int32)
+        scores = self.score(rows, query)
+        if top_k and 0 < top_k < len(rows):
+            selected = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            selected = np.arange(len(rows))
+        # 同分時維持原本 (sheet) 的順序
+        order = selected[np.lexsort((rows[selected], -scores[selected]))]
+        return rows[order], scores[order]
+
+    def metric_values(self, metric: str) -> np.ndarray:
+        """排行榜指標：reaction (互動數)、share (分享數)、weighted (互動數 + 權重 × 分享數)"""
+        if metric == "reaction":
+            return self.reactions
+        if metric == "share":
+            return self.shares
+        if metric == "weighted":
+            return self.reactions + LLM_CONTEXT_SHARE_WEIGHT * self.shares
+        raise ValueError(f"不支援的排行指標: {metric}")
+
+    def _match_term(self, term: str) -> np.ndarray:
+        tokens = _term_tokens(term)
+        if not tokens:
+            return _EMPTY
+        lists = []
+        for token in set(tokens):
+            rows = self.postings.get(token)
+            if rows is None:
+                return _EMPTY
+            lists.append(rows)
+        lists.sort(key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+            if not len(rows):
+                return _EMPTY
+        if len(tokens) > 1:
+            # bigram 都出現不代表連續出現，逐筆確認 (候選通常很少)；中文內文沒有空白，比對時忽略空白
+            compact = term.replace(" ", "")
+            rows = np.fromiter((r for r in rows if compact in self._compact[r]), dtype=np.int32)
+        return rows
+
+    def search(self, query: str) -> np.ndarray:
+        """符合查詢的列位置 (由小到大)"""
+        result = _EMPTY
+        for group in parse_query(query):
+            rows = None
+            for term in sorted(group, key=len, reverse=True):
+                matched = self._match_term(term)
+                rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+                if not len(rows):
+                    break
+            if rows is not None and len(rows):
+                result = np.union1d(result, rows)
+        return result.astype(np.int32, copy=False)
+
+
+_index: Optional[KolDataIndex] = None
+_index_lock = threading.RLock()
+
+
+def rebuild_kol_index(kol_data: List[Dict[str, Any]], version: str) -> KolDataIndex:
+    """以手上的資料直接重建本 worker 的索引 (例如剛從 Google Sheet 取得資料時)"""
+    global _index
+    index = KolDataIndex(version, kol_data)
+    with _index_lock:
+        _index = index
+    logger.info(f"kol_data 索引已建立: {len(index)} 筆, {len(index.postings)} 個 token (版本 {version[:8]})")
+
+    # 依賴索引的預先計算 (使用延遲導入避免循環導入)
+    from .leaderboard import precompute_leaderboards
+    from .rollups import build_rollups
+    kol_info = shared_cache.get("sheet:kol_info", default=[]) or []
+    for name, build in (("排行榜", precompute_leaderboards), ("每日彙總表", build_rollups)):
+        try:
+            build(index, kol_info)
+        except Exception as e:
+            logger.error(f"建立{name}時出錯: {str(e)}")
+    return index
+
+
+def get_kol_index() -> Optional[KolDataIndex]:
+    """取得與 Redis 版本一致的 kol_data 索引，版本變動時重建
+
+    Redis 中沒有資料時會先從 Google Sheet 更新；仍然沒有資料時返回 None。
+    """
+    try:
+        r = get_redis_connection()
+        version = r.get(KOL_DATA_VERSION_KEY)
+    except Exception as e:
+        logger.error(f"讀取 kol_data 版本時出錯: {str(e)}")
+        r = None
+        version = None
+
+    index = _index
+    if index is not None and version is not None and index.version == version:
+        return index
+
+    with _index_lock:
+        index = _index
+        if index is not None and version is not None and index.version == version:
+            return index
+
+        kol_data = get_redis_key("sheet:kol_data", default=[])
+        if not kol_data:
+            # 使用延遲導入避免循環導入
+            from .sheet import sheet_manager
+            kol_data = sheet_manager.get_kol_data(force_refresh=True)
+            if not kol_data:
+                return None
+            return _index
+        if version is None:
+            # 資料不是經由 SheetManager 寫入 (例如 benchmark)，補上版本戳記
+            version = uuid.uuid4().hex
+            try:
+                r = r or get_redis_connection()
+                ttl = r.ttl("sheet:kol_data")
+                if not r.set(KOL_DATA_VERSION_KEY, version, nx=True, ex=ttl if ttl and ttl > 0 else None):
+                    version = r.get(KOL_DATA_VERSION_KEY) or version
+            except Exception as e:
+                logger.error(f"寫入 kol_data 版本時出錯: {str(e)}")
+
+        return rebuild_kol_index(kol_data, version)
@@ -0,0 +1,146 @@
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .redis import render_posts, kol_info_frame
+from .shared_cache import shared_cache
+from .utils import logger
+from .kol_index import KolDataIndex, SOURCE_FILTERS, get_kol_index, time_window, top_k_rows
+from .settings import LEADERBOARD_DEFAULT_K, LEADERBOARD_MAX_K
+
+METRICS = ("reaction", "share", "weighted")
+# 預先計算的時間區間 (time, n)：昨日、今日、近 7 日
+COMMON_WINDOWS = [(0, 1), (1, 1), (2, 7)]
+ALL_TAGS = "All"
+
+# 本 worker 預先計算的排行榜，與 kol_data 索引版本對應
+# (tag, time, n, metric) -> (區間開始時間, 前 LEADERBOARD_MAX_K 名的列位置)
+_boards: Dict[Tuple[str, Any, int, str], Tuple[int, np.ndarray]] = {}
+_boards_version: Optional[str] = None
+_boards_lock = threading.Lock()
+
+
+def _window_key(time_type: Any, n_days: int) -> Tuple[Any, int]:
+    # 只有「近 n 日」與 n 有關
+    return (time_type, n_days if time_type == 2 else 1)
+
+
+def _tag_kol_ids(kol_info: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    tag_kols: Dict[str, List[str]] = {}
+    for info in kol_info:
+        tag = info.get("tag")
+        if tag and info.get("kol_id") is not None:
+            tag_kols.setdefault(tag, []).append(info["kol_id"])
+    return tag_kols
+
+
+def precompute_leaderboards(index: KolDataIndex, kol_info: Optional[List[Dict[str, Any]]] = None) -> int:
+    """為每個 tag (含 All) × 常用時間區間 × 指標預先算好前 LEADERBOARD_MAX_K 名
+
+    在 kol_data 索引重建時呼叫。資料在下次更新前不會有更新的貼文，因此只比對區間的
+    開始時間；日期改變 (開始時間不同) 時改為即時計算。
+
+    Returns:
+        排行榜數量
+    """
+    global _boards, _boards_version
+    if kol_info is None:
+        kol_info = shared_cache.get("sheet:kol_info", default=[]) or []
+    tag_kols = _tag_kol_ids(kol_info)
+    values = {metric: index.metric_values(metric) for metric in METRICS}
+
+    boards = {}
+    for time_type, n_days in COMMON_WINDOWS:
+        window = time_window(time_type, n_days)
+        window_rows = index.select(time_range=window[:2])
+        for tag in [ALL_TAGS] + sorted(tag_kols):
+            rows = window_rows if tag == ALL_TAGS else index.select(rows=window_rows, kol_ids=tag_kols[tag])
+            for metric in METRICS:
+                top = top_k_rows(rows, values[metric][rows], LEADERBOARD_MAX_K)
+                boards[(tag, time_type, n_days, metric)] = (window[0], top)
+
+    with _boards_lock:
+        _boards = boards
+        _boards_version = index.version
+    logger.info(f"排行榜已預先計算: {len(boards)} 個 (版本 {index.version[:8]})")
+    return len(boards)
+
+
+def _precomputed(index: KolDataIndex, tag: str, time_type: Any, n_days: int, metric: str, window) -> Optional[np.ndarray]:
+    with _boards_lock:
+        if _boards_version != index.version:
+            return None
+        board = _boards.get((tag, *_window_key(time_type, n_days), metric))
+    if board is None or window is None or board[0] != window[0]:
+        return None
+    return board[1]
+
+
+def get_leaderboard(
+    tags: Optional[List[str]] = None,
+    time_type: Any = "",
+    n_days: int = 1,
+    source: int = 0,
+    metric: str = "reaction",
+    k: int = LEADERBOARD_DEFAULT_K,
+) -> Dict[str, Any]:
+    """依互動數/分享數/加權分數取得前 k 名貼文
+
+    單一 tag (或 All)、不篩選來源、常用時間區間時直接使用預先計算的結果，
+    其他條件以索引取出區間後用 argpartition 部分選取。
+    """
+    if metric not in METRICS:
+        raise ValueError(f"不支援的排行指標: {metric}，可用 {', '.join(METRICS)}")
+    k = min(max(int(k or LEADERBOARD_DEFAULT_K), 1), LEADERBOARD_MAX_K)
+    tags = [tag for tag in (tags or []) if tag] or [ALL_TAGS]
+
+    index = get_kol_index()
+    window = time_window(time_type, n_days)
+    result = {
+        "metric": metric,
+        "k": k,
+        "start_datetime": window[2] if window else "",
+        "end_datetime": window[3] if window else "",
+        "precomputed": False,
+        "posts": [],
+    }
+    if index is None or not len(index):
+        return result
+
+    source_name = SOURCE_FILTERS.get(source)
+    kol_info = shared_cache.get("sheet:kol_info", default=[]) or []
+
+    top = None
+    if source_name is None and len(tags) == 1:
+        top = _precomputed(index, tags[0], time_type, n_days, metric, window)
+    if top is not None:
+        result["precomputed"] = True
+        top = top[:k]
+    else:
+        kol_ids = None
+        if tags != [ALL_TAGS]:
+            tag_kols = _tag_kol_ids(kol_info)
+            kol_ids = [kol_id for tag in tags for kol_id in tag_kols.get(tag, [])]
+        rows = index.select(
+            time_range=window[:2] if window else None,
+            source=source_name,
+            kol_ids=kol_ids,
+        )
+        top = top_k_rows(rows, index.metric_values(metric)[rows], k)
+
+    result["posts"] = _leaderboard_posts(index, top, index.metric_values(metric)[top], kol_info)
+    return result
+
+
+def _leaderboard_posts(index: KolDataIndex, rows: np.ndarray, values: np.ndarray, kol_info: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """以 /api/redis/kol-data 的 render_posts 組成欄位，score 為排行指標的值"""
+    if not len(rows):
+        return []
+    df = render_posts(index, kol_info_frame(kol_info), rows, values)
+    posts = df[["Id", "KOL", "連結", "內容", "互動數", "分享數", "發文時間", "相關度"]].rename(columns={"相關度": "score"})
+    posts["內容"] = posts["內容"].astype(str).str[:100]
+    # 排行榜以數值輸出 (Google Sheet 的原始值可能是字串)
+    posts["互動數"] = index.reactions[rows].astype(int)
+    posts["分享數"] = index.shares[rows].astype(int)
+    return posts.to_dict(orient="records")
@@ -0,0 +1,348 @@
+import time
+import math
+import uuid
+import random
+import hashlib
+import threading
+import functools
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from .utils import logger
+from .metrics import metrics, add_timing
+from .settings import (
+    LLM_BACKEND,
+    GEMINI_MODEL,
+    GEMINI_API_KEY,
+    LLM_STUB_LATENCY_DISTRIBUTION,
+    LLM_STUB_LATENCY_MS,
+    LLM_STUB_LATENCY_JITTER,
+    LLM_STUB_TOKENS_PER_SECOND,
+    LLM_STUB_OUTPUT_TOKENS,
+    LLM_STUB_STREAM_CHUNK_TOKENS,
+    LLM_STUB_FAILURE_RATE,
+    LLM_STUB_SEED,
+)
+
+# 每個行程最多保留的 cached model 物件數
+_MAX_CACHED_MODELS = 256
+
+
+class LLMError(Exception):
+    """LLM 呼叫失敗"""
+
+
+class LLMNotConfiguredError(LLMError):
+    """LLM 後端未設定 (例如缺少 API 金鑰)"""
+
+
+class CachedContextMissError(LLMError):
+    """cached context handle 已失效 (過期、被刪除或不在此行程中)"""
+
+
+class LLMResult:
+    """LLM 回應與用量"""
+
+    def __init__(self, text: str, input_tokens: int = 0, output_tokens: int = 0):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+def _part_text(part: Any) -> str:
+    if isinstance(part, dict):
+        return part.get("text", "")
+    return str(part)
+
+
+def history_chars(history: List[Dict[str, Any]]) -> int:
+    """計算對話紀錄的總字數 (history 格式與 Gemini 相同：role + parts)"""
+    return sum(len(_part_text(p)) for item in history or [] for p in item.get("parts", []))
+
+
+def _instrumented(op: str):
+    """記錄 LLM 呼叫的延遲、token 數與錯誤次數"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(self, *args, **kwargs)
+            except Exception:
+                metrics.inc("llm_errors_total", backend=self.name, model=self.model, op=op)
+                raise
+            elapsed = time.perf_counter() - start
+            add_timing("llm", elapsed)
+            metrics.observe("llm_request_duration_seconds", elapsed, backend=self.name, model=self.model, op=op)
+            metrics.inc("llm_tokens_total", result.input_tokens, backend=self.name, model=self.model, direction="input")
+            metrics.inc("llm_tokens_total", result.output_tokens, backend=self.name, model=self.model, direction="output")
+            return result
+        return wrapper
+    return decorator
+
+
+class LLMProvider(ABC):
+    """LLM 後端介面
+
+    history 使用 Gemini 的格式：[{"role": "user" | "model", "parts": [str | {"text": str}]}]
+    子類別必須實作所有 abstractmethod，缺少時在建立實例時就會出錯，而不是在請求中途。
+    """
+
+    name = "base"
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def is_configured(self) -> bool:
+        return True
+
+    @abstractmethod
+    def chat(self, history: List[Dict[str, Any]], message: str) -> LLMResult:
+        """以對話紀錄與新訊息取得回應"""
+
+    def stream_chat(self, history: List[Dict[str, Any]], message: str) -> Iterator[str]:
+        yield self.chat(history, message).text
+
+    @abstractmethod
+    def create_cached_context(self, system_instruction: str, contents: List[Dict[str, Any]], ttl: int) -> str:
+        """在後端保存 prompt 與資料，返回 handle"""
+
+    @abstractmethod
+    def generate_cached(self, handle: str, message: str) -> LLMResult:
+        """以 cached context 回答；handle 失效時拋出 CachedContextMissError"""
+
+    @abstractmethod
+    def delete_cached_context(self, handle: str) -> None:
+        """刪除 cached context"""
+
+
+class GeminiProvider(LLMProvider):
+    """google.generativeai 後端"""
+
+    name = "gemini"
+
+    def __init__(self, model: str = GEMINI_MODEL, api_key: str = GEMINI_API_KEY):
+        super().__init__(model)
+        self.api_key = api_key
+        self._cached_models: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def is_configured(self) -> bool:
+        return bool(self.api_key)
+
+    def _genai(self):
+        if not self.api_key:
+            raise LLMNotConfiguredError("未設置 Gemini API 金鑰")
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        return genai
+
+    @staticmethod
+    def _result(response) -> LLMResult:
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResult(
+            response.text,
+            input_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+    @_instrumented("chat")
+    def chat(self, history, message):
+        genai = self._genai()
+        chat = genai.GenerativeModel(self.model).start_chat(history=history or None)
+        return self._result(chat.send_message(message))
+
+    def stream_chat(self, history, message):
+        genai = self._genai()
+        chat = genai.GenerativeModel(self.model).start_chat(history=history or None)
+        for chunk in chat.send_message(message, stream=True):
+            yield chunk.text
+
+    def _remember(self, handle: str, model: Any) -> None:
+        with self._lock:
+            self._cached_models[handle] = model
+            while len(self._cached_models) > _MAX_CACHED_MODELS:
+                self._cached_models.pop(next(iter(self._cached_models)))
+
+    def create_cached_context(self, system_instruction, contents, ttl):
+        genai = self._genai()
+        from google.generativeai import caching
+
+        model_name = self.model if self.model.startswith("models/") else f"models/{self.model}"
+        cache = caching.CachedContent.create(
+            model=model_name,
+            display_name=f"st-llm-{uuid.uuid4().hex[:8]}",
+            system_instruction=system_instruction,
+            contents=contents,
+            ttl=timedelta(seconds=ttl),
+        )
+        self._remember(cache.name, genai.GenerativeModel.from_cached_content(cached_content=cache))
+        return cache.name
+
+    @_instrumented("generate_cached")
+    def generate_cached(self, handle, message):
+        from google.api_core import exceptions as google_exceptions
+
+        model = self._cached_models.get(handle)
+        try:
+            if model is None:
+                # 其他 worker 建立的 cache，取回後保存在本行程
+                model = self._genai().GenerativeModel.from_cached_content(cached_content=handle)
+                self._remember(handle, model)
+            return self._result(model.generate_content(message))
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e:
+            with self._lock:
+                self._cached_models.pop(handle, None)
+            raise CachedContextMissError(str(e))
+
+    def delete_cached_context(self, handle):
+        self._genai()
+        from google.generativeai import caching
+
+        with self._lock:
+            self._cached_models.pop(handle, None)
+        caching.CachedContent(handle).delete()
+
+
+class StubProvider(LLMProvider):
+    """本地假 LLM 後端，供測試與壓測使用，不需要網路與 API 金鑰
+
+    回應內容由輸入決定 (相同輸入永遠得到相同回應)；延遲、輸出速度與失敗率
+    依設定模擬，隨機數使用固定 seed，重跑壓測可得到相同的分布。
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        model: str = "stub",
+        latency_distribution: str = LLM_STUB_LATENCY_DISTRIBUTION,
+        latency_ms: float = LLM_STUB_LATENCY_MS,
+        latency_jitter: float = LLM_STUB_LATENCY_JITTER,
+        tokens_per_second: float = LLM_STUB_TOKENS_PER_SECOND,
+        output_tokens: int = LLM_STUB_OUTPUT_TOKENS,
+        stream_chunk_tokens: int = LLM_STUB_STREAM_CHUNK_TOKENS,
+        failure_rate: float = LLM_STUB_FAILURE_RATE,
+        seed: int = LLM_STUB_SEED,
+    ):
+        super().__init__(model)
+        self.latency_distribution = latency_distribution
+        self.latency_ms = latency_ms
+        self.latency_jitter = latency_jitter
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.stream_chunk_tokens = max(stream_chunk_tokens, 1)
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._contexts: Dict[str, Dict[str, Any]] = {}
+        self.call_count = 0
+        self.cached_context_count = 0
+
+    def _first_token_latency(self) -> float:
+        """依設定的分布抽出首個 token 的延遲 (秒)"""
+        mean = self.latency_ms / 1000
+        with self._lock:
+            if self.latency_distribution == "fixed":
+                value = mean
+            elif self.latency_distribution == "uniform":
+                value = self._rng.uniform(mean * (1 - self.latency_jitter), mean * (1 + self.latency_jitter))
+            elif self.latency_distribution == "normal":
+                value = self._rng.gauss(mean, mean * self.latency_jitter)
+            else:
+                # lognormal：latency_ms 為中位數，jitter 為 sigma，模擬長尾
+                value = mean * math.exp(self._rng.gauss(0, self.latency_jitter))
+        return max(value, 0.0)
+
+    def _maybe_fail(self) -> None:
+        with self._lock:
+            self.call_count += 1
+            failed = self.failure_rate > 0 and self._rng.random() < self.failure_rate
+        if failed:
+            raise LLMError("stub LLM 模擬失敗")
+
+    def _reply_tokens(self, history, message) -> List[str]:
+        digest = hashlib.sha256(f"{history_chars(history)}\x1f{message}".encode("utf-8")).hexdigest()
+        words = [digest[i:i + 4] for i in range(0, len(digest), 4)]
+        tokens = [f"[stub:{self.model}]"]
+        while len(tokens) < self.output_tokens:
+            tokens.append(words[len(tokens) % len(words)])
+        return tokens
+
+    def _token_delay(self, count: int) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return count / self.tokens_per_second
+
+    @_instrumented("chat")
+    def chat(self, history, message):
+        self._maybe_fail()
+        tokens = self._reply_tokens(history, message)
+        time.sleep(self._first_token_latency() + self._token_delay(len(tokens)))
+        input_tokens = (history_chars(history) + len(message)) // 2
+        return LLMResult(" ".join(tokens), input_tokens=input_tokens, output_tokens=len(tokens))
+
+    def stream_chat(self, history, message):
+        self._maybe_fail()
+        tokens = self._reply_tokens(history, message)
+        time.sleep(self._first_token_latency())
+        for i in range(0, len(tokens), self.stream_chunk_tokens):
+            chunk = tokens[i:i + self.stream_chunk_tokens]
+            if i:
+                time.sleep(self._token_delay(len(chunk)))
+            yield " ".join(chunk) + " "
+
+    def create_cached_context(self, system_instruction, contents, ttl):
+        handle = f"stub/{uuid.uuid4().hex}"
+        now = time.time()
+        with self._lock:
+            # 順便清掉已過期的項目
+            for key in [k for k, v in self._contexts.items() if v["expire_at"] <= now]:
+                del self._contexts[key]
+            self._contexts[handle] = {
+                "history": [{"role": "user", "parts": [system_instruction]}] + list(contents),
+                "expire_at": now + ttl,
+            }
+            self.cached_context_count += 1
+        return handle
+
+    def generate_cached(self, handle, message):
+        entry = self._contexts.get(handle)
+        if entry is None or entry["expire_at"] <= time.time():
+            raise CachedContextMissError(handle)
+        return self.chat(entry["history"], message)
+
+    def delete_cached_context(self, handle):
+        with self._lock:
+            self._contexts.pop(handle, None)
+
+
+def create_llm_provider(backend: str = LLM_BACKEND) -> LLMProvider:
+    """依名稱建立 LLM 後端 (gemini 或 stub)"""
+    if backend == "stub":
+        return StubProvider()
+    if backend != "gemini":
+        logger.warning(f"未知的 LLM 後端 {backend}，改用 gemini")
+    return GeminiProvider()
+
+
+_provider: Optional[LLMProvider] = None
+_provider_lock = threading.Lock()
+
+
+def get_llm_provider() -> LLMProvider:
+    """取得全局 LLM 後端 (由 ST_LLM_BACKEND 決定)"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = create_llm_provider()
+                logger.info(f"使用 LLM 後端: {_provider.name} ({_provider.model})")
+    return _provider
+
+
+def set_llm_provider(provider: LLMProvider) -> None:
+    """替換全局 LLM 後端 (測試與壓測用)"""
+    global _provider
+    _provider = provider
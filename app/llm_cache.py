@@ -0,0 +1,100 @@
+import re
+import json
+import time
+import hashlib
+import unicodedata
+from typing import Any, Dict, Optional
+
+from .redis import get_redis_connection
+from .utils import logger
+from .settings import (
+    LLM_CACHE_ENABLED,
+    LLM_CACHE_TTL,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_MAX_ENTRY_BYTES,
+)
+
+# Redis key 前綴：llm_cache:{hash} 存回應，llm_cache:index 依寫入時間排序
+LLM_CACHE_PREFIX = "llm_cache"
+LLM_CACHE_INDEX_KEY = f"{LLM_CACHE_PREFIX}:index"
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+# 問句結尾常見的標點，不影響語意
+_TRAILING_PUNCTUATION = "?？!！。.,，~～ "
+
+
+def normalize_query(query: str) -> str:
+    """正規化使用者查詢：全半形統一、忽略大小寫、合併空白、去除結尾標點"""
+    if not query:
+        return ""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    text = _WHITESPACE_PATTERN.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+def content_digest(content: str) -> str:
+    """計算資料內容的 sha256 摘要"""
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+
+def make_cache_key(prompt_version: str, data_digest: str, model: str, query: str) -> str:
+    """由 prompt 版本、資料摘要、模型名稱與正規化查詢組成 cache key"""
+    raw = "\x1f".join([prompt_version or "", data_digest or "", model or "", normalize_query(query)])
+    return f"{LLM_CACHE_PREFIX}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def get_cached_response(cache_key: str) -> Optional[Dict[str, Any]]:
+    """讀取緩存的 LLM 回應，不存在或已過期時返回 None"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        r = get_redis_connection()
+        value = r.get(cache_key)
+        if value is None:
+            return None
+        return json.loads(value)
+    except Exception as e:
+        logger.error(f"讀取 LLM 回應緩存 {cache_key} 時出錯: {str(e)}")
+        return None
+
+
+def set_cached_response(cache_key: str, response: Dict[str, Any], ttl: int = LLM_CACHE_TTL) -> bool:
+    """寫入 LLM 回應緩存，並依數量上限淘汰最舊的項目
+
+    Args:
+        cache_key: make_cache_key 產生的 key
+        response: 要緩存的回應內容
+        ttl: 過期時間 (秒)
+
+    Returns:
+        是否成功寫入 (回應過大或緩存停用時返回 False)
+    """
+    if not LLM_CACHE_ENABLED:
+        return False
+    try:
+        value = json.dumps(response, ensure_ascii=False)
+        if len(value.encode("utf-8")) > LLM_CACHE_MAX_ENTRY_BYTES:
+            logger.info(f"LLM 回應過大 ({len(value)} 字元)，不寫入緩存")
+            return False
+
+        now = time.time()
+        r = get_redis_connection()
+        pipe = r.pipeline()
+        pipe.set(cache_key, value, ex=ttl)
+        pipe.zadd(LLM_CACHE_INDEX_KEY, {cache_key: now})
+        # 已過期的項目直接從索引移除
+        pipe.zremrangebyscore(LLM_CACHE_INDEX_KEY, "-inf", now - ttl)
+        pipe.zcard(LLM_CACHE_INDEX_KEY)
+        size = pipe.execute()[-1]
+
+        # 超過數量上限時淘汰最舊的項目
+        overflow = size - LLM_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            evicted = [key for key, _ in r.zpopmin(LLM_CACHE_INDEX_KEY, overflow)]
+            if evicted:
+                r.delete(*evicted)
+                logger.info(f"LLM 回應緩存超過上限，淘汰 {len(evicted)} 筆")
+        return True
+    except Exception as e:
+        logger.error(f"寫入 LLM 回應緩存 {cache_key} 時出錯: {str(e)}")
+        return False
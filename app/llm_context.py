@@ -0,0 +1,180 @@
+import re
+import math
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+from .settings import (
+    LLM_CONTEXT_TOKEN_BUDGET,
+    LLM_CONTEXT_CONTENT_CHARS,
+    LLM_CONTEXT_SHORT_CONTENT_CHARS,
+    LLM_CONTEXT_SHARE_WEIGHT,
+    LLM_CONTEXT_RECENCY_WEIGHT,
+    LLM_CONTEXT_RECENCY_HALF_LIFE_HOURS,
+)
+
+# 中日韓文字 (含全形標點) 大約每字 1 個 token，其餘字元約 4 個字元 1 個 token
+_CJK_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+# 表格欄位 (與 /api/redis/kol-data 的 Markdown 一致)
+_TABLE_HEADER = "| Id | KOL | 連結 | 內容 | 互動數 | 分享數 | 發文時間 |\n|---|---|---|---|---|---|---|\n"
+
+# 預留給長尾摘要的 token 數
+_SUMMARY_RESERVE_TOKENS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估文字的 token 數"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _to_number(value: Any) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def rank_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """依互動數、分享數與發文時間排序貼文 (分數高者在前)
+
+    時間以資料中最新的一筆為基準計算衰減，相同資料永遠得到相同排序。
+    關鍵字查詢的結果帶有「相關度」(BM25，已含互動數與時間加權)，直接依相關度排序。
+    """
+    if not rows:
+        return []
+
+    if all("相關度" in row for row in rows):
+        return sorted(rows, key=lambda row: -_to_number(row.get("相關度")))
+
+    timestamps = [_to_number(row.get("timestamp")) for row in rows]
+    newest = max(timestamps)
+    engagement = [
+        math.log1p(_to_number(row.get("互動數"))) + LLM_CONTEXT_SHARE_WEIGHT * math.log1p(_to_number(row.get("分享數")))
+        for row in rows
+    ]
+    max_engagement = max(engagement) or 1.0
+    half_life = LLM_CONTEXT_RECENCY_HALF_LIFE_HOURS * 3600
+
+    scored = []
+    for i, row in enumerate(rows):
+        recency = 0.5 ** ((newest - timestamps[i]) / half_life) if half_life > 0 else 0.0
+        score = engagement[i] / max_engagement + LLM_CONTEXT_RECENCY_WEIGHT * recency
+        scored.append((-score, i))
+    scored.sort()
+    return [rows[i] for _, i in scored]
+
+
+def _render_row(row: Dict[str, Any], content_chars: int) -> str:
+    content = str(row.get("內容", "") or "").replace("\n", " ").replace("|", "／")
+    if len(content) > content_chars:
+        content = content[:content_chars] + "..."
+    return (
+        f"| {row.get('Id', '')} | {row.get('KOL', '')} | {row.get('連結', '')} | {content} "
+        f"| {row.get('互動數', '')} | {row.get('分享數', '')} | {row.get('發文時間', '')} |\n"
+    )
+
+
+def _summarize_rows(rows: List[Dict[str, Any]]) -> str:
+    """把未放入表格的長尾貼文彙總成一段文字"""
+    reactions = sum(_to_number(row.get("互動數")) for row in rows)
+    shares = sum(_to_number(row.get("分享數")) for row in rows)
+    times = sorted(str(row.get("發文時間", "")) for row in rows if row.get("發文時間"))
+    top_kols = Counter(str(row.get("KOL", "")) for row in rows).most_common(5)
+
+    summary = f"\n另有 {len(rows)} 筆較低互動的貼文未列出，合計互動數 {int(reactions)}、分享數 {int(shares)}"
+    if times:
+        summary += f"，發文時間介於 {times[0]} ~ {times[-1]}"
+    if top_kols:
+        summary += "；發文較多的 KOL：" + "、".join(f"{name} ({count} 篇)" for name, count in top_kols)
+    return summary + "。\n"
+
+
+def build_kol_context(
+    rows: List[Dict[str, Any]],
+    token_budget: int = LLM_CONTEXT_TOKEN_BUDGET
+) -> Tuple[str, Dict[str, Any]]:
+    """在 token 預算內建立給 LLM 的 KOL 資料表
+
+    依 rank_rows 的順序放入貼文；放不下完整內容時改放截短的內容，
+    再放不下的長尾貼文則彙總成一段摘要。
+
+    Args:
+        rows: /api/redis/kol-data 儲存的貼文列表
+        token_budget: 資料表可使用的 token 上限
+
+    Returns:
+        (Markdown 表格文字, 內容報告)
+    """
+    ranked = rank_rows(rows)
+    parts = [_TABLE_HEADER]
+    used = estimate_tokens(_TABLE_HEADER)
+    budget = max(token_budget - _SUMMARY_RESERVE_TOKENS, 0)
+
+    included_ids = []
+    truncated = 0
+    stop = len(ranked)
+    for i, row in enumerate(ranked):
+        line = _render_row(row, LLM_CONTEXT_CONTENT_CHARS)
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            line = _render_row(row, LLM_CONTEXT_SHORT_CONTENT_CHARS)
+            cost = estimate_tokens(line)
+            if used + cost > budget:
+                stop = i
+                break
+            truncated += 1
+        parts.append(line)
+        used += cost
+        included_ids.append(row.get("Id"))
+
+    if not included_ids:
+        parts.append("| 沒有資料 | | | | | | |\n")
+
+    omitted = ranked[stop:]
+    if omitted:
+        parts.append(_summarize_rows(omitted))
+    text = "".join(parts)
+
+    report = {
+        "total_rows": len(rows),
+        "included_rows": len(included_ids),
+        "truncated_rows": truncated,
+        "omitted_rows": len(omitted),
+        "estimated_tokens": estimate_tokens(text),
+        "token_budget": token_budget,
+        "included_ids": included_ids,
+    }
+    return text, report
+
+
+def build_markdown_context(
+    markdown_content: str,
+    token_budget: int = LLM_CONTEXT_TOKEN_BUDGET
+) -> Tuple[str, Dict[str, Any]]:
+    """沒有結構化資料時的退路：依行截斷既有的 Markdown 表格"""
+    lines = markdown_content.splitlines(keepends=True)
+    used = 0
+    kept = 0
+    for line in lines:
+        cost = estimate_tokens(line)
+        if used + cost > token_budget:
+            break
+        used += cost
+        kept += 1
+    text = "".join(lines[:kept])
+    omitted = len(lines) - kept
+    if omitted:
+        text += f"\n另有 {omitted} 行資料因長度限制未列出。\n"
+    report = {
+        "total_rows": None,
+        "included_rows": None,
+        "truncated_rows": 0,
+        "omitted_rows": omitted,
+        "estimated_tokens": estimate_tokens(text),
+        "token_budget": token_budget,
+        "included_ids": [],
+    }
+    return text, report
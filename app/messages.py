@@ -0,0 +1,439 @@
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import redis
+from starlette.concurrency import run_in_threadpool
+
+from .redis import get_redis_connection, get_async_redis_connection
+from .utils import logger
+from .settings import SESSION_EXPIRE, MESSAGE_STREAM_HEARTBEAT
+
+
+def message_key(session_id: str, search_id: int) -> str:
+    return f"messages:{session_id}-{search_id}"
+
+
+def sequence_key(session_id: str, search_id: int) -> str:
+    """下一個訊息 ID 的計數器；清空或刪除訊息時不重設，ID 因此只增不減"""
+    return f"messages_seq:{session_id}-{search_id}"
+
+
+def message_channel(session_id: str, search_id: int) -> str:
+    """訊息事件的 pub/sub channel (新增、更新、刪除、清空)"""
+    return f"message_events:{session_id}-{search_id}"
+
+
+def _event(event_type: str, **payload: Any) -> str:
+    return json.dumps({"type": event_type, **payload}, ensure_ascii=False)
+
+
+def _encode(message: Dict[str, Any]) -> str:
+    return json.dumps(message, ensure_ascii=False, sort_keys=True)
+
+
+def _decode(members: List[str]) -> List[Dict[str, Any]]:
+    return [json.loads(member) for member in members]
+
+
+def _migrate(r: redis.Redis, key: str) -> None:
+    """舊格式 (整個訊息列表存成一個 JSON 字串) 轉成 sorted set
+
+    第一次以新格式存取到舊 key 時才轉換；WATCH 確保只有一個請求完成轉換。
+    """
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != "string":
+                    pipe.unwatch()
+                    return
+                raw = pipe.get(key)
+                ttl = pipe.ttl(key)
+                try:
+                    messages = json.loads(raw) if raw else []
+                except json.JSONDecodeError:
+                    messages = []
+                pipe.multi()
+                pipe.delete(key)
+                if messages:
+                    pipe.zadd(key, {_encode(m): m["id"] for m in messages})
+                    pipe.expire(key, ttl if ttl and ttl > 0 else SESSION_EXPIRE)
+                pipe.execute()
+                logger.info(f"訊息 {key} 已轉換為 sorted set ({len(messages)} 則)")
+                return
+            except redis.WatchError:
+                continue
+
+
+def _next_id(pipe: redis.client.Pipeline, key: str, seq_key: str) -> int:
+    """在 WATCH 中讀取下一個訊息 ID
+
+    計數器不存在時 (舊資料或過期) 從目前最大 ID + 1 開始。
+    """
+    seq = pipe.get(seq_key)
+    if seq is not None:
+        return int(seq)
+    last = pipe.zrevrange(key, 0, 0, withscores=True)
+    return int(last[0][1]) + 1 if last else 0
+
+
+def _run(key: str, fn: Callable[[redis.Redis], Any]) -> Any:
+    """執行 sorted set 操作；遇到舊格式的 key (WRONGTYPE) 時先轉換再重試"""
+    r = get_redis_connection()
+    try:
+        return fn(r)
+    except redis.ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        _migrate(r, key)
+        return fn(r)
+
+
+def append_message(session_id: str, search_id: int, role: str, content: str) -> Dict[str, Any]:
+    """新增訊息，ID 取自 messages_seq 計數器 (WATCH 確保多個 worker 同時新增時不會重複)
+
+    清空或刪除訊息後 ID 也不會重複使用，推送與 since_id 的客戶端不會漏掉新訊息。
+    """
+    key = message_key(session_id, search_id)
+    seq_key = sequence_key(session_id, search_id)
+
+    def op(r: redis.Redis) -> Dict[str, Any]:
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key, seq_key)
+                    message = {
+                        "id": _next_id(pipe, key, seq_key),
+                        "role": role,
+                        "content": content,
+                        "created_at": int(time.time()),
+                    }
+                    pipe.multi()
+                    pipe.zadd(key, {_encode(message): message["id"]})
+                    pipe.expire(key, SESSION_EXPIRE)
+                    pipe.set(seq_key, message["id"] + 1, ex=SESSION_EXPIRE)
+                    pipe.publish(message_channel(session_id, search_id), _event("created", message=message))
+                    pipe.execute()
+                    return message
+                except redis.WatchError:
+                    continue
+
+    return _run(key, op)
+
+
+def list_messages(
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    raw: bool = False
+) -> List[Any]:
+    """since_id 之後的訊息 (由舊到新)，limit 為只取最新的幾則
+
+    raw 為 True 時返回 sorted set 中的 JSON 字串，不解析 (直接輸出為回應時使用)
+    """
+    key = message_key(session_id, search_id)
+    low = f"({since_id}" if since_id is not None else "-inf"
+    decode = (lambda members: members) if raw else _decode
+
+    def op(r: redis.Redis) -> List[Any]:
+        if limit and limit > 0:
+            return decode(r.zrevrangebyscore(key, "+inf", low, start=0, num=limit)[::-1])
+        return decode(r.zrangebyscore(key, low, "+inf"))
+
+    return _run(key, op)
+
+
+def get_message(session_id: str, search_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+    key = message_key(session_id, search_id)
+    members = _run(key, lambda r: r.zrangebyscore(key, message_id, message_id))
+    return json.loads(members[0]) if members else None
+
+
+def page_messages(
+    session_id: str,
+    search_id: int,
+    page_size: int,
+    before_id: Optional[int] = None
+) -> Tuple[List[Dict[str, Any]], bool, int]:
+    """由新到舊分頁：取 before_id 之前最新的 page_size 則訊息
+
+    Returns:
+        (訊息列表 (由舊到新), 是否還有更早的訊息, 訊息總數)
+    """
+    key = message_key(session_id, search_id)
+    high = f"({before_id}" if before_id is not None else "+inf"
+
+    def op(r: redis.Redis) -> Tuple[List[Dict[str, Any]], bool, int]:
+        with r.pipeline(transaction=False) as pipe:
+            pipe.zrevrangebyscore(key, high, "-inf", start=0, num=page_size + 1)
+            pipe.zcard(key)
+            members, total = pipe.execute()
+        has_more = len(members) > page_size
+        return _decode(members[:page_size][::-1]), has_more, total
+
+    return _run(key, op)
+
+
+def update_message_content(session_id: str, search_id: int, message_id: int, content: str) -> bool:
+    """更新訊息內容 (以同一個 score 換掉 member)"""
+    key = message_key(session_id, search_id)
+
+    def op(r: redis.Redis) -> bool:
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    members = pipe.zrangebyscore(key, message_id, message_id)
+                    if not members:
+                        pipe.unwatch()
+                        return False
+                    message = json.loads(members[0])
+                    message["content"] = content
+                    pipe.multi()
+                    pipe.zremrangebyscore(key, message_id, message_id)
+                    pipe.zadd(key, {_encode(message): message_id})
+                    pipe.expire(key, SESSION_EXPIRE)
+                    pipe.publish(message_channel(session_id, search_id), _event("updated", message=message))
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    return _run(key, op)
+
+
+def delete_message_by_id(session_id: str, search_id: int, message_id: int) -> bool:
+    key = message_key(session_id, search_id)
+    deleted = _run(key, lambda r: r.zremrangebyscore(key, message_id, message_id) > 0)
+    if deleted:
+        get_redis_connection().publish(message_channel(session_id, search_id), _event("deleted", id=message_id))
+    return deleted
+
+
+def clear_messages(session_id: str, search_id: int) -> None:
+    """刪除所有訊息；ID 計數器保留，之後的訊息 ID 接續增加"""
+    key = message_key(session_id, search_id)
+
+    def op(r: redis.Redis) -> None:
+        with r.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.publish(message_channel(session_id, search_id), _event("cleared"))
+            pipe.execute()
+
+    _run(key, op)
+
+
+def delete_session_messages(session_id: str) -> None:
+    """刪除會話下所有訊息與 ID 計數器"""
+    r = get_redis_connection()
+    for pattern in (f"messages:{session_id}-*", f"messages_seq:{session_id}-*"):
+        keys = list(r.scan_iter(match=pattern, count=1000))
+        if keys:
+            r.delete(*keys)
+
+
+def _validate_operation(op: Any) -> Optional[str]:
+    """批次操作的格式檢查，返回錯誤訊息 (格式正確時為 None)"""
+    if not isinstance(op, dict):
+        return "操作必須是物件"
+    kind = op.get("op")
+    if kind not in ("create", "update", "delete"):
+        return f"不支援的操作: {kind}"
+    if not isinstance(op.get("search_id"), int):
+        return "缺少 search_id"
+    if kind in ("update", "delete") and not isinstance(op.get("id"), int):
+        return "缺少訊息 id"
+    if kind in ("create", "update") and not isinstance(op.get("content"), str):
+        return "缺少 content"
+    return None
+
+
+def _failed(index: int, op: Any, error: str) -> Dict[str, Any]:
+    return {"index": index, "op": op.get("op") if isinstance(op, dict) else None, "success": False, "error": error}
+
+
+def apply_message_batch(session_id: str, operations: List[Any]) -> List[Dict[str, Any]]:
+    """在同一個 transaction 中新增、更新、刪除多則訊息 (可跨 search_id)
+
+    operations 的每一項為
+    {"op": "create", "search_id": int, "role": str, "content": str}、
+    {"op": "update", "search_id": int, "id": int, "content": str} 或
+    {"op": "delete", "search_id": int, "id": int}，依序套用 (後面的操作看得到前面的結果)。
+    WATCH 所有相關的 key，其他請求同時修改時整批重算，不會只寫入一部分。
+
+    Returns:
+        與 operations 同順序的結果：{"index", "op", "success", "message" 或 "error"}
+    """
+    errors = [_validate_operation(op) for op in operations]
+    search_ids = sorted({op["search_id"] for op, error in zip(operations, errors) if error is None})
+    keys = {search_id: message_key(session_id, search_id) for search_id in search_ids}
+    seq_keys = {search_id: sequence_key(session_id, search_id) for search_id in search_ids}
+    r = get_redis_connection()
+    for key in keys.values():
+        _migrate(r, key)
+    if not keys:
+        return [_failed(i, op, error) for i, (op, error) in enumerate(zip(operations, errors))]
+
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*keys.values(), *seq_keys.values())
+                # 每個 search_id 的下一個訊息 ID，以及被更新、刪除的訊息目前的內容
+                next_ids = {search_id: _next_id(pipe, key, seq_keys[search_id]) for search_id, key in keys.items()}
+                first_ids = dict(next_ids)
+                current: Dict[int, Dict[int, Optional[Dict[str, Any]]]] = {search_id: {} for search_id in search_ids}
+                for op, error in zip(operations, errors):
+                    if error is None and op["op"] != "create" and op["id"] not in current[op["search_id"]]:
+                        members = pipe.zrangebyscore(keys[op["search_id"]], op["id"], op["id"])
+                        current[op["search_id"]][op["id"]] = json.loads(members[0]) if members else None
+
+                results = []
+                changed: Dict[int, Dict[int, Optional[Dict[str, Any]]]] = {search_id: {} for search_id in search_ids}
+                events: List[Tuple[int, str]] = []
+                now = int(time.time())
+                for i, (op, error) in enumerate(zip(operations, errors)):
+                    if error is not None:
+                        results.append(_failed(i, op, error))
+                        continue
+                    kind, search_id = op["op"], op["search_id"]
+                    messages = current[search_id]
+                    if kind == "create":
+                        message = {
+                            "id": next_ids[search_id],
+                            "role": op.get("role"),
+                            "content": op["content"],
+                            "created_at": now,
+                        }
+                        next_ids[search_id] += 1
+                        messages[message["id"]] = changed[search_id][message["id"]] = message
+                        events.append((search_id, _event("created", message=message)))
+                        results.append({"index": i, "op": kind, "success": True, "message": message})
+                        continue
+                    message = messages.get(op["id"])
+                    if message is None:
+                        results.append(_failed(i, op, "訊息不存在"))
+                    elif kind == "update":
+                        message = dict(message, content=op["content"])
+                        messages[op["id"]] = changed[search_id][op["id"]] = message
+                        events.append((search_id, _event("updated", message=message)))
+                        results.append({"index": i, "op": kind, "success": True, "message": message})
+                    else:
+                        messages[op["id"]] = changed[search_id][op["id"]] = None
+                        events.append((search_id, _event("deleted", id=op["id"])))
+                        results.append({"index": i, "op": kind, "success": True})
+
+                pipe.multi()
+                for search_id, messages in changed.items():
+                    if not messages:
+                        continue
+                    key = keys[search_id]
+                    for message_id, message in messages.items():
+                        pipe.zremrangebyscore(key, message_id, message_id)
+                        if message is not None:
+                            pipe.zadd(key, {_encode(message): message_id})
+                    pipe.expire(key, SESSION_EXPIRE)
+                for search_id, next_id in next_ids.items():
+                    if next_id != first_ids[search_id]:
+                        pipe.set(seq_keys[search_id], next_id, ex=SESSION_EXPIRE)
+                for search_id, event in events:
+                    pipe.publish(message_channel(session_id, search_id), event)
+                pipe.execute()
+                return results
+            except redis.WatchError:
+                continue
+
+
+@asynccontextmanager
+async def _subscription(session_id: str, search_id: int):
+    r = get_async_redis_connection()
+    pubsub = r.pubsub()
+    await pubsub.subscribe(message_channel(session_id, search_id))
+    try:
+        yield pubsub
+    finally:
+        try:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+            await r.aclose()
+        except Exception as e:
+            logger.debug(f"關閉訊息訂閱時出錯: {str(e)}")
+
+
+async def _next_event(pubsub, timeout: float) -> Optional[Dict[str, Any]]:
+    """等待下一個訊息事件，timeout 秒內沒有事件時返回 None"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+        message = await pubsub.get_message(timeout=remaining)
+        if message is not None and message.get("type") == "message":
+            return json.loads(message["data"])
+        if remaining <= 0:
+            return None
+
+
+async def _backlog(session_id: str, search_id: int, since_id: Optional[int]) -> List[Dict[str, Any]]:
+    """訂閱前已存在、since_id 之後的訊息 (以 created 事件表示)"""
+    if since_id is None:
+        return []
+    messages = await run_in_threadpool(list_messages, session_id, search_id, since_id)
+    return [{"type": "created", "message": message} for message in messages]
+
+
+def _is_replayed(event: Dict[str, Any], last_id: Optional[int]) -> bool:
+    # 訂閱後、補送前新增的訊息會同時出現在補送與事件中 (訊息 ID 只增不減)
+    message = event.get("message") or {}
+    return event.get("type") == "created" and last_id is not None and message.get("id", -1) <= last_id
+
+
+async def message_events(
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int] = None,
+    heartbeat: float = MESSAGE_STREAM_HEARTBEAT
+) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """訂閱訊息事件 (跨 worker，Redis pub/sub)
+
+    先訂閱再補送 since_id 之後的訊息，兩者之間新增的訊息不會遺漏；
+    等待事件時不佔用 threadpool，每 heartbeat 秒沒有事件時產生 None (keepalive)。
+    """
+    async with _subscription(session_id, search_id) as pubsub:
+        last_id = since_id
+        for event in await _backlog(session_id, search_id, since_id):
+            last_id = event["message"]["id"]
+            yield event
+        while True:
+            event = await _next_event(pubsub, heartbeat)
+            if event is None:
+                yield None
+                continue
+            if event.get("type") == "cleared":
+                # 保險起見：清空之後不再以舊的 ID 判斷重複
+                last_id = None
+            if not _is_replayed(event, last_id):
+                yield event
+
+
+async def poll_message_events(
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int],
+    timeout: float
+) -> List[Dict[str, Any]]:
+    """long-poll：已有 since_id 之後的訊息時立即返回，否則最多等待 timeout 秒"""
+    async with _subscription(session_id, search_id) as pubsub:
+        events = await _backlog(session_id, search_id, since_id)
+        if events:
+            return events
+        event = await _next_event(pubsub, timeout)
+        while event is not None:
+            if event.get("type") == "cleared":
+                since_id = None
+            if not _is_replayed(event, since_id):
+                events.append(event)
+            # 同時發生的事件一起返回
+            event = await _next_event(pubsub, 0)
+        return events
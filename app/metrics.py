@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import threading
+import contextvars
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+
+from .utils import logger
+from .settings import METRICS_ENABLED, METRICS_FLUSH_INTERVAL, METRICS_WORKER_TTL
+
+# 延遲 (秒) 的 histogram 邊界
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Redis 單一指令通常在毫秒以下
+FAST_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# payload 大小 (bytes)：1KB ~ 256MB
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+# 資料列數
+ROW_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+# 名稱 -> (類型, 說明, histogram 邊界)
+METRIC_DEFINITIONS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "http_request_duration_seconds": ("histogram", "HTTP 請求處理時間 (依路由)", LATENCY_BUCKETS),
+    "redis_helper_duration_seconds": ("histogram", "app/redis.py helper 的執行時間", FAST_LATENCY_BUCKETS),
+    "redis_helper_errors_total": ("counter", "app/redis.py helper 的錯誤次數", ()),
+    "redis_payload_bytes": ("histogram", "sheet:* key 的 payload 大小", SIZE_BUCKETS),
+    "sheet_fetch_duration_seconds": ("histogram", "SheetConnector.get_data 的執行時間", LATENCY_BUCKETS),
+    "sheet_fetch_rows": ("histogram", "SheetConnector.get_data 取得的資料列數", ROW_BUCKETS),
+    "sheet_fetch_errors_total": ("counter", "SheetConnector.get_data 的錯誤次數", ()),
+    "sheet_cache_requests_total": ("counter", "SheetManager getter 的緩存命中 (hit / miss / refresh)", ()),
+    "shared_cache_requests_total": ("counter", "sheet:* 本地快取的命中 (hit / validated / miss)", ()),
+    "session_lock_wait_seconds": ("histogram", "取得 session 鎖 (本地 + Redis) 的等待時間", FAST_LATENCY_BUCKETS),
+    "kol_filter_stage_duration_seconds": ("histogram", "KOL 資料篩選各階段的執行時間", LATENCY_BUCKETS),
+    "llm_request_duration_seconds": ("histogram", "LLM 呼叫時間", LATENCY_BUCKETS),
+    "llm_tokens_total": ("counter", "LLM 使用的 token 數 (input / output)", ()),
+    "llm_errors_total": ("counter", "LLM 呼叫的錯誤次數", ()),
+}
+
+_WORKER_KEY_PREFIX = "metrics:worker:"
+
+# 目前請求各階段的累計時間 (秒)，由 ServerTimingMiddleware 設定；未啟用時為 None
+_request_timing: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_timing", default=None
+)
+# 由 app/redis.py helper 以更細的粒度記錄的階段，StageTimer 不重複寫入 Server-Timing
+_HELPER_STAGES = {"redis_fetch", "redis_write"}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class MetricsRegistry:
+    """worker 內的指標 (counter 與 histogram)
+
+    每個 worker 只累計自己的數值，定期把快照寫入 Redis
+    (metrics:worker:{hostname}:{pid})，/metrics 被抓取時合併所有 worker 的快照，
+    因此多個 uvicorn worker 時數字仍然正確。worker 結束後其快照在
+    METRICS_WORKER_TTL 秒後過期，對 Prometheus 而言等同 counter 重置。
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, LabelKey], float] = {}
+        # (name, labels) -> [每個邊界的計數..., +Inf 計數, sum]
+        self._histograms: Dict[Tuple[str, LabelKey], List[float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """增加 counter"""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """記錄一筆 histogram 觀測值"""
+        if not self.enabled:
+            return
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = (name, _label_key(labels))
+        index = bisect_left(buckets, value)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """目前 worker 的數值 (可 JSON 序列化)"""
+        with self._lock:
+            return {
+                "counters": [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, dict(labels), list(series)] for (name, labels), series in self._histograms.items()],
+            }
+
+    def flush(self) -> None:
+        """把目前 worker 的快照寫入 Redis"""
+        if not self.enabled:
+            return
+        # 直接使用連線，避免 redis helper 的指標記錄到自己
+        from .redis import get_redis_connection
+        try:
+            get_redis_connection().set(
+                f"{_WORKER_KEY_PREFIX}{self.worker_id}",
+                json.dumps(self.snapshot(), ensure_ascii=False),
+                ex=METRICS_WORKER_TTL
+            )
+        except Exception as e:
+            logger.warning(f"寫入指標快照失敗: {str(e)}")
+
+    def collect(self) -> Tuple[List[Dict[str, Any]], int]:
+        """取得所有 worker 的快照
+
+        Returns:
+            (快照列表, worker 數)；Redis 不可用時只返回本 worker
+        """
+        self.flush()
+        from .redis import get_redis_connection
+        try:
+            r = get_redis_connection()
+            keys = list(r.scan_iter(f"{_WORKER_KEY_PREFIX}*"))
+            raw_values = r.mget(keys) if keys else []
+            snapshots = [json.loads(raw) for raw in raw_values if raw]
+            if snapshots:
+                return snapshots, len(snapshots)
+        except Exception as e:
+            logger.warning(f"讀取其他 worker 的指標失敗，只輸出本 worker: {str(e)}")
+        return [self.snapshot()], 1
+
+    def render(self) -> str:
+        """以 Prometheus text format 輸出所有 worker 合併後的指標"""
+        snapshots, worker_count = self.collect()
+
+        counters: Dict[Tuple[str, LabelKey], float] = {}
+        histograms: Dict[Tuple[str, LabelKey], List[float]] = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot.get("counters", []):
+                key = (name, _label_key(labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, series in snapshot.get("histograms", []):
+                if name not in METRIC_DEFINITIONS or len(series) != len(METRIC_DEFINITIONS[name][2]) + 2:
+                    # 舊版本 worker 的邊界不同，無法合併
+                    continue
+                key = (name, _label_key(labels))
+                merged = histograms.setdefault(key, [0] * len(series))
+                for i, v in enumerate(series):
+                    merged[i] += v
+
+        lines = [
+            "# HELP metrics_workers 回報指標的 worker 數",
+            "# TYPE metrics_workers gauge",
+            f"metrics_workers {worker_count}",
+        ]
+        for name, (metric_type, help_text, buckets) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for (n, labels), series in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, series):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {int(cumulative)}")
+                cumulative += series[len(buckets)]
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {int(cumulative)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(series[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {int(cumulative)}")
+        return "\n".join(lines) + "\n"
+
+    async def flush_periodically(self, interval: float = METRICS_FLUSH_INTERVAL) -> None:
+        """背景工作：定期寫入快照，讓其他 worker 抓取時看得到本 worker"""
+        from starlette.concurrency import run_in_threadpool
+        while True:
+            await asyncio.sleep(interval)
+            await run_in_threadpool(self.flush)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def add_timing(stage: str, seconds: float) -> None:
+    """把一段時間累加到目前請求的 Server-Timing (未啟用時不做任何事)"""
+    timing = _request_timing.get()
+    if timing is not None:
+        timing[stage] = timing.get(stage, 0.0) + seconds
+
+
+class StageTimer:
+    """記錄一個請求內各處理階段的時間
+
+    每次呼叫 lap(stage) 記錄距離上一次 lap (或建立時) 經過的時間，
+    同名階段會累加，並寫入 kol_filter_stage_duration_seconds 與 Server-Timing。
+    """
+
+    def __init__(self, endpoint: str, registry: Optional[MetricsRegistry] = None):
+        self.endpoint = endpoint
+        self.registry = registry or metrics
+        self.stages: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> float:
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+        self.registry.observe("kol_filter_stage_duration_seconds", elapsed, endpoint=self.endpoint, stage=stage)
+        if stage not in _HELPER_STAGES:
+            add_timing(stage, elapsed)
+        return elapsed
+
+    def skip(self) -> None:
+        """重設起點，不計入任何階段"""
+        self._last = time.perf_counter()
+
+
+class MetricsMiddleware:
+    """記錄每個請求的處理時間 (以路由樣板分組，避免 session_id 等參數造成標籤爆量)"""
+
+    def __init__(self, app, registry: Optional[MetricsRegistry] = None):
+        self.app = app
+        self.registry = registry or metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            self.registry.observe(
+                "http_request_duration_seconds",
+                time.perf_counter() - start,
+                method=scope.get("method", ""),
+                route=getattr(route, "path", "unmatched"),
+                status=status["code"],
+            )
+
+
+class ServerTimingMiddleware:
+    """在回應加上 Server-Timing header，列出各階段的時間 (瀏覽器 devtools 可直接查看)
+
+    各階段由 add_timing / StageTimer 記錄；header 在回應開始時送出，
+    之後 (例如串流途中) 的時間不會包含在內。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing: Dict[str, float] = {}
+        token = _request_timing.set(timing)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timing.items()]
+                entries.append(f"total;dur={(time.perf_counter() - start) * 1000:.1f}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(entries).encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_timing.reset(token)
+
+
+# 全局指標 registry
+metrics = MetricsRegistry()
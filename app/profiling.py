@@ -0,0 +1,214 @@
+import io
+import os
+import time
+import uuid
+import json
+import base64
+import random
+import pstats
+import marshal
+import cProfile
+import threading
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+from .redis import get_redis_connection
+from .utils import logger
+from .settings import (
+    PROFILING_ENABLED,
+    PROFILING_SAMPLE_RATE,
+    PROFILING_TOKEN,
+    PROFILING_MAX_PROFILES,
+    PROFILING_TTL,
+)
+
+# 要求分析的 header，值必須等於 ST_LLM_PROFILING_TOKEN
+PROFILE_HEADER = "x-profile"
+PROFILE_INDEX_KEY = "profile:index"
+# 文字摘要列出的函數數
+_SUMMARY_LIMIT = 60
+
+router = APIRouter(prefix="/profiles", tags=["profiling"])
+
+
+class ProfilingMiddleware:
+    """以 cProfile 分析被選中的請求，結果存入 Redis
+
+    只有 ST_LLM_PROFILING_ENABLED=true 時才會加入 app，關閉時完全沒有額外開銷。
+    請求帶有 X-Profile: <ST_LLM_PROFILING_TOKEN> 時一定分析，其他請求依
+    ST_LLM_PROFILING_SAMPLE_RATE 抽樣。cProfile 同一時間只能有一個，分析中的
+    其他請求直接略過；丟到 threadpool 的工作 (例如 LLM 呼叫) 不在分析範圍內。
+
+    限制：cProfile 分析的是整個 event loop thread，被分析的請求 await 時，同時執行的
+    其他請求在 event loop 上的時間也會算進這份 profile。meta 的 overlapping_requests
+    記錄分析期間同時執行的其他請求數，不為 0 時結果只能當作參考，
+    需要準確的結果時請在沒有其他流量時以 X-Profile header 分析。
+    """
+
+    def __init__(self, app, sample_rate: float = PROFILING_SAMPLE_RATE, token: str = PROFILING_TOKEN):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.token = token
+        self._active = threading.Lock()
+        # 執行中的請求數與累計開始的請求數 (只在 event loop 上修改)
+        self._inflight = 0
+        self._started = 0
+
+    def _reason(self, scope) -> Optional[str]:
+        if self.token:
+            for name, value in scope.get("headers", []):
+                if name == PROFILE_HEADER.encode() and value.decode("latin-1") == self.token:
+                    return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path", "").startswith("/api/profiles"):
+            await self.app(scope, receive, send)
+            return
+
+        self._inflight += 1
+        self._started += 1
+        try:
+            reason = self._reason(scope)
+            if reason is None or not self._active.acquire(blocking=False):
+                await self.app(scope, receive, send)
+                return
+            await self._profile(scope, receive, send, reason)
+        finally:
+            self._inflight -= 1
+
+    async def _profile(self, scope, receive, send, reason: str) -> None:
+        profile_id = uuid.uuid4().hex[:16]
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler = cProfile.Profile()
+        # 分析開始時已在執行的其他請求，與分析期間開始的請求
+        others = self._inflight - 1
+        started = self._started
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.disable()
+        finally:
+            self._active.release()
+            duration = time.perf_counter() - start
+            route = scope.get("route")
+            meta = {
+                "id": profile_id,
+                "method": scope.get("method", ""),
+                "path": scope.get("path", ""),
+                "route": getattr(route, "path", ""),
+                "status": status["code"],
+                "duration_ms": round(duration * 1000, 3),
+                "reason": reason,
+                "overlapping_requests": others + self._started - started,
+                "pid": os.getpid(),
+                "created_at": time.time(),
+            }
+            # 整理 pstats 與寫入 Redis 不在 event loop 上執行
+            await run_in_threadpool(save_profile, meta, profiler)
+
+
+def save_profile(meta: Dict[str, Any], profiler: cProfile.Profile) -> None:
+    """把 profile (pstats 格式) 與文字摘要存入 Redis，只保留最近的 PROFILING_MAX_PROFILES 筆"""
+    try:
+        profiler.create_stats()
+        raw = marshal.dumps(profiler.stats)
+        stream = io.StringIO()
+        if meta.get("overlapping_requests"):
+            stream.write(
+                f"注意：分析期間有 {meta['overlapping_requests']} 個其他請求同時執行，"
+                f"它們在 event loop 上的時間也包含在這份 profile 中\n\n"
+            )
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(_SUMMARY_LIMIT)
+
+        profile_id = meta["id"]
+        r = get_redis_connection()
+        pipe = r.pipeline()
+        pipe.set(f"profile:meta:{profile_id}", json.dumps(meta, ensure_ascii=False), ex=PROFILING_TTL)
+        pipe.set(f"profile:text:{profile_id}", stream.getvalue(), ex=PROFILING_TTL)
+        # 連線使用 decode_responses，二進位資料以 base64 保存
+        pipe.set(f"profile:data:{profile_id}", base64.b64encode(raw).decode("ascii"), ex=PROFILING_TTL)
+        pipe.zadd(PROFILE_INDEX_KEY, {profile_id: meta["created_at"]})
+        pipe.zremrangebyscore(PROFILE_INDEX_KEY, "-inf", meta["created_at"] - PROFILING_TTL)
+        pipe.zremrangebyrank(PROFILE_INDEX_KEY, 0, -PROFILING_MAX_PROFILES - 1)
+        pipe.execute()
+        logger.info(f"已保存請求分析 {profile_id}: {meta['method']} {meta['path']} {meta['duration_ms']}ms ({meta['reason']})")
+    except Exception as e:
+        logger.error(f"保存請求分析時出錯: {str(e)}")
+
+
+def list_profiles(limit: int = PROFILING_MAX_PROFILES) -> List[Dict[str, Any]]:
+    """最近的 profile (新的在前)"""
+    r = get_redis_connection()
+    ids = r.zrevrange(PROFILE_INDEX_KEY, 0, limit - 1)
+    if not ids:
+        return []
+    raw_meta = r.mget([f"profile:meta:{profile_id}" for profile_id in ids])
+    return [json.loads(raw) for raw in raw_meta if raw]
+
+
+def _check_token(token: Optional[str]) -> None:
+    if PROFILING_TOKEN and token != PROFILING_TOKEN:
+        raise HTTPException(status_code=403, detail="需要有效的 X-Profile header")
+
+
+@router.get("")
+async def api_list_profiles(limit: int = 50, x_profile: Optional[str] = Header(None)):
+    """列出最近的請求分析"""
+    _check_token(x_profile)
+    return {"profiles": list_profiles(limit)}
+
+
+@router.get("/{profile_id}")
+async def api_get_profile(profile_id: str, format: str = "text", x_profile: Optional[str] = Header(None)):
+    """取得請求分析
+
+    Args:
+        profile_id: profile ID (回應 header X-Profile-Id)
+        format: text 為依累計時間排序的文字摘要；pstats 為可用
+            `python -m pstats` 或 snakeviz 開啟的原始檔
+    """
+    _check_token(x_profile)
+    r = get_redis_connection()
+    if format == "pstats":
+        data = r.get(f"profile:data:{profile_id}")
+        if data is None:
+            raise HTTPException(status_code=404, detail="找不到 profile")
+        return Response(
+            base64.b64decode(data),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'}
+        )
+
+    text = r.get(f"profile:text:{profile_id}")
+    if text is None:
+        raise HTTPException(status_code=404, detail="找不到 profile")
+    return PlainTextResponse(text)
+
+
+def install(app) -> bool:
+    """ST_LLM_PROFILING_ENABLED=true 時加入 middleware 與查詢 API"""
+    if not PROFILING_ENABLED:
+        return False
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router, prefix="/api")
+    if not PROFILING_TOKEN:
+        logger.warning("已啟用請求分析但未設定 ST_LLM_PROFILING_TOKEN，分析結果任何人都可讀取")
+    logger.info(f"已啟用請求分析，抽樣率 {PROFILING_SAMPLE_RATE}")
+    return True
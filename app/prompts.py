@@ -0,0 +1,169 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .utils import logger
+from .settings import PROMPT_DIR, PROMPT_RELOAD_INTERVAL
+
+# 預設 prompt 模板名稱 (對應 PROMPT_DIR/prompt.txt)
+DEFAULT_PROMPT_NAME = "prompt"
+
+# 模板變數格式：{{ variable }}
+_VARIABLE_PATTERN = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+
+class PromptTemplate:
+    """已載入並預先編譯的 prompt 模板"""
+
+    def __init__(self, name: str, path: str, text: str, mtime: float, size: int):
+        self.name = name
+        self.path = path
+        self.text = text
+        self.mtime = mtime
+        self.size = size
+        self.digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.version = f"{name}@{self.digest[:12]}"
+        self.loaded_at = time.time()
+
+        # 預先把模板拆成 (文字, 變數名稱) 片段，render 時只需串接
+        self._parts: List[Tuple[str, Optional[str]]] = []
+        last = 0
+        for match in _VARIABLE_PATTERN.finditer(text):
+            self._parts.append((text[last:match.start()], match.group(1)))
+            last = match.end()
+        self._parts.append((text[last:], None))
+        self.variables = sorted({var for _, var in self._parts if var})
+
+    def render(self, **variables) -> str:
+        """以變數填入模板，未提供的變數保留原樣"""
+        if not self.variables:
+            return self.text
+
+        chunks = []
+        for literal, var in self._parts:
+            chunks.append(literal)
+            if var is None:
+                continue
+            if var in variables:
+                chunks.append(str(variables[var]))
+            else:
+                chunks.append("{{" + var + "}}")
+        return "".join(chunks)
+
+
+class PromptRegistry:
+    """Prompt 模板註冊表
+
+    模板只在第一次使用時讀取，之後最多每 reload_interval 秒檢查一次檔案的
+    mtime / 大小，有變動才重新讀取；內容 hash 沒變則沿用原本的版本。
+    """
+
+    def __init__(self, base_dir: str = PROMPT_DIR, reload_interval: float = PROMPT_RELOAD_INTERVAL):
+        self.base_dir = base_dir
+        self.reload_interval = reload_interval
+        self._paths: Dict[str, str] = {}
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: str) -> None:
+        """註冊具名模板 (相對路徑以 base_dir 為基準)"""
+        if not os.path.isabs(path):
+            path = os.path.join(self.base_dir, path)
+        path = os.path.realpath(path)
+        with self._lock:
+            self._paths[name] = path
+            self._templates.pop(name, None)
+            self._checked_at.pop(name, None)
+
+    def _resolve_path(self, name: str) -> str:
+        path = self._paths.get(name)
+        if path is None:
+            path = os.path.realpath(os.path.join(self.base_dir, f"{name}.txt"))
+            self._paths[name] = path
+        return path
+
+    def get(self, name: str = DEFAULT_PROMPT_NAME) -> Optional[PromptTemplate]:
+        """取得模板，必要時重新載入
+
+        Returns:
+            PromptTemplate，如果檔案不存在或讀取失敗則返回最後一次成功載入的版本 (或 None)
+        """
+        now = time.monotonic()
+        template = self._templates.get(name)
+        if template is not None and now - self._checked_at.get(name, 0) < self.reload_interval:
+            return template
+
+        with self._lock:
+            template = self._templates.get(name)
+            if template is not None and now - self._checked_at.get(name, 0) < self.reload_interval:
+                return template
+
+            path = self._resolve_path(name)
+            self._checked_at[name] = now
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                logger.warning(f"Prompt 文件不存在: {path}")
+                return template
+            except OSError as e:
+                logger.error(f"讀取 prompt 文件失敗: {str(e)}")
+                return template
+
+            if template is not None and template.mtime == stat.st_mtime and template.size == stat.st_size:
+                return template
+
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read().strip()
+            except Exception as e:
+                logger.error(f"讀取 prompt 文件失敗: {str(e)}")
+                return template
+
+            new_template = PromptTemplate(name, path, text, stat.st_mtime, stat.st_size)
+            if template is not None and template.digest == new_template.digest:
+                # 只有 mtime 變動，內容相同，沿用舊版本
+                template.mtime = stat.st_mtime
+                template.size = stat.st_size
+                return template
+
+            self._templates[name] = new_template
+            if template is None:
+                logger.info(f"載入 prompt 模板 {new_template.version}")
+            else:
+                logger.info(f"重新載入 prompt 模板 {template.version} -> {new_template.version}")
+            return new_template
+
+    def get_by_path(self, path: str) -> Optional[PromptTemplate]:
+        """以檔案路徑取得模板 (檔名即模板名稱)"""
+        name = os.path.splitext(os.path.basename(path))[0]
+        resolved = os.path.realpath(path)
+        if self._paths.get(name) != resolved:
+            self.register(name, resolved)
+        return self.get(name)
+
+    def render(self, name: str = DEFAULT_PROMPT_NAME, /, **variables) -> Optional[str]:
+        """渲染具名模板"""
+        template = self.get(name)
+        if template is None:
+            return None
+        return template.render(**variables)
+
+    def version(self, name: str = DEFAULT_PROMPT_NAME) -> str:
+        """取得模板版本字串 (name@hash)，可用於 cache key 與日誌"""
+        template = self.get(name)
+        return template.version if template else ""
+
+    def list_templates(self) -> List[Dict[str, str]]:
+        """列出已載入的模板與版本"""
+        return [
+            {"name": t.name, "path": t.path, "version": t.version}
+            for t in self._templates.values()
+        ]
+
+
+# 全局 prompt 註冊表
+prompt_registry = PromptRegistry()
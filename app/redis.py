@@ -1,17 +1,23 @@
 import json
+import time
+import hashlib
 import redis
 from typing import Optional, Any
 from fastapi import APIRouter, Request, Query
-from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta, timezone
 
-from .utils import logger
-from .settings import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
+from .utils import logger, encode_cursor, decode_cursor
+from .responses import JSONResponse, RawJSONResponse, json_object
+from .metrics import metrics, StageTimer, add_timing
+from .settings import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, KOL_DATA_ROW_CONTENT_CHARS, KOL_SEARCH_TOP_K, KOL_DATA_MAX_PAGE_SIZE
 
 
 # Redis 連接池
 _redis_pool = None
+# asyncio 版連接池 (pub/sub 訂閱使用)
+_async_redis_pool = None
 _redis_process = None
 # 模擬 Redis 實例
 _fake_redis = None
@@ -24,12 +30,93 @@ router = APIRouter(tags=["redis"])
 @router.get("/kol-info")
 async def get_kol_info_endpoint():
     try:
-        kol_info = get_redis_key("sheet:kol_info", default=[])
-        return JSONResponse({"kol_info": kol_info})
+        from .shared_cache import shared_cache  # 使用延遲導入避免循環導入
+        # Redis 中的值已經是 JSON，直接嵌入回應
+        kol_info = shared_cache.get_raw("sheet:kol_info") or "[]"
+        return RawJSONResponse(json_object({"kol_info": kol_info}))
     except Exception as e:
         logger.error(f"獲取 KOL info 時出錯: {str(e)}")
         return JSONResponse({"error": str(e)}, status_code=500)
 
+def _filter_digest(*conditions: Any) -> str:
+    """篩選條件的摘要，用來確認 cursor 屬於同一個查詢"""
+    raw = json.dumps(conditions, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def kol_info_frame(kol_info: list) -> pd.DataFrame:
+    """kol_info 的 DataFrame，同一個 KOL 有多列 (多個 tag) 時只取一列，合併時貼文才不會重複"""
+    df_info = pd.DataFrame(kol_info)
+    if "kol_id" in df_info.columns:
+        df_info = df_info.drop_duplicates("kol_id")
+    return df_info
+
+
+def render_posts(kol_index, df_info: pd.DataFrame, rows: np.ndarray, scores: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """把索引的列位置組成輸出欄位 (與 kol_info 合併、時間格式化)，只處理給定的列"""
+    df_data = kol_index.df.iloc[rows]
+    if scores is not None:
+        df_data = df_data.assign(相關度=np.round(scores.astype(float), 4))
+
+    if not df_data.empty and not df_info.empty:
+        df = pd.merge(
+            df_data,
+            df_info,
+            on="kol_id",
+            how="left",
+            suffixes=("", "_info")
+        )
+    else:
+        # 索引的 DataFrame 由所有請求共用，不可直接修改
+        df = df_data.copy()
+
+    # timestamp 轉換
+    if "timestamp" in df.columns:
+        df["發文時間"] = pd.to_datetime(
+            df["timestamp"], unit="s", utc=True
+        ).dt.tz_convert('Asia/Taipei').dt.strftime("%Y-%m-%dT%H:%M:%S")
+    else:
+        df["發文時間"] = ""
+
+    # 欄位 rename
+    df["Id"] = df["doc_id"]
+    df["KOL"] = df["kol_name"].fillna(df["kol_id"])
+    df["連結"] = df["post_url"]
+    df["內容"] = df["content"]
+    df["互動數"] = df["reaction_count"]
+    df["分享數"] = df["share_count"]
+    return df
+
+
+def load_kol_data_rows(session_id: str, search_id: int) -> Optional[list]:
+    """取得 /kol-data 第一頁時保存的完整結果 (貼文列表)，供 LLM 依 token 預算挑選資料
+
+    /kol-data 只保存列位置與資料版本，這裡才由索引組成貼文；
+    沒有保存或資料已更新 (索引版本不同) 時返回 None。
+    """
+    saved = get_redis_key(f"kol_data_rows:{session_id}-{search_id}", default=None)
+    if not isinstance(saved, dict):
+        return None
+    from .kol_index import get_kol_index  # 使用延遲導入避免循環導入
+    from .shared_cache import shared_cache
+    kol_index = get_kol_index()
+    if kol_index is None or saved.get("v") != kol_index.version:
+        return None
+    rows = np.asarray(saved.get("rows") or [], dtype=np.int64)
+    if not len(rows):
+        return []
+    scores = np.asarray(saved["scores"], dtype=float) if saved.get("scores") is not None else None
+    df = render_posts(kol_index, kol_info_frame(shared_cache.get("sheet:kol_info", default=[]) or []), rows, scores)
+
+    row_columns = ["Id", "KOL", "連結", "內容", "互動數", "分享數", "發文時間", "timestamp"]
+    if scores is not None:
+        # 讓 LLM 上下文沿用相關度排序
+        row_columns.append("相關度")
+    rows_df = df[row_columns].copy()
+    rows_df["內容"] = rows_df["內容"].astype(str).str[:KOL_DATA_ROW_CONTENT_CHARS]
+    return rows_df.to_dict(orient="records")
+
+
 @router.post("/kol-data")
 async def get_filtered_kol_data(
     session_id: str = Query(..., description="必填：會話 ID"),
@@ -44,108 +131,103 @@ async def get_filtered_kol_data(
         tags = data.get("tags", [])
         time_type = data.get("time", "")
         n_days = int(data.get("n", 1) or 1)
-        # source = data.get("source", 0)  # 未來會實現的 source 篩選
-
-        # 獲取原始數據
-        kol_data = get_redis_key("sheet:kol_data", default=[])
-        kol_info = get_redis_key("sheet:kol_info", default=[])
+        query_text = str(data.get("query") or "").strip()
+        top_k = int(data.get("top_k", KOL_SEARCH_TOP_K) or 0)
+        source = int(data.get("source", 0) or 0)
+        # 分頁：帶 page_size 或 cursor 時每次只返回一頁
+        cursor = data.get("cursor")
+        paged = data.get("page_size") is not None or cursor is not None
+        page_size = min(max(int(data.get("page_size") or KOL_DATA_MAX_PAGE_SIZE), 1), KOL_DATA_MAX_PAGE_SIZE)
+        timer = StageTimer("kol_data")
+
+        # 獲取原始數據 (kol_data 使用本 worker 的索引，只在資料版本變動時重建)
+        from .kol_index import get_kol_index, time_window, SOURCE_FILTERS  # 使用延遲導入避免循環導入
+        from .shared_cache import shared_cache
+        # 資料版本變動時會重建索引 (大量資料需數秒)，在 threadpool 中執行，不阻塞 event loop
+        kol_index = await run_in_threadpool(get_kol_index)
+        kol_info = shared_cache.get("sheet:kol_info", default=[])
         if not kol_info:
             from .sheet import sheet_manager
             kol_info = sheet_manager.get_kol_info(force_refresh=True)
 
-        if not kol_data:
-            from .sheet import sheet_manager
-            kol_data = sheet_manager.get_kol_data(force_refresh=True)
+        timer.lap("redis_fetch")
 
         # 轉換為 DataFrame
-        df_data = pd.DataFrame(kol_data)
+        df_data = kol_index.df if kol_index is not None else pd.DataFrame()
         df_info = pd.DataFrame(kol_info)
+        df_info_unique = kol_info_frame(kol_info)
+        timer.lap("dataframe")
         
         if df_data.empty:
             return JSONResponse({"kol_data": []})
-            
-        # 1. 時間篩選
-        tz = timezone(timedelta(hours=8))
-        now = datetime.now(tz)
-        
-        if time_type == 0:
-            # 昨日 00:00:00 ~ 23:59:59 (台北)
-            y = now - timedelta(days=1)
-            y_start = y.replace(hour=0, minute=0, second=0, microsecond=0)
-            y_end = y.replace(hour=23, minute=59, second=59, microsecond=999999)
-            ts_start = int(y_start.timestamp())
-            ts_end = int(y_end.timestamp())
-            df_data = df_data[
-                (df_data["timestamp"] >= ts_start) &
-                (df_data["timestamp"] <= ts_end)
-            ]
-        elif time_type == 1:
-            # 今日 00:00:00 ~ 現在 (台北)
-            t_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            ts_start = int(t_start.timestamp())
-            ts_end = int(now.timestamp())
-            df_data = df_data[
-                (df_data["timestamp"] >= ts_start) &
-                (df_data["timestamp"] <= ts_end)
-            ]
-        elif time_type == 2:
-            # 近 n 日 (含今日)
-            n_start = (now - timedelta(days=n_days-1)).replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-            ts_start = int(n_start.timestamp())
-            ts_end = int(now.timestamp())
-            df_data = df_data[
-                (df_data["timestamp"] >= ts_start) &
-                (df_data["timestamp"] <= ts_end)
-            ]
-            
-        # 2. Source 篩選（預留，未來實現）
-        # if source == 1:
-        #     # 篩選 Facebook 來源
-        #     df_data = df_data[df_data["source"] == "facebook"]
-        # elif source == 2:
-        #     # 篩選 Threads 來源
-        #     df_data = df_data[df_data["source"] == "threads"]
-        # else:
-        #     # source == 0 或其他值，不篩選 source
-        #     pass
-            
+
+        # cursor 綁定資料版本與篩選條件，資料更新後舊的 cursor 失效
+        filter_key = _filter_digest(query_text, tags, source, time_type, n_days, top_k)
+        offset = 0
+        cursor_window = None
+        if cursor is not None:
+            payload = decode_cursor(cursor)
+            if payload is None or payload.get("f") != filter_key or not isinstance(payload.get("offset"), int):
+                return JSONResponse({"markdown": "", "error": "無效的 cursor"}, status_code=400)
+            if payload.get("v") != kol_index.version:
+                return JSONResponse({"markdown": "", "error": "資料已更新，請重新查詢"}, status_code=409)
+            offset = max(payload["offset"], 0)
+            cursor_window = payload.get("w")
+
+        # 0. 關鍵字篩選 (saved search 的 query，使用全文索引)
+        rows = kol_index.search(query_text) if query_text else None
+
+        # 1. 時間篩選 (後續頁沿用第一頁的時間區間)
+        window = tuple(cursor_window) if cursor_window else time_window(time_type, n_days)
+
+        # 2. Source 篩選 (0 或其他值不篩選)
+        source_name = SOURCE_FILTERS.get(source)
+
         # 3. Tag 篩選
+        kol_ids = None
         if tags and tags != ["All"]:
             # 如果不是選全部，需要根據 tag 找出對應的 kol_id 列表
             if not df_info.empty and "tag" in df_info.columns:
                 kol_ids_with_tags = df_info[df_info["tag"].isin(tags)]["kol_id"].unique().tolist()
                 if kol_ids_with_tags:
-                    df_data = df_data[df_data["kol_id"].isin(kol_ids_with_tags)]
-        
-        # 完成篩選後，再與 kol_info 合併
-        if not df_data.empty and not df_info.empty:
-            df = pd.merge(
-                df_data,
-                df_info,
-                on="kol_id",
-                how="left",
-                suffixes=("", "_info")
-            )
-        else:
-            df = df_data
-
-        # timestamp 轉換
-        if "timestamp" in df.columns:
-            df["發文時間"] = pd.to_datetime(
-                df["timestamp"], unit="s", utc=True
-            ).dt.tz_convert('Asia/Taipei').dt.strftime("%Y-%m-%dT%H:%M:%S")
-        else:
-            df["發文時間"] = ""
-
-        # 欄位 rename
-        df["Id"] = df["doc_id"]
-        df["KOL"] = df["kol_name"].fillna(df["kol_id"])
-        df["連結"] = df["post_url"]
-        df["內容"] = df["content"]
-        df["互動數"] = df["reaction_count"]
-        df["分享數"] = df["share_count"]
+                    kol_ids = kol_ids_with_tags
+
+        # 以索引組合所有條件 (時間用 searchsorted，source/tag 用預先分好的列位置)，不逐列比較
+        rows = kol_index.select(
+            rows=rows,
+            time_range=window[:2] if window else None,
+            source=source_name,
+            kol_ids=kol_ids,
+        )
+        timer.lap("filter")
+
+        # 4. 相關度排序 (有關鍵字或指定 top_k 時)
+        ranked = bool(query_text) or top_k > 0
+        scores = None
+        if ranked:
+            rows, scores = kol_index.rank(rows, query_text, top_k)
+            timer.lap("rank")
+
+        # 5. 分頁：總數直接來自索引；只組成這一頁的貼文，完整結果以列位置保存供 LLM 使用
+        total = len(rows)
+        first_page = offset == 0
+        next_cursor = None
+        page_rows, page_scores = rows, scores
+        if paged:
+            end = offset + page_size
+            if end < total:
+                next_cursor = encode_cursor({
+                    "v": kol_index.version,
+                    "f": filter_key,
+                    "w": list(window[:2]) if window else None,
+                    "offset": end,
+                })
+            page_rows = rows[offset:end]
+            page_scores = scores[offset:end] if scores is not None else None
+
+        # 完成篩選與分頁後，再與 kol_info 合併
+        df = render_posts(kol_index, df_info_unique, page_rows, page_scores)
+        timer.lap("merge")
 
         # 轉換為字典列表
         result = df[["Id", "KOL", "連結", "內容", "互動數", "分享數", "發文時間"]].to_dict(
@@ -177,30 +259,137 @@ async def get_filtered_kol_data(
             markdown_content = md_header + md_separator + "| 沒有資料 | | | | | | |"
         
         markdown_content += "\n```"
+        timer.lap("render")
+
+        response = {
+            # "kol_data": result,
+            "markdown": markdown_content,
+            "total": total,
+        }
+        if paged:
+            response["page_size"] = page_size
+            response["next_cursor"] = next_cursor
+        if not first_page:
+            # 之後的頁只返回資料，不重複寫入 Redis 與訊息
+            return JSONResponse(response)
         
         # 只儲存 Markdown 格式到 Redis
         kol_data_md_key = f"kol_data_md:{session_id}-{search_id}"
         set_redis_key(kol_data_md_key, markdown_content, expire=10*60)  # Markdown格式，10分鐘過期
+
+        # 完整結果只保存列位置與資料版本，LLM 需要時才由索引組成貼文 (load_kol_data_rows)
+        kol_data_rows_key = f"kol_data_rows:{session_id}-{search_id}"
+        set_redis_key(kol_data_rows_key, {
+            "v": kol_index.version,
+            "rows": rows.tolist(),
+            "scores": np.round(scores.astype(float), 4).tolist() if scores is not None else None,
+        }, expire=10*60)
         
         # 將 Markdown 添加到訊息中
         from .session import create_message
         
-        create_message(
+        # create_message 會等待 session 鎖，在 threadpool 中執行以免阻塞 event loop
+        await run_in_threadpool(
+            create_message,
             session_id=session_id,
             search_id=search_id,
             role="bot",
             content=markdown_content
         )
+        timer.lap("redis_write")
             
-        # 返回原始數據和 Markdown 格式
-        return JSONResponse({
-            # "kol_data": result,
-            "markdown": markdown_content
-        })
+        # 返回 Markdown 格式 (分頁時附上下一頁的 cursor)
+        return JSONResponse(response)
     except Exception as e:
         logger.error(f"KOL data 過濾/合併出錯: {str(e)}")
         return JSONResponse({"markdown": "", "error": str(e)}, status_code=500)
 
+@router.post("/kol-leaderboard")
+async def get_kol_leaderboard(
+    request: Request = None
+):
+    """依互動數、分享數或加權分數取得前 k 名貼文 (不經過 LLM)
+
+    body: {"tags": [str], "time": int, "n": int, "source": int,
+           "metric": "reaction" | "share" | "weighted", "k": int}
+    """
+    try:
+        if request is None:
+            return JSONResponse({"error": "無效的請求"}, status_code=400)
+
+        data = await request.json()
+        timer = StageTimer("kol_leaderboard")
+        from .leaderboard import get_leaderboard  # 使用延遲導入避免循環導入
+        try:
+            # 資料版本變動時會重建索引與排行榜，在 threadpool 中執行，不阻塞 event loop
+            result = await run_in_threadpool(
+                get_leaderboard,
+                tags=[tag for tag in data.get("tags", []) if tag != "All"],
+                time_type=data.get("time", ""),
+                n_days=int(data.get("n", 1) or 1),
+                source=int(data.get("source", 0) or 0),
+                metric=data.get("metric", "reaction"),
+                k=data.get("k"),
+            )
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        timer.lap("rank")
+        return JSONResponse(result)
+    except Exception as e:
+        logger.error(f"獲取 KOL 排行榜時出錯: {str(e)}")
+        return JSONResponse({"posts": [], "error": str(e)}, status_code=500)
+
+@router.post("/kol-aggregates")
+async def get_kol_aggregates(
+    request: Request = None
+):
+    """貼文數、互動數、分享數的彙總與每日趨勢 (使用每日彙總表，不掃描貼文)
+
+    body: {"tags": [str], "time": int, "n": int, "series": bool,
+           "group_by": "" | "tag" | "kol", "limit": int}
+    """
+    try:
+        if request is None:
+            return JSONResponse({"error": "無效的請求"}, status_code=400)
+
+        data = await request.json()
+        tags = [tag for tag in data.get("tags", []) if tag != "All"] or None
+        group_by = data.get("group_by") or ""
+        if group_by not in ("", "tag", "kol"):
+            return JSONResponse({"error": f"不支援的 group_by: {group_by}"}, status_code=400)
+        timer = StageTimer("kol_aggregates")
+
+        from .kol_index import time_window  # 使用延遲導入避免循環導入
+        from .rollups import get_rollups
+        from .shared_cache import shared_cache
+        window = time_window(data.get("time", ""), int(data.get("n", 1) or 1))
+        # 資料版本變動時會重建索引與彙總表，在 threadpool 中執行，不阻塞 event loop
+        rollups = await run_in_threadpool(get_rollups)
+        result = {
+            "start_datetime": window[2] if window else "",
+            "end_datetime": window[3] if window else "",
+            "totals": {"posts": 0, "reactions": 0, "shares": 0},
+        }
+        if rollups is None:
+            return JSONResponse(result)
+
+        result["totals"] = rollups.totals(window, tags)
+        if data.get("series", True):
+            result["series"] = rollups.series(window, tags)
+        if group_by == "tag":
+            result["groups"] = rollups.by_tag(window, tags)
+        elif group_by == "kol":
+            kol_ids = None
+            if tags:
+                kol_info = shared_cache.get("sheet:kol_info", default=[]) or []
+                kol_ids = [info.get("kol_id") for info in kol_info if info.get("tag") in tags]
+            result["groups"] = rollups.by_kol(window, kol_ids, int(data.get("limit", 50) or 50))
+        timer.lap("rollup")
+        return JSONResponse(result)
+    except Exception as e:
+        logger.error(f"獲取 KOL 彙總時出錯: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
 @router.post("/kol-data-count")
 async def get_filtered_kol_data_count(
     request: Request = None
@@ -214,76 +403,62 @@ async def get_filtered_kol_data_count(
         tags = data.get("tags", [])
         time_type = data.get("time", "")
         n_days = int(data.get("n", 1) or 1)
+        query_text = str(data.get("query") or "").strip()
+        source = int(data.get("source", 0) or 0)
+        timer = StageTimer("kol_data_count")
 
-        kol_data = get_redis_key("sheet:kol_data", default=[])
-        kol_info = get_redis_key("sheet:kol_info", default=[])
+        from .kol_index import get_kol_index, time_window, SOURCE_FILTERS  # 使用延遲導入避免循環導入
+        from .shared_cache import shared_cache
+        # 資料版本變動時會重建索引 (大量資料需數秒)，在 threadpool 中執行，不阻塞 event loop
+        kol_index = await run_in_threadpool(get_kol_index)
+        kol_info = shared_cache.get("sheet:kol_info", default=[])
 
         if not kol_info:
             from .sheet import sheet_manager
             kol_info = sheet_manager.get_kol_info(force_refresh=True)
 
-        if not kol_data:
-            from .sheet import sheet_manager
-            kol_data = sheet_manager.get_kol_data(force_refresh=True)
-
-        if not kol_data or not kol_info:
+        if kol_index is None or not len(kol_index) or not kol_info:
             return JSONResponse({
                 "count": 0,
                 "start_datetime": "",
                 "end_datetime": ""
             })
 
-        df_data = pd.DataFrame(kol_data)
-        df_info = pd.DataFrame(kol_info)
-
-        # merge kol_id
-        if not df_data.empty and not df_info.empty:
-            df = pd.merge(df_data, df_info, on="kol_id", how="left", suffixes=("", "_info"))
-        else:
-            df = df_data
+        timer.lap("redis_fetch")
 
         # 時間篩選
-        tz = timezone(timedelta(hours=8))
-        now = datetime.now(tz)
-        start_datetime = ""
-        end_datetime = ""
-        
-        if time_type == 0:
-            # 昨日 00:00:00 ~ 23:59:59 (台北)
-            y = now - timedelta(days=1)
-            y_start = y.replace(hour=0, minute=0, second=0, microsecond=0)
-            y_end = y.replace(hour=23, minute=59, second=59, microsecond=999999)
-            ts_start = int(y_start.timestamp())
-            ts_end = int(y_end.timestamp())
-            df = df[(df["timestamp"] >= ts_start) & (df["timestamp"] <= ts_end)]
-            start_datetime = y_start.strftime("%Y-%m-%d %H:%M:%S")
-            end_datetime = y_end.strftime("%Y-%m-%d %H:%M:%S")
-        elif time_type == 1:
-            # 今日 00:00:00 ~ 現在 (台北)
-            t_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            ts_start = int(t_start.timestamp())
-            ts_end = int(now.timestamp())
-            df = df[(df["timestamp"] >= ts_start) & (df["timestamp"] <= ts_end)]
-            start_datetime = t_start.strftime("%Y-%m-%d %H:%M:%S")
-            end_datetime = now.strftime("%Y-%m-%d %H:%M:%S")
-        elif time_type == 2:
-            # 近 n 日 (含今日)
-            n_start = (now - timedelta(days=n_days-1)).replace(
-                hour=0, minute=0, second=0, microsecond=0
+        window = time_window(time_type, n_days)
+        start_datetime, end_datetime = (window[2], window[3]) if window else ("", "")
+        source_name = SOURCE_FILTERS.get(source)
+        tag_filter = tags if tags and tags != ["All"] and any("tag" in info for info in kol_info) else None
+
+        rollups = None
+        if not query_text and source_name is None:
+            # 只有時間與 tag 條件：直接由每日彙總表的累加和算出，不需掃描貼文
+            from .rollups import get_rollups
+            rollups = await run_in_threadpool(get_rollups)
+        if rollups is not None:
+            count = rollups.totals(window, tag_filter)["posts"]
+            timer.lap("rollup")
+        else:
+            # 關鍵字篩選 (使用全文索引)
+            rows = kol_index.search(query_text) if query_text else None
+
+            # tags 過濾 (tag 在 kol_info，換算成 kol_id)
+            kol_ids = None
+            if tag_filter:
+                kol_ids = list({info.get("kol_id") for info in kol_info if info.get("tag") in tag_filter})
+
+            rows = kol_index.select(
+                rows=rows,
+                time_range=window[:2] if window else None,
+                source=source_name,
+                kol_ids=kol_ids,
             )
-            ts_start = int(n_start.timestamp())
-            ts_end = int(now.timestamp())
-            df = df[(df["timestamp"] >= ts_start) & (df["timestamp"] <= ts_end)]
-            start_datetime = n_start.strftime("%Y-%m-%d %H:%M:%S")
-            end_datetime = now.strftime("%Y-%m-%d %H:%M:%S")
-
-        # tags 過濾（假設 tag 欄位存在於 info）
-        if tags and tags != ["All"]:
-            if "tag" in df.columns:
-                df = df[df["tag"].isin(tags)]
 
-        # 返回數量
-        count = len(df)
+            # 返回數量
+            count = len(rows)
+            timer.lap("filter")
 
         return JSONResponse({
             "count": count,
@@ -315,6 +490,24 @@ def is_redis_running(host: str = REDIS_HOST, port: int = REDIS_PORT) -> bool:
         return False
 
 
+def use_fake_redis(server=None):
+    """改用 fakeredis (測試、壓測與 benchmark 使用)
+
+    Args:
+        server: 共用的 fakeredis.FakeServer，None 表示建立新的
+
+    Returns:
+        使用中的 FakeServer
+    """
+    global _fake_redis, _use_fake_redis
+    import fakeredis
+
+    _fake_redis = server if server is not None else fakeredis.FakeServer()
+    _use_fake_redis = True
+    logger.info("已切換為 fakeredis")
+    return _fake_redis
+
+
 def get_redis_connection() -> redis.Redis:
     """獲取 Redis 連接
 
@@ -346,6 +539,61 @@ def get_redis_connection() -> redis.Redis:
     return redis.Redis(connection_pool=_redis_pool)
 
 
+def get_async_redis_connection():
+    """獲取 asyncio 版 Redis 連接
+
+    用於需要長時間等待的操作 (例如 pub/sub 訂閱)，等待時不佔用 threadpool。
+
+    Returns:
+        redis.asyncio.Redis 連接物件
+    """
+    global _async_redis_pool
+
+    if _use_fake_redis:
+        import fakeredis.aioredis
+        return fakeredis.aioredis.FakeRedis(server=_fake_redis, decode_responses=True)
+
+    import redis.asyncio
+    if _async_redis_pool is None:
+        _async_redis_pool = redis.asyncio.ConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB,
+            password=REDIS_PASSWORD,
+            decode_responses=True
+        )
+    return redis.asyncio.Redis(connection_pool=_async_redis_pool)
+
+
+# 值等於 token 時才刪除 (只釋放自己持有的租約鎖)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def release_lock(r: redis.Redis, key: str, token: str) -> bool:
+    """原子地比對 token 並刪除鎖，租約過期後被其他持有者取得的鎖不會被刪除
+
+    Returns:
+        是否刪除 (False 表示鎖已過期或不屬於 token)
+    """
+    return bool(r.eval(_RELEASE_LOCK_SCRIPT, 1, key, token))
+
+
+async def async_release_lock(r, key: str, token: str) -> bool:
+    """release_lock 的 asyncio 版"""
+    return bool(await r.eval(_RELEASE_LOCK_SCRIPT, 1, key, token))
+
+
+def _record_payload(key: str, op: str, value: Any) -> None:
+    """記錄 sheet:* key 的 payload 大小 (JSON 以 ASCII 輸出，字元數即 bytes)"""
+    if key.startswith("sheet:") and isinstance(value, str):
+        metrics.observe("redis_payload_bytes", len(value), key=key, op=op)
+
+
 def set_redis_key(key: str, value: Any, expire: Optional[int] = None) -> bool:
     """設置 Redis 鍵值
 
@@ -357,18 +605,26 @@ def set_redis_key(key: str, value: Any, expire: Optional[int] = None) -> bool:
     Returns:
         是否成功設置
     """
+    start = time.perf_counter()
     try:
         r = get_redis_connection()
         # 將複雜數據結構轉為 JSON
         if not isinstance(value, (str, int, float, bool)):
             value = json.dumps(value)
+        encoded = time.perf_counter()
+        add_timing("json_encode", encoded - start)
         r.set(key, value)
         if expire is not None:
             r.expire(key, expire)
+        add_timing("redis_write", time.perf_counter() - encoded)
+        _record_payload(key, "set", value)
         return True
     except Exception as e:
+        metrics.inc("redis_helper_errors_total", helper="set_redis_key")
         logger.error(f"設置 Redis 鍵 {key} 時出錯: {str(e)}")
         return False
+    finally:
+        metrics.observe("redis_helper_duration_seconds", time.perf_counter() - start, helper="set_redis_key")
 
 
 def get_redis_key(key: str, default: Any = None) -> Any:
@@ -381,20 +637,29 @@ def get_redis_key(key: str, default: Any = None) -> Any:
     Returns:
         鍵值，如果值為 JSON 字符串會自動解析為 Python 對象
     """
+    start = time.perf_counter()
     try:
         r = get_redis_connection()
         value = r.get(key)
+        fetched = time.perf_counter()
+        add_timing("redis_fetch", fetched - start)
         if value is None:
             return default
+        _record_payload(key, "get", value)
 
         # 嘗試解析 JSON
         try:
             return json.loads(value)
         except (json.JSONDecodeError, TypeError):
             return value
+        finally:
+            add_timing("json_decode", time.perf_counter() - fetched)
     except Exception as e:
+        metrics.inc("redis_helper_errors_total", helper="get_redis_key")
         logger.error(f"獲取 Redis 鍵 {key} 時出錯: {str(e)}")
         return default
+    finally:
+        metrics.observe("redis_helper_duration_seconds", time.perf_counter() - start, helper="get_redis_key")
 
 
 def delete_redis_key(key: str) -> bool:
@@ -406,13 +671,18 @@ def delete_redis_key(key: str) -> bool:
     Returns:
         是否成功刪除
     """
+    start = time.perf_counter()
     try:
         r = get_redis_connection()
         r.delete(key)
+        add_timing("redis_write", time.perf_counter() - start)
         return True
     except Exception as e:
+        metrics.inc("redis_helper_errors_total", helper="delete_redis_key")
         logger.error(f"刪除 Redis 鍵 {key} 時出錯: {str(e)}")
         return False
+    finally:
+        metrics.observe("redis_helper_duration_seconds", time.perf_counter() - start, helper="delete_redis_key")
 
 
 async def stop_redis_server():
@@ -434,12 +704,14 @@ async def stop_redis_server():
 
 def close_redis_pool():
     """關閉 Redis 連接池"""
-    global _redis_pool
+    global _redis_pool, _async_redis_pool
     if _redis_pool is not None:
         logger.info("正在關閉 Redis 連接池...")
         _redis_pool.disconnect()
         _redis_pool = None
         logger.info("Redis 連接池已關閉")
+    # asyncio 版的連線屬於各自的 event loop，只丟棄連接池，由 GC 關閉
+    _async_redis_pool = None
 
 
 def cleanup_redis():
@@ -456,9 +728,15 @@ def scan_redis_keys(pattern: str) -> list:
     Returns:
         符合的 key list
     """
+    start = time.perf_counter()
     try:
         r = get_redis_connection()
-        return list(r.scan_iter(pattern))
+        keys = list(r.scan_iter(pattern))
+        add_timing("redis_fetch", time.perf_counter() - start)
+        return keys
     except Exception as e:
+        metrics.inc("redis_helper_errors_total", helper="scan_redis_keys")
         logger.error(f"scan redis keys 失敗: {str(e)}")
         return []
+    finally:
+        metrics.observe("redis_helper_duration_seconds", time.perf_counter() - start, helper="scan_redis_keys")
@@ -0,0 +1,41 @@
+from typing import Any, Dict, Iterable, Optional, Union
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+
+RawJSON = Union[str, bytes]
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class JSONResponse(ORJSONResponse):
+    """以 orjson 編碼的 JSON 回應 (所有路由的預設回應類別)
+
+    與標準函式庫的 json 相容：允許非字串的 dict key，numpy 數值直接輸出；
+    NaN/Infinity 輸出為 null (標準函式庫會輸出不合法的 JSON)。
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=_OPTIONS)
+
+
+class RawJSONResponse(Response):
+    """內容已經是 JSON (例如 Redis 中的值)，直接輸出，不解析也不重新編碼"""
+
+    media_type = "application/json"
+
+
+def _as_bytes(raw: RawJSON) -> bytes:
+    return raw.encode("utf-8") if isinstance(raw, str) else raw
+
+
+def json_array(items: Iterable[RawJSON]) -> bytes:
+    """把已編碼的 JSON 值組成陣列"""
+    return b"[" + b",".join(_as_bytes(item) for item in items) + b"]"
+
+
+def json_object(raw: Optional[Dict[str, RawJSON]] = None, **fields: Any) -> bytes:
+    """組成 JSON 物件：raw 中的值已經是 JSON，直接嵌入；其他欄位以 orjson 編碼"""
+    parts = [orjson.dumps(name) + b":" + orjson.dumps(value, option=_OPTIONS) for name, value in fields.items()]
+    parts.extend(orjson.dumps(name) + b":" + _as_bytes(value) for name, value in (raw or {}).items())
+    return b"{" + b",".join(parts) + b"}"
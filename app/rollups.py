@@ -0,0 +1,218 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .shared_cache import shared_cache
+from .utils import logger
+from .kol_index import KolDataIndex, get_kol_index
+
+# 以台北時間切日
+_TZ = timezone(timedelta(hours=8))
+_TZ_OFFSET = 8 * 3600
+_DAY = 24 * 3600
+# 彙總的指標：貼文數、互動數、分享數
+FIELDS = ("posts", "reactions", "shares")
+
+
+def _day_number(ts: float) -> int:
+    return int((ts + _TZ_OFFSET) // _DAY)
+
+
+def _prefix(daily: np.ndarray) -> np.ndarray:
+    """每列最前面補 0 的累加和，區間 [a, b] 的總和 = cum[b + 1] - cum[a]"""
+    zeros = np.zeros(daily.shape[:-1] + (1,), dtype=np.float64)
+    return np.concatenate([zeros, np.cumsum(daily, axis=-1)], axis=-1)
+
+
+class KolRollups:
+    """每日彙總表 (與 kol_data 索引版本對應)
+
+    - 每個 (日, kol_id) 與每個 (日, tag) 的貼文數、互動數、分享數，以日為單位的累加和
+    - 沒有時間的貼文另計，只在不篩選時間時計入
+    任何時間區間的總數為 O(1)，趨勢序列為 O(天數)，不需要逐篇掃描貼文。
+    """
+
+    def __init__(self, index: KolDataIndex, kol_info: List[Dict[str, Any]]):
+        self.version = index.version
+        df = index.df
+        n = len(df)
+
+        timestamps = df["timestamp"].to_numpy(dtype=np.float64) if "timestamp" in df.columns else np.full(n, np.nan)
+        dated = ~np.isnan(timestamps)
+        days = np.floor((timestamps[dated] + _TZ_OFFSET) / _DAY).astype(np.int64)
+        self.first_day = int(days.min()) if len(days) else 0
+        self.n_days = int(days.max()) - self.first_day + 1 if len(days) else 0
+
+        if "kol_id" in df.columns:
+            codes, kol_ids = pd.factorize(df["kol_id"])
+        else:
+            codes, kol_ids = np.full(n, -1), pd.Index([])
+        self.kol_ids: List[str] = list(kol_ids)
+        self.kol_pos = {kol_id: i for i, kol_id in enumerate(self.kol_ids)}
+        n_kols = len(self.kol_ids)
+
+        values = {"posts": np.ones(n), "reactions": index.reactions, "shares": index.shares}
+        has_kol = codes >= 0
+        dated_codes = codes[dated]
+        dated_has_kol = has_kol[dated]
+        flat = dated_codes[dated_has_kol] * self.n_days + (days[dated_has_kol] - self.first_day)
+
+        # 每個 kol 的每日數值 → 累加和；沒有時間的貼文另計
+        self.kol_cum: Dict[str, np.ndarray] = {}
+        self.kol_undated: Dict[str, np.ndarray] = {}
+        self.total_cum: Dict[str, np.ndarray] = {}
+        self.total_undated: Dict[str, float] = {}
+        kol_daily: Dict[str, np.ndarray] = {}
+        for field in FIELDS:
+            v = values[field]
+            daily = np.bincount(flat, weights=v[dated][dated_has_kol], minlength=n_kols * self.n_days)
+            kol_daily[field] = daily.reshape(n_kols, self.n_days)
+            self.kol_cum[field] = _prefix(kol_daily[field])
+            undated = ~dated & has_kol
+            self.kol_undated[field] = np.bincount(codes[undated], weights=v[undated], minlength=n_kols)
+            # 全部貼文 (含沒有 kol_id 的)
+            total_daily = np.bincount(days - self.first_day, weights=v[dated], minlength=self.n_days)
+            self.total_cum[field] = _prefix(total_daily)
+            self.total_undated[field] = float(v[~dated].sum())
+
+        # 每個 tag 的每日數值 (kol_info 中同一個 KOL 可以有多個 tag)
+        tag_kols: Dict[str, List[int]] = {}
+        for info in kol_info:
+            tag, kol_id = info.get("tag"), info.get("kol_id")
+            if tag and kol_id in self.kol_pos:
+                tag_kols.setdefault(tag, []).append(self.kol_pos[kol_id])
+        self.tags: List[str] = sorted(tag_kols)
+        self.tag_pos = {tag: i for i, tag in enumerate(self.tags)}
+        # 每個 tag 的 KOL 位置 (不重複)
+        self.tag_members: List[np.ndarray] = [np.asarray(sorted(set(tag_kols[tag])), dtype=np.int64) for tag in self.tags]
+        self.tag_cum: Dict[str, np.ndarray] = {}
+        self.tag_undated: Dict[str, np.ndarray] = {}
+        for field in FIELDS:
+            daily = np.zeros((len(self.tags), self.n_days))
+            undated = np.zeros(len(self.tags))
+            for i, members in enumerate(self.tag_members):
+                daily[i] = kol_daily[field][members].sum(axis=0)
+                undated[i] = self.kol_undated[field][members].sum()
+            self.tag_cum[field] = _prefix(daily)
+            self.tag_undated[field] = undated
+
+    def _day_range(self, window: Optional[tuple]) -> Tuple[int, int]:
+        """時間區間對應的日索引 [lo, hi) (已限制在資料範圍內)"""
+        if window is None:
+            return 0, self.n_days
+        lo = _day_number(window[0]) - self.first_day
+        hi = _day_number(window[1]) - self.first_day + 1
+        return min(max(lo, 0), self.n_days), min(max(hi, 0), self.n_days)
+
+    def _rows(self, tags: Optional[List[str]]) -> Tuple[Optional[Dict[str, np.ndarray]], Optional[Dict[str, np.ndarray]]]:
+        """tags 對應的 (累加和, 沒有時間的數值)，None 為全部"""
+        if not tags:
+            return None, None
+        positions = [self.tag_pos[tag] for tag in set(tags) if tag in self.tag_pos]
+        if len(positions) == 1:
+            i = positions[0]
+            return (
+                {field: self.tag_cum[field][i] for field in FIELDS},
+                {field: self.tag_undated[field][i] for field in FIELDS},
+            )
+        # 同一個 KOL 可以屬於多個 tag，以 KOL 的聯集加總，每篇貼文只計一次
+        if positions:
+            members = np.unique(np.concatenate([self.tag_members[i] for i in positions]))
+        else:
+            members = np.zeros(0, dtype=np.int64)
+        cum = {field: self.kol_cum[field][members].sum(axis=0) for field in FIELDS}
+        undated = {field: self.kol_undated[field][members].sum() for field in FIELDS}
+        return cum, undated
+
+    def totals(self, window: Optional[tuple], tags: Optional[List[str]] = None) -> Dict[str, int]:
+        """區間內的貼文數、互動數、分享數"""
+        lo, hi = self._day_range(window)
+        cum, undated = self._rows(tags)
+        cum = cum or self.total_cum
+        undated = undated or self.total_undated
+        result = {}
+        for field in FIELDS:
+            value = cum[field][hi] - cum[field][lo]
+            if window is None:
+                value += undated[field]
+            result[field] = int(round(value))
+        return result
+
+    def series(self, window: Optional[tuple], tags: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """區間內每日的數值 (趨勢圖用)"""
+        lo, hi = self._day_range(window)
+        cum, _ = self._rows(tags)
+        cum = cum or self.total_cum
+        daily = {field: np.diff(cum[field][lo:hi + 1]) for field in FIELDS}
+        points = []
+        for i in range(hi - lo):
+            date = datetime.fromtimestamp((self.first_day + lo + i) * _DAY - _TZ_OFFSET, _TZ).strftime("%Y-%m-%d")
+            point = {"date": date}
+            point.update({field: int(round(daily[field][i])) for field in FIELDS})
+            points.append(point)
+        return points
+
+    def by_tag(self, window: Optional[tuple], tags: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """每個 tag 的區間總數 (貼文數多者在前)"""
+        lo, hi = self._day_range(window)
+        selected = [tag for tag in self.tags if not tags or tag in tags]
+        groups = []
+        for tag in selected:
+            i = self.tag_pos[tag]
+            group = {"tag": tag}
+            for field in FIELDS:
+                value = self.tag_cum[field][i][hi] - self.tag_cum[field][i][lo]
+                if window is None:
+                    value += self.tag_undated[field][i]
+                group[field] = int(round(value))
+            groups.append(group)
+        return sorted(groups, key=lambda g: (-g["posts"], g["tag"]))
+
+    def by_kol(self, window: Optional[tuple], kol_ids: Optional[List[str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """每個 KOL 的區間總數 (貼文數多者在前，最多 limit 筆)"""
+        lo, hi = self._day_range(window)
+        positions = np.arange(len(self.kol_ids))
+        if kol_ids is not None:
+            positions = np.asarray(sorted({self.kol_pos[k] for k in kol_ids if k in self.kol_pos}), dtype=np.int64)
+        sums = {}
+        for field in FIELDS:
+            sums[field] = self.kol_cum[field][positions, hi] - self.kol_cum[field][positions, lo]
+            if window is None:
+                sums[field] = sums[field] + self.kol_undated[field][positions]
+        order = np.lexsort((positions, -sums["posts"]))[:limit]
+        groups = []
+        for j in order:
+            group = {"kol_id": self.kol_ids[positions[j]]}
+            group.update({field: int(round(sums[field][j])) for field in FIELDS})
+            groups.append(group)
+        return groups
+
+
+_rollups: Optional[KolRollups] = None
+_rollups_lock = threading.Lock()
+
+
+def build_rollups(index: KolDataIndex, kol_info: Optional[List[Dict[str, Any]]] = None) -> KolRollups:
+    """以 kol_data 索引建立每日彙總表 (kol_data 更新、索引重建時呼叫)"""
+    global _rollups
+    if kol_info is None:
+        kol_info = shared_cache.get("sheet:kol_info", default=[]) or []
+    rollups = KolRollups(index, kol_info)
+    with _rollups_lock:
+        _rollups = rollups
+    logger.info(f"每日彙總表已建立: {rollups.n_days} 天, {len(rollups.kol_ids)} 個 KOL, {len(rollups.tags)} 個 tag (版本 {index.version[:8]})")
+    return rollups
+
+
+def get_rollups() -> Optional[KolRollups]:
+    """取得與目前 kol_data 索引同版本的彙總表，版本不同時重建"""
+    index = get_kol_index()
+    if index is None:
+        return None
+    rollups = _rollups
+    if rollups is not None and rollups.version == index.version:
+        return rollups
+    return build_rollups(index)
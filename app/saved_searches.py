@@ -0,0 +1,276 @@
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import redis
+
+from .redis import get_redis_connection
+from .utils import logger
+from .settings import SESSION_EXPIRE
+
+# 每個 session 的 saved search：
+#   saved_searches:{session_id}        hash，field 為搜索 ID，值為搜索 (JSON)
+#   saved_searches:{session_id}:order  sorted set，member 為搜索 ID，score 為 order
+#   saved_searches:{session_id}:next_id 最後分配的搜索 ID (INCR)
+# 搜索的 order 以 sorted set 為準，讀取時覆蓋到搜索上。
+
+
+def saved_search_key(session_id: str) -> str:
+    return f"saved_searches:{session_id}"
+
+
+def order_key(session_id: str) -> str:
+    return f"saved_searches:{session_id}:order"
+
+
+def id_key(session_id: str) -> str:
+    return f"saved_searches:{session_id}:next_id"
+
+
+def _keys(session_id: str) -> Tuple[str, str, str]:
+    return saved_search_key(session_id), order_key(session_id), id_key(session_id)
+
+
+def _encode(search: Dict[str, Any]) -> str:
+    return json.dumps(search)
+
+
+def _write_all(pipe, session_id: str, searches: List[Dict[str, Any]]) -> None:
+    """(在 MULTI 中) 以 searches 取代整個 session 的 saved search"""
+    key, order, ids = _keys(session_id)
+    pipe.delete(key, order)
+    if searches:
+        pipe.hset(key, mapping={str(s["id"]): _encode(s) for s in searches})
+        pipe.zadd(order, {str(s["id"]): s.get("order", i + 1) for i, s in enumerate(searches)})
+    pipe.set(ids, max([s["id"] for s in searches], default=0))
+    _touch(pipe, session_id)
+
+
+def _touch(pipe, session_id: str) -> None:
+    for key in _keys(session_id):
+        pipe.expire(key, SESSION_EXPIRE)
+
+
+def _migrate(r: redis.Redis, session_id: str) -> None:
+    """舊格式 (整個列表存成一個 JSON 字串) 轉成 hash + sorted set
+
+    第一次以新格式存取到舊 key 時才轉換；WATCH 確保只有一個請求完成轉換。
+    """
+    key = saved_search_key(session_id)
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != "string":
+                    pipe.unwatch()
+                    return
+                raw = pipe.get(key)
+                try:
+                    searches = json.loads(raw) if raw else []
+                except json.JSONDecodeError:
+                    searches = []
+                searches = [s for s in searches if isinstance(s, dict) and isinstance(s.get("id"), int)]
+                pipe.multi()
+                _write_all(pipe, session_id, searches)
+                pipe.execute()
+                logger.info(f"saved search {key} 已轉換為 hash ({len(searches)} 筆)")
+                return
+            except redis.WatchError:
+                continue
+
+
+def _run(session_id: str, fn: Callable[[redis.Redis], Any]) -> Any:
+    """執行 hash 操作；遇到舊格式的 key (WRONGTYPE) 時先轉換再重試"""
+    r = get_redis_connection()
+    try:
+        return fn(r)
+    except redis.ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        _migrate(r, session_id)
+        return fn(r)
+
+
+def _decode(raw: Optional[str], order: Optional[float]) -> Optional[Dict[str, Any]]:
+    if raw is None:
+        return None
+    search = json.loads(raw)
+    if order is not None:
+        search["order"] = int(order)
+    return search
+
+
+def _read_all(r, session_id: str) -> List[Dict[str, Any]]:
+    key, order, _ = _keys(session_id)
+    ordered = r.zrange(order, 0, -1, withscores=True)
+    if not ordered:
+        # 沒有 order 時可能是舊格式，讀一次 hash 以觸發 WRONGTYPE
+        r.hlen(key)
+        return []
+    values = r.hmget(key, [member for member, _ in ordered])
+    searches = [_decode(raw, score) for raw, (_, score) in zip(values, ordered)]
+    return [s for s in searches if s is not None]
+
+
+def list_saved_searches(session_id: str) -> List[Dict[str, Any]]:
+    """依 order 排序的 saved search"""
+    return _run(session_id, lambda r: _read_all(r, session_id))
+
+
+def replace_saved_searches(session_id: str, searches: List[Dict[str, Any]]) -> None:
+    """以 searches 取代整個 session 的 saved search (建立 session、複製系統搜索時)"""
+    with get_redis_connection().pipeline() as pipe:
+        _write_all(pipe, session_id, searches)
+        pipe.execute()
+
+
+def delete_saved_searches(session_id: str) -> None:
+    get_redis_connection().delete(*_keys(session_id))
+
+
+def insert_saved_search(session_id: str, build: Callable[[int, int], Dict[str, Any]]) -> Dict[str, Any]:
+    """新增 saved search：ID 以 INCR 分配，build(搜索 ID, order) 組裝搜索，order 排在最後"""
+    key, order, ids = _keys(session_id)
+
+    def op(r: redis.Redis) -> Dict[str, Any]:
+        # 先觸發舊格式轉換，INCR 才會從既有的最大 ID 往上
+        r.hlen(key)
+        search_id = r.incr(ids)
+        last = r.zrevrange(order, 0, 0, withscores=True)
+        search = build(search_id, int(last[0][1]) + 1 if last else 1)
+        with r.pipeline() as pipe:
+            pipe.hset(key, str(search_id), _encode(search))
+            pipe.zadd(order, {str(search_id): search["order"]})
+            _touch(pipe, session_id)
+            pipe.execute()
+        return search
+
+    return _run(session_id, op)
+
+
+def patch_saved_search(
+    session_id: str,
+    search_id: int,
+    update: Callable[[Dict[str, Any]], None]
+) -> Optional[Dict[str, Any]]:
+    """以 update(搜索) 修改單一 saved search (只讀寫該 field)，不存在時返回 None"""
+    key, order, _ = _keys(session_id)
+    field = str(search_id)
+
+    def op(r: redis.Redis) -> Optional[Dict[str, Any]]:
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key, order)
+                    search = _decode(pipe.hget(key, field), pipe.zscore(order, field))
+                    if search is None:
+                        pipe.unwatch()
+                        return None
+                    previous_order = search.get("order")
+                    update(search)
+                    pipe.multi()
+                    pipe.hset(key, field, _encode(search))
+                    if search.get("order") != previous_order:
+                        pipe.zadd(order, {field: search["order"]})
+                    _touch(pipe, session_id)
+                    pipe.execute()
+                    return search
+                except redis.WatchError:
+                    continue
+
+    return _run(session_id, op)
+
+
+def remove_saved_search(session_id: str, search_id: int) -> bool:
+    key, order, _ = _keys(session_id)
+
+    def op(r: redis.Redis) -> bool:
+        with r.pipeline() as pipe:
+            pipe.hdel(key, str(search_id))
+            pipe.zrem(order, str(search_id))
+            deleted, _ = pipe.execute()
+        return deleted > 0
+
+    return _run(session_id, op)
+
+
+def reorder_saved_searches(session_id: str, search_ids: List[int]) -> List[int]:
+    """依 search_ids 的順序重新設定 order (1, 2, ...)，只改 sorted set，不重寫搜索
+
+    沒有列出的搜索排在後面，保持原本的相對順序。
+
+    Returns:
+        新的順序 (搜索 ID)
+    """
+    key, order, _ = _keys(session_id)
+
+    def op(r: redis.Redis) -> List[int]:
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(order)
+                    # 先觸發舊格式轉換
+                    pipe.hlen(key)
+                    current = [int(member) for member in pipe.zrange(order, 0, -1)]
+                    existing = set(current)
+                    listed = list(dict.fromkeys(i for i in search_ids if i in existing))
+                    listed_set = set(listed)
+                    ordered = listed + [i for i in current if i not in listed_set]
+                    pipe.multi()
+                    if ordered:
+                        pipe.zadd(order, {str(search_id): position for position, search_id in enumerate(ordered, 1)})
+                    _touch(pipe, session_id)
+                    pipe.execute()
+                    return ordered
+                except redis.WatchError:
+                    continue
+
+    return _run(session_id, op)
+
+
+def apply_saved_search_changes(
+    session_id: str,
+    modify: Callable[[List[Dict[str, Any]], Callable[[], int]], Any]
+) -> Any:
+    """在同一個 transaction 中修改多筆 saved search
+
+    modify(依 order 排序的搜索列表, 分配新 ID 的函式) 直接修改列表並返回結果；
+    之後只寫入有變動的搜索與 order，刪除列表中不再出現的搜索。
+    其他請求同時修改時 (WATCH) 重新讀取並再呼叫一次 modify。
+    """
+    key, order, ids = _keys(session_id)
+
+    def op(r: redis.Redis) -> Any:
+        with r.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key, order, ids)
+                    searches = _read_all(pipe, session_id)
+                    before = {s["id"]: _encode(s) for s in searches}
+                    last_id = max(int(pipe.get(ids) or 0), max(before, default=0))
+                    allocated = [last_id]
+
+                    def allocate() -> int:
+                        allocated[0] += 1
+                        return allocated[0]
+
+                    result = modify(searches, allocate)
+                    after = {s["id"]: s for s in searches}
+                    changed = {i: s for i, s in after.items() if before.get(i) != _encode(s)}
+                    removed = [i for i in before if i not in after]
+
+                    pipe.multi()
+                    if changed:
+                        pipe.hset(key, mapping={str(i): _encode(s) for i, s in changed.items()})
+                        pipe.zadd(order, {str(i): s.get("order", 0) for i, s in changed.items()})
+                    if removed:
+                        pipe.hdel(key, *[str(i) for i in removed])
+                        pipe.zrem(order, *[str(i) for i in removed])
+                    if allocated[0] != last_id:
+                        pipe.set(ids, allocated[0])
+                    _touch(pipe, session_id)
+                    pipe.execute()
+                    return result
+                except redis.WatchError:
+                    continue
+
+    return _run(session_id, op)
@@ -1,27 +1,65 @@
+import copy
+import json
 import time
 import uuid
-from typing import Dict, List, Optional, Any
-from fastapi import APIRouter, Body, Query
-from .redis import set_redis_key, get_redis_key, delete_redis_key, scan_redis_keys, get_redis_connection
-from .utils import logger
-from .settings import SESSION_EXPIRE, GEMINI_MODEL, GEMINI_API_KEY
+from typing import Callable, Dict, List, Optional, Any
+from fastapi import APIRouter, Body, Query, Request, Header
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from .redis import set_redis_key, get_redis_key, delete_redis_key, get_redis_connection
+from .utils import logger, encode_cursor, decode_cursor
+from .settings import SESSION_EXPIRE, MESSAGE_MAX_PAGE_SIZE, MESSAGE_LONG_POLL_TIMEOUT, BATCH_MAX_OPERATIONS
 from .sheet import sheet_manager
-import threading
+from .responses import JSONResponse, RawJSONResponse, json_array
+from .shared_cache import shared_cache
+from .session_lock import session_locks
+from .llm_cache import make_cache_key, content_digest, get_cached_response, set_cached_response
+from .llm_context import build_kol_context, build_markdown_context
+from .context_cache import context_cache
+from .llm import get_llm_provider
+from .singleflight import llm_singleflight
+from .history import invalidate_digest, delete_session_digests
+from .metrics import StageTimer
+from .messages import (
+    message_key,
+    append_message,
+    get_message,
+    list_messages,
+    page_messages,
+    update_message_content,
+    delete_message_by_id,
+    clear_messages,
+    delete_session_messages,
+    message_events,
+    poll_message_events,
+    apply_message_batch,
+)
+from .saved_searches import (
+    list_saved_searches,
+    replace_saved_searches,
+    delete_saved_searches,
+    insert_saved_search,
+    patch_saved_search,
+    remove_saved_search,
+    reorder_saved_searches,
+    apply_saved_search_changes,
+)
 from datetime import datetime
-import google.generativeai as genai
-from google.generativeai import GenerativeModel
-
-# per-session lock
-_session_locks: Dict[str, threading.Lock] = {}
-def get_session_lock(session_id: str) -> threading.Lock:
-    if session_id not in _session_locks:
-        _session_locks[session_id] = threading.Lock()
-    return _session_locks[session_id]
 
 # 創建路由器
 router = APIRouter()
 
 
+def _batch_error(operations: Any) -> Optional[str]:
+    """批次 API 的 operations 檢查"""
+    if not isinstance(operations, list) or not operations:
+        return "operations 不能為空"
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return f"operations 最多 {BATCH_MAX_OPERATIONS} 個"
+    return None
+
+
+
 @router.delete("/session")
 async def delete_session_endpoint(session_id: str):
     """刪除會話及其相關數據"""
@@ -68,7 +106,8 @@ async def api_create_message(
     search_id: int = Query(...),
     message: dict = Body(...)
 ):
-    result = create_message(
+    result = await run_in_threadpool(
+        create_message,
         session_id, 
         search_id, 
         message.get("role"), 
@@ -77,8 +116,93 @@ async def api_create_message(
     return result
 
 @router.get("/message")
-async def api_get_messages(session_id: str, search_id: int, since_id: Optional[int] = None, limit: Optional[int] = None):
-    return get_messages(session_id, search_id, since_id, limit)
+async def api_get_messages(
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    page_size: Optional[int] = None,
+    cursor: Optional[str] = None
+):
+    """取得訊息
+
+    帶 page_size 或 cursor 時改為分頁：由最新的訊息往前，每頁最多 page_size 則，
+    返回 {"messages", "next_cursor", "total"}；next_cursor 為取得更早訊息的 cursor，
+    沒有更早的訊息時為 null。
+    """
+    if page_size is None and cursor is None:
+        # 訊息在 Redis 中已經是 JSON，直接組成陣列，不解析再重新編碼
+        return RawJSONResponse(json_array(get_messages(session_id, search_id, since_id, limit, raw=True)))
+    page = get_messages_page(session_id, search_id, page_size, cursor)
+    if "error" in page:
+        return JSONResponse(page, status_code=400)
+    return page
+
+@router.get("/message/stream")
+async def api_stream_messages(
+    request: Request,
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """以 Server-Sent Events 推送訊息的新增 (created)、更新 (updated)、刪除 (deleted) 與清空 (cleared)
+
+    帶 since_id (或重新連線時瀏覽器自動帶的 Last-Event-ID) 時先補送之後的訊息。
+    每個事件的 data 為 JSON，例如 {"type": "created", "message": {...}}。
+    """
+    if since_id is None and last_event_id and last_event_id.isdigit():
+        since_id = int(last_event_id)
+
+    async def event_stream():
+        async for event in message_events(session_id, search_id, since_id):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            message = event.get("message") or {}
+            event_id = f"id: {message['id']}\n" if event["type"] == "created" else ""
+            yield f"{event_id}event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/message/poll")
+async def api_poll_messages(
+    session_id: str,
+    search_id: int,
+    since_id: Optional[int] = None,
+    timeout: float = MESSAGE_LONG_POLL_TIMEOUT
+):
+    """long-poll：返回 since_id 之後的訊息事件，沒有時最多等待 timeout 秒 (不支援 SSE 的客戶端使用)"""
+    timeout = min(max(timeout, 0), MESSAGE_LONG_POLL_TIMEOUT)
+    return {"events": await poll_message_events(session_id, search_id, since_id, timeout)}
+
+@router.post("/message/batch")
+async def api_batch_messages(
+    session_id: str = Query(...),
+    body: dict = Body(...)
+):
+    """批次新增、更新、刪除訊息 (可跨 search_id)，在同一個 Redis transaction 中完成
+
+    body 為 {"operations": [...]}，每一項為
+    {"op": "create", "search_id": int, "role": str, "content": str}、
+    {"op": "update", "search_id": int, "id": int, "content": str} 或
+    {"op": "delete", "search_id": int, "id": int}。
+    返回 {"results": [...]}，與 operations 同順序，每一項有 success 與 message 或 error。
+    """
+    operations = body.get("operations")
+    error = _batch_error(operations)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    results = await run_in_threadpool(batch_messages, session_id, operations)
+    if results is None:
+        return JSONResponse({"error": "批次處理訊息失敗"}, status_code=500)
+    return {"results": results}
 
 @router.patch("/message")
 async def api_update_message(
@@ -87,7 +211,8 @@ async def api_update_message(
     message_id: int = Query(...),
     update_data: dict = Body(...)
 ):
-    return {"success": update_message(
+    return {"success": await run_in_threadpool(
+        update_message,
         session_id, 
         search_id, 
         message_id, 
@@ -102,14 +227,9 @@ async def api_delete_message(
     message_id: Optional[int] = None
 ):
     if message_id is not None:
-        return {"success": delete_message(session_id, search_id, message_id)}
+        return {"success": await run_in_threadpool(delete_message, session_id, search_id, message_id)}
     # 沒有帶 message_id，直接清空該 search_id 的所有訊息
-    from .redis import set_redis_key
-    from .settings import SESSION_EXPIRE
-    message_key = f"messages:{session_id}-{search_id}"
-    set_redis_key(message_key, [], expire=SESSION_EXPIRE)
-    logger.info(f"清空所有訊息 in {session_id}-{search_id}")
-    return {"success": True}
+    return {"success": await run_in_threadpool(clear_all_messages, session_id, search_id)}
 
 # 新增 saved_search CRUD API
 @router.post("/saved_search")
@@ -117,26 +237,63 @@ async def api_create_saved_search(
     session_id: str = Query(...),
     search_data: dict = Body(...)
 ):
-    return create_saved_search(session_id, search_data)
+    return await run_in_threadpool(create_saved_search, session_id, search_data)
 
 @router.get("/saved_search")
 async def api_get_saved_searches(session_id: str):
     return get_saved_searches(session_id)
 
+@router.post("/saved_search/batch")
+async def api_batch_saved_searches(
+    session_id: str = Query(...),
+    body: dict = Body(...)
+):
+    """批次新增、更新、刪除已保存的搜索 (例如一次更新所有項目的 order)
+
+    body 為 {"operations": [...]}，每一項為 {"op": "create", ...搜索欄位}、
+    {"op": "update", "id": int, ...要更新的欄位} 或 {"op": "delete", "id": int}。
+    返回 {"results": [...]}，與 operations 同順序，每一項有 success 與 search 或 error。
+    """
+    operations = body.get("operations")
+    error = _batch_error(operations)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    results = await run_in_threadpool(batch_saved_searches, session_id, operations)
+    if results is None:
+        return JSONResponse({"error": "批次處理 saved_search 失敗"}, status_code=500)
+    return {"results": results}
+
+@router.post("/saved_search/reorder")
+async def api_reorder_saved_searches(
+    session_id: str = Query(...),
+    body: dict = Body(...)
+):
+    """依 {"ids": [搜索 ID, ...]} 的順序重新設定 order，沒有列出的搜索排在後面
+
+    返回 {"order": [搜索 ID, ...]} (新的順序)
+    """
+    search_ids = body.get("ids")
+    if not isinstance(search_ids, list):
+        return JSONResponse({"error": "ids 必須是列表"}, status_code=400)
+    order = await run_in_threadpool(update_saved_search_order, session_id, search_ids)
+    if order is None:
+        return JSONResponse({"error": "重新排序 saved_search 失敗"}, status_code=500)
+    return {"order": order}
+
 @router.patch("/saved_search")
 async def api_update_saved_search(
     session_id: str = Query(...),
     search_id: int = Query(...),
     update_data: dict = Body(...)
 ):
-    updated_search = update_saved_search(session_id, search_id, update_data)
+    updated_search = await run_in_threadpool(update_saved_search, session_id, search_id, update_data)
     if updated_search:
         return updated_search
     return {"error": "not found or update failed"}
 
 @router.delete("/saved_search")
 async def api_delete_saved_search(session_id: str, search_id: int):
-    return {"success": delete_saved_search(session_id, search_id)}
+    return {"success": await run_in_threadpool(delete_saved_search, session_id, search_id)}
 
 # @router.get("/message/llm")
 # async def api_get_llm_response(
@@ -210,8 +367,8 @@ async def api_post_llm_response(
         # 使用延遲導入避免循環導入
         from .gemini import gemini_chat
         
-        # 使用 Gemini API 處理請求
-        bot_reply = gemini_chat(session_id, search_id, query=query)
+        # 使用 Gemini API 處理請求 (LLM 呼叫會阻塞，在 threadpool 中執行)
+        bot_reply = await run_in_threadpool(gemini_chat, session_id, search_id, query=query)
         
         # 只返回內容，不需要其他元數據
         return {"content": bot_reply}
@@ -234,16 +391,18 @@ async def api_get_kol_data_llm_response(
     Args:
         session_id: 會話 ID
         search_id: 搜索 ID
-        request_data: 包含查詢的請求體 {"query": "..."}
+        request_data: 包含查詢的請求體 {"query": "...", "no_cache": false}
+            no_cache 為 true 時略過回應緩存，強制呼叫 LLM
         
     Returns:
-        LLM 生成的回應內容
+        LLM 生成的回應內容，以及送入 LLM 的資料報告 (context)
     """
     try:
         # 從請求體中獲取查詢
         query = request_data.get("query", "")
         if not query:
             return {"error": "查詢不能為空"}
+        bypass_cache = bool(request_data.get("no_cache", False))
         
         # 從 Redis 中獲取 Markdown 格式的 KOL 數據
         from .redis import get_redis_key
@@ -255,42 +414,94 @@ async def api_get_kol_data_llm_response(
         if not markdown_content:
             return {"error": "找不到 KOL 數據，請先使用 /api/redis/kol-data 獲取資料"}
         
-        # 加載 prompt 模板
-        from .gemini import load_prompt
-        prompt = load_prompt()
-        if not prompt:
+        # 加載 prompt 模板 (已緩存，只有檔案變動時才重新讀取)
+        from .prompts import prompt_registry
+        prompt_template = prompt_registry.get()
+        if prompt_template is None or not prompt_template.text:
             return {"error": "無法加載 prompt 模板"}
+        prompt = prompt_template.render()
+        logger.info(f"KOL data LLM 使用 prompt 版本 {prompt_template.version}")
+
+        # 依 token 預算挑選要送給 LLM 的資料 (依互動數與時間排序，長尾彙總)
+        # /kol-data 只保存列位置，這裡才由索引組成貼文 (在 threadpool 中執行，不阻塞 event loop)
+        from .redis import load_kol_data_rows
+        timer = StageTimer("kol_data_llm")
+        kol_data_rows = await run_in_threadpool(load_kol_data_rows, session_id, search_id)
+        if kol_data_rows is not None:
+            context_content, context_report = build_kol_context(kol_data_rows)
+        else:
+            context_content, context_report = build_markdown_context(markdown_content)
+        timer.lap("context_build")
+        logger.info(
+            f"KOL data LLM 上下文: {context_report['included_rows']}/{context_report['total_rows']} 筆, "
+            f"截短 {context_report['truncated_rows']} 筆, 省略 {context_report['omitted_rows']} 筆, "
+            f"約 {context_report['estimated_tokens']} tokens"
+        )
+
+        # 相同 prompt、相同資料、相同模型的相同問題直接返回緩存
+        provider = get_llm_provider()
+        context_digest = content_digest(context_content)
+        cache_key = make_cache_key(
+            prompt_template.version,
+            context_digest,
+            f"{provider.name}:{provider.model}",
+            query
+        )
+        if not bypass_cache:
+            cached = get_cached_response(cache_key)
+            if cached is not None:
+                logger.info(f"KOL data LLM 命中回應緩存 {cache_key}")
+                return {"content": cached.get("content", ""), "cached": True, "context": context_report}
         
-        # 直接使用 GenerativeModel 而不是 gemini_chat
-        if not GEMINI_API_KEY:
+        context_message = f"以下是 KOL 發文資料：\n\n```markdown\n{context_content}\n```"
+
+        if not provider.is_configured():
             return {"error": "未設置 Gemini API 金鑰，無法使用聊天功能"}
             
-        try:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = GenerativeModel(GEMINI_MODEL)
-            
-            # 將 prompt 和 markdown 資料放入 history 中
-            # 這樣 LLM 就能理解背景和數據，而用戶查詢可以更簡潔
-            
-            # 建立對話，將系統訊息放入 history
-            chat = model.start_chat(
-                history=[
+        def call_llm() -> str:
+            result = None
+            # 同一個 search 的後續提問重用已上傳的 prompt 與資料 (context cache)
+            if context_cache is not None:
+                handle = context_cache.get_or_create(
+                    session_id,
+                    search_id,
+                    prompt,
+                    context_message,
+                    f"{prompt_template.version}:{context_digest}",
+                    context_report["estimated_tokens"]
+                )
+                if handle:
+                    result = context_cache.generate(session_id, search_id, handle, query)
+
+            if result is None:
+                # 將 prompt 和 markdown 資料放入 history 中
+                # 這樣 LLM 就能理解背景和數據，而用戶查詢可以更簡潔
+                history = [
                     {
                         "role": "user",
                         "parts": [prompt]
                     },
                     {
                         "role": "model",
-                        "parts": [f"以下是 KOL 發文資料：\n\n```markdown\n{markdown_content}\n```"]
+                        "parts": [context_message]
                     }
                 ]
-            )
-            
-            # 只傳送用戶的實際查詢
-            response = chat.send_message(query)
-            
-            # 直接返回 LLM 的回應
-            return {"content": response.text}
+                # 只傳送用戶的實際查詢
+                result = provider.chat(history, query)
+
+            # 寫入回應緩存後返回 LLM 的回應
+            set_cached_response(cache_key, {"content": result.text})
+            return result.text
+
+        try:
+            # 同時間相同的問題 (跨 worker) 只呼叫一次 LLM，其他請求共用結果
+            if llm_singleflight is not None:
+                content, coalesced = await llm_singleflight.do(cache_key, call_llm)
+            else:
+                content, coalesced = await run_in_threadpool(call_llm), False
+            if coalesced:
+                logger.info(f"KOL data LLM 合併相同請求 {cache_key}")
+            return {"content": content, "cached": False, "coalesced": coalesced, "context": context_report}
         except Exception as e:
             logger.error(f"Gemini API 呼叫出錯: {str(e)}")
             return {"error": f"Gemini API 錯誤: {str(e)}"}
@@ -323,7 +534,7 @@ def create_session(session_id: Optional[str] = None) -> str:
         now = int(time.time())
         
         # 獲取系統搜索，如果沒有則創建默認搜索
-        global_saved_searches = get_redis_key("sheet:saved_searches", default=[])
+        global_saved_searches = shared_cache.get("sheet:saved_searches", default=[])
         system_searches = [s for s in global_saved_searches if s.get("account") == "系統"]
         
         # 如果系統搜索為空，創建至少一個默認系統搜索
@@ -349,11 +560,11 @@ def create_session(session_id: Optional[str] = None) -> str:
             #     },
             #     "created_at": datetime.now().isoformat()
             # }]
-            global_saved_searches = get_redis_key("sheet:saved_searches", default=[])
+            global_saved_searches = shared_cache.get("sheet:saved_searches", default=[])
             system_searches = [s for s in global_saved_searches if s.get("account") == "系統"]
 
             # 寫回 redis 以便其它用戶使用
-            set_redis_key("sheet:saved_searches", system_searches)
+            shared_cache.set("sheet:saved_searches", system_searches)
             logger.info("已創建默認系統搜索")
         
         session_data = {
@@ -362,17 +573,16 @@ def create_session(session_id: Optional[str] = None) -> str:
         }
         session_key = f"sessions:{session_id}"
         set_redis_key(session_key, session_data, expire=SESSION_EXPIRE)
-        saved_searches_key = f"saved_searches:{session_id}"
-        set_redis_key(saved_searches_key, system_searches, expire=SESSION_EXPIRE)
-        
-        # 為每個 search_id 建立空的 messages key
-        for search in system_searches:
-            search_id = search.get("id")
-            if search_id is not None:
-                set_redis_key(f"messages:{session_id}-{search_id}", [], expire=SESSION_EXPIRE)
+        replace_saved_searches(session_id, system_searches)
         
-        # 建立一個 messages:{session_id}-999 的空 list
-        set_redis_key(f"messages:{session_id}-999", [], expire=SESSION_EXPIRE)
+        # 每個 search_id (與 999) 的訊息從空的開始；訊息存成 sorted set，空的就是不存在的 key
+        message_keys = [
+            message_key(session_id, search.get("id"))
+            for search in system_searches
+            if search.get("id") is not None
+        ]
+        message_keys.append(message_key(session_id, 999))
+        get_redis_connection().delete(*message_keys)
         logger.info(f"創建新會話: {session_id}，複製了 {len(system_searches)} 筆系統搜索")
         return session_id
     except Exception as e:
@@ -417,11 +627,9 @@ def delete_session(session_id: str) -> bool:
             return False
         session_key = f"sessions:{session_id}"
         delete_redis_key(session_key)
-        keys = scan_redis_keys(f"messages:{session_id}-*")
-        for k in keys:
-            delete_redis_key(k)
-        saved_searches_key = f"saved_searches:{session_id}"
-        delete_redis_key(saved_searches_key)
+        delete_session_messages(session_id)
+        delete_saved_searches(session_id)
+        delete_session_digests(session_id)
         return True
     except Exception as e:
         logger.error(f"刪除會話時出錯: {str(e)} | redis_alive={is_redis_alive()}")
@@ -446,24 +654,13 @@ def create_message(
         添加的消息對象
     """
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             session_data = get_session(session_id)
             if session_data is None:
                 session_id = create_session(session_id)
                 session_data = get_session(session_id)
-            message_key = f"messages:{session_id}-{search_id}"
-            messages = get_redis_key(message_key, default=[])
-            message_id = max([m["id"] for m in messages], default=-1) + 1
-            message = {
-                "id": message_id,
-                "role": role,
-                "content": content,
-                "created_at": int(time.time()),
-            }
-            messages.append(message)
-            set_redis_key(message_key, messages, expire=SESSION_EXPIRE)
-            logger.info(f"添加消息 {message_id} 到會話 {session_id}")
+            message = append_message(session_id, search_id, role, content)
+            logger.info(f"添加消息 {message['id']} 到會話 {session_id}")
             return message
     except Exception as e:
         logger.error(f"添加消息時出錯: {str(e)} | redis_alive={is_redis_alive()}")
@@ -474,14 +671,16 @@ def get_messages(
     session_id: str,
     search_id: int,
     since_id: Optional[int] = None,
-    limit: Optional[int] = None
-) -> List[Dict[str, Any]]:
+    limit: Optional[int] = None,
+    raw: bool = False
+) -> List[Any]:
     """獲取會話消息
 
     Args:
         session_id: 會話 ID
         since_id: 只獲取此 ID 之後的消息
         limit: 消息數量限制
+        raw: 返回未解析的 JSON 字串
 
     Returns:
         消息列表
@@ -489,18 +688,53 @@ def get_messages(
     try:
         if get_session(session_id) is None:
             return []
-        message_key = f"messages:{session_id}-{search_id}"
-        messages = get_redis_key(message_key, default=[])
-        if since_id is not None:
-            messages = [msg for msg in messages if msg["id"] > since_id]
-        if limit and limit > 0:
-            messages = messages[-limit:]
-        return messages
+        return list_messages(session_id, search_id, since_id, limit, raw)
     except Exception as e:
         logger.error(f"獲取消息時出錯: {str(e)} | redis_alive={is_redis_alive()}")
         return []
 
 
+def get_messages_page(
+    session_id: str,
+    search_id: int,
+    page_size: Optional[int] = None,
+    cursor: Optional[str] = None
+) -> Dict[str, Any]:
+    """分頁獲取會話消息 (由新到舊)
+
+    cursor 記錄上一頁最早的訊息 ID 與 search_id。訊息 ID 由 messages_seq 計數器配發，
+    刪除或清空訊息後也不會重複使用，因此新增訊息不會影響之後的分頁；
+    清空後舊的 cursor 只會返回空頁，不會翻到清空後新增的訊息。
+
+    Args:
+        session_id: 會話 ID
+        search_id: 搜索 ID
+        page_size: 每頁訊息數 (上限 MESSAGE_MAX_PAGE_SIZE)
+        cursor: 上一頁返回的 next_cursor，None 為最新一頁
+
+    Returns:
+        {"messages": 訊息列表 (由舊到新), "next_cursor": str 或 None, "total": 訊息總數}
+    """
+    page_size = min(max(int(page_size or MESSAGE_MAX_PAGE_SIZE), 1), MESSAGE_MAX_PAGE_SIZE)
+    before_id = None
+    if cursor is not None:
+        payload = decode_cursor(cursor)
+        if payload is None or payload.get("search_id") != search_id or not isinstance(payload.get("before"), int):
+            return {"error": "無效的 cursor", "messages": [], "next_cursor": None, "total": 0}
+        before_id = payload["before"]
+    try:
+        if get_session(session_id) is None:
+            return {"messages": [], "next_cursor": None, "total": 0}
+        messages, has_more, total = page_messages(session_id, search_id, page_size, before_id)
+        next_cursor = None
+        if has_more and messages:
+            next_cursor = encode_cursor({"search_id": search_id, "before": messages[0]["id"]})
+        return {"messages": messages, "next_cursor": next_cursor, "total": total}
+    except Exception as e:
+        logger.error(f"分頁獲取消息時出錯: {str(e)} | redis_alive={is_redis_alive()}")
+        return {"messages": [], "next_cursor": None, "total": 0}
+
+
 def update_message(
     session_id: str,
     search_id: int,
@@ -520,22 +754,16 @@ def update_message(
         是否成功更新
     """
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             if get_session(session_id) is None:
                 return False
-            message_key = f"messages:{session_id}-{search_id}"
-            messages = get_redis_key(message_key, default=[])
-            updated = False
-            for msg in messages:
-                if msg["id"] == message_id:
-                    if content is not None:
-                        msg["content"] = content
-                    # role 不會被更新
-                    updated = True
-                    break
+            # role 不會被更新；沒有新內容時只確認訊息存在
+            if content is None:
+                updated = get_message(session_id, search_id, message_id) is not None
+            else:
+                updated = update_message_content(session_id, search_id, message_id, content)
             if updated:
-                set_redis_key(message_key, messages, expire=SESSION_EXPIRE)
+                invalidate_digest(session_id, search_id, message_id)
                 logger.info(f"更新消息 {message_id} in {session_id}-{search_id}")
                 return True
             return False
@@ -547,16 +775,12 @@ def update_message(
 def delete_message(session_id: str, search_id: int, message_id: int) -> bool:
     """刪除單一訊息"""
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             if get_session(session_id) is None:
                 return False
-            message_key = f"messages:{session_id}-{search_id}"
-            messages = get_redis_key(message_key, default=[])
-            new_messages = [msg for msg in messages if msg["id"] != message_id]
-            if len(new_messages) == len(messages):
+            if not delete_message_by_id(session_id, search_id, message_id):
                 return False  # 沒有刪除任何東西
-            set_redis_key(message_key, new_messages, expire=SESSION_EXPIRE)
+            invalidate_digest(session_id, search_id, message_id)
             logger.info(f"刪除消息 {message_id} in {session_id}-{search_id}")
             return True
     except Exception as e:
@@ -564,6 +788,60 @@ def delete_message(session_id: str, search_id: int, message_id: int) -> bool:
         return False
 
 
+def clear_all_messages(session_id: str, search_id: int) -> bool:
+    """清空 search_id 的所有訊息"""
+    try:
+        with session_locks.lock(session_id):
+            clear_messages(session_id, search_id)
+            invalidate_digest(session_id, search_id)
+            logger.info(f"清空所有訊息 in {session_id}-{search_id}")
+            return True
+    except Exception as e:
+        logger.error(f"清空消息時出錯: {str(e)} | redis_alive={is_redis_alive()}")
+        return False
+
+
+def _saved_search_record(
+    search_id: int,
+    order: int,
+    search_data: Dict[str, Any],
+    name: Optional[str] = None
+) -> Dict[str, Any]:
+    """組裝 saved search，query 欄位要包進去"""
+    return {
+        "id": search_id,
+        "title": search_data.get("title", name or f"Search {int(time.time())}"),
+        "account": search_data.get("account", "使用者"),
+        "order": order,
+        "query": {
+            "title": search_data.get("title", ""),
+            "time": search_data.get("time", 0),
+            "source": search_data.get("source", 0),
+            "tags": search_data.get("tags", []),
+            "query": search_data.get("query", ""),
+            "n": search_data.get("n", ""),
+            "range": search_data.get("range")
+        },
+        "created_at": datetime.now().isoformat()
+    }
+
+
+def _merge_saved_search(search: Dict[str, Any], update_data: Dict[str, Any]) -> None:
+    """把 update_data 覆蓋到 search 上 (直接修改 search)"""
+    # 先處理 query 欄位的扁平 merge
+    if "query" in search and isinstance(search["query"], dict):
+        for key in ["title", "time", "source", "tags", "query", "n", "range"]:
+            if key in update_data:
+                search["query"][key] = update_data[key]
+    # 其他欄位照舊
+    for k in ["title", "account", "order", "created_at"]:
+        if k in update_data:
+            search[k] = update_data[k]
+    # 如果有 query 整包，還是可以直接覆蓋
+    if "query" in update_data and isinstance(update_data["query"], dict):
+        search["query"] = update_data["query"]
+
+
 def create_saved_search(
     session_id: str,
     search_data: Dict[str, Any],
@@ -571,35 +849,17 @@ def create_saved_search(
 ) -> Dict[str, Any]:
     """保存搜索參數，格式與 get_saved_searches 一致"""
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             session_data = get_session(session_id)
             if session_data is None:
                 session_id = create_session(session_id)
                 session_data = get_session(session_id)
-            saved_searches_key = f"saved_searches:{session_id}"
-            saved_searches = get_redis_key(saved_searches_key, default=[])
-            search_id = max([s.get("id", 0) for s in saved_searches], default=0) + 1
-            now_iso = datetime.now().isoformat()
-            # 直接組裝 search dict，query 欄位要包進去
-            search_record = {
-                "id": search_id,
-                "title": search_data.get("title", name or f"Search {int(time.time())}"),
-                "account": search_data.get("account", "使用者"),
-                "order": len(saved_searches) + 1,
-                "query": {
-                    "title": search_data.get("title", ""),
-                    "time": search_data.get("time", 0),
-                    "source": search_data.get("source", 0),
-                    "tags": search_data.get("tags", []),
-                    "query": search_data.get("query", ""),
-                    "n": search_data.get("n", ""),
-                    "range": search_data.get("range")
-                },
-                "created_at": now_iso
-            }
-            saved_searches.append(search_record)
-            set_redis_key(saved_searches_key, saved_searches, expire=SESSION_EXPIRE)
+            # ID 以 INCR 分配，只寫入這一筆
+            search_record = insert_saved_search(
+                session_id,
+                lambda search_id, order: _saved_search_record(search_id, order, search_data, name)
+            )
+            search_id = search_record["id"]
             logger.info(f"保存搜索 {search_id} 到會話 {session_id}")
             return search_record
     except Exception as e:
@@ -618,14 +878,13 @@ def get_saved_searches(session_id: str) -> List[Dict[str, Any]]:
                 logger.error("創建 session 失敗")
                 return []
             
-        # 取得 saved_searches，如果是空的就複製系統搜索
-        saved_searches_key = f"saved_searches:{session_id}"
-        raw_list = get_redis_key(saved_searches_key, default=[])
+        # 取得 saved_searches (依 order 排序)，如果是空的就複製系統搜索
+        raw_list = list_saved_searches(session_id)
 
         # 如果是空的，嘗試從全局複製系統搜索
         if len(raw_list) == 0:
             logger.info(f"saved_searches:{session_id} 為空，從全局複製系統搜索")
-            global_saved_searches = get_redis_key("sheet:saved_searches", default=[])
+            global_saved_searches = shared_cache.get("sheet:saved_searches", default=[])
             system_searches = [s for s in global_saved_searches if s.get("account") == "系統"]
             
             # 如果全局系統搜索仍為空，創建一個默認系統搜索
@@ -651,11 +910,11 @@ def get_saved_searches(session_id: str) -> List[Dict[str, Any]]:
                 #     },
                 #     "created_at": datetime.now().isoformat()
                 # }]
-                global_saved_searches = get_redis_key("sheet:saved_searches", default=[])
+                global_saved_searches = shared_cache.get("sheet:saved_searches", default=[])
                 system_searches = [s for s in global_saved_searches if s.get("account") == "系統"]
             
-            set_redis_key(saved_searches_key, system_searches, expire=SESSION_EXPIRE)
-            raw_list = system_searches
+            replace_saved_searches(session_id, system_searches)
+            raw_list = list_saved_searches(session_id)
             logger.info(f"複製了 {len(raw_list)} 筆系統搜索")
 
         result = []
@@ -679,33 +938,16 @@ def update_saved_search(
     更新已保存的搜索，直接覆蓋 search dict 的欄位，並回傳更新後的 search dict
     """
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             if get_session(session_id) is None:
                 return {}
-            saved_searches_key = f"saved_searches:{session_id}"
-            saved_searches = get_redis_key(saved_searches_key, default=[])
-            updated = False
-            updated_search = None
-            for s in saved_searches:
-                if s["id"] == search_id:
-                    # 先處理 query 欄位的扁平 merge
-                    if "query" in s and isinstance(s["query"], dict):
-                        for key in ["title", "time", "source", "tags", "query", "n", "range"]:
-                            if key in update_data:
-                                s["query"][key] = update_data[key]
-                    # 其他欄位照舊
-                    for k in ["title", "account", "order", "created_at"]:
-                        if k in update_data:
-                            s[k] = update_data[k]
-                    # 如果有 query 整包，還是可以直接覆蓋
-                    if "query" in update_data and isinstance(update_data["query"], dict):
-                        s["query"] = update_data["query"]
-                    updated = True
-                    updated_search = s
-                    break
-            if updated:
-                set_redis_key(saved_searches_key, saved_searches, expire=SESSION_EXPIRE)
+            # 只讀寫這一筆搜索
+            updated_search = patch_saved_search(
+                session_id,
+                search_id,
+                lambda search: _merge_saved_search(search, update_data)
+            )
+            if updated_search is not None:
                 logger.info(f"更新 saved_search {search_id} in {session_id}")
                 return updated_search
             return {}
@@ -724,22 +966,114 @@ def delete_saved_search(session_id: str, search_id: int) -> bool:
         是否成功刪除
     """
     try:
-        lock = get_session_lock(session_id)
-        with lock:
+        with session_locks.lock(session_id):
             if get_session(session_id) is None:
                 return False
-            saved_searches_key = f"saved_searches:{session_id}"
-            saved_searches = get_redis_key(saved_searches_key, default=[])
-            filtered_searches = [s for s in saved_searches if s["id"] != search_id]
-            if len(filtered_searches) == len(saved_searches):
+            if not remove_saved_search(session_id, search_id):
                 return False
-            set_redis_key(saved_searches_key, filtered_searches, expire=SESSION_EXPIRE)
             logger.info(f"刪除搜索 {search_id} in {session_id}")
             return True
     except Exception as e:
         logger.error(f"刪除搜索時出錯: {str(e)} | redis_alive={is_redis_alive()}")
         return False
 
+def update_saved_search_order(session_id: str, search_ids: List[Any]) -> Optional[List[int]]:
+    """依 search_ids 的順序重新排序已保存的搜索 (只改排序，不重寫搜索)，出錯時返回 None"""
+    try:
+        with session_locks.lock(session_id):
+            if get_session(session_id) is None:
+                return None
+            order = reorder_saved_searches(session_id, [i for i in search_ids if isinstance(i, int)])
+        logger.info(f"重新排序 saved_search in {session_id}: {order}")
+        return order
+    except Exception as e:
+        logger.error(f"重新排序 saved_search 時出錯: {str(e)} | redis_alive={is_redis_alive()}")
+        return None
+
+
+def batch_messages(session_id: str, operations: List[Any]) -> Optional[List[Dict[str, Any]]]:
+    """批次新增、更新、刪除訊息 (一個 Redis transaction)，返回每個操作的結果，出錯時返回 None"""
+    try:
+        with session_locks.lock(session_id):
+            if get_session(session_id) is None:
+                return None
+            results = apply_message_batch(session_id, operations)
+        for op, result in zip(operations, results):
+            if result["success"] and result["op"] in ("update", "delete"):
+                invalidate_digest(session_id, op["search_id"], op["id"])
+        succeeded = sum(1 for result in results if result["success"])
+        logger.info(f"批次處理訊息 in {session_id}: {succeeded}/{len(results)} 成功")
+        return results
+    except Exception as e:
+        logger.error(f"批次處理訊息時出錯: {str(e)} | redis_alive={is_redis_alive()}")
+        return None
+
+
+def _saved_search_operation_error(op: Any) -> Optional[str]:
+    """批次操作的格式檢查，返回錯誤訊息 (格式正確時為 None)"""
+    if not isinstance(op, dict):
+        return "操作必須是物件"
+    if op.get("op") not in ("create", "update", "delete"):
+        return f"不支援的操作: {op.get('op')}"
+    if op["op"] in ("update", "delete") and not isinstance(op.get("id"), int):
+        return "缺少搜索 id"
+    return None
+
+
+def batch_saved_searches(session_id: str, operations: List[Any]) -> Optional[List[Dict[str, Any]]]:
+    """批次新增、更新、刪除已保存的搜索，返回每個操作的結果，出錯時返回 None
+
+    operations 的每一項為 {"op": "create", ...搜索欄位}、{"op": "update", "id": int, ...要更新的欄位}
+    或 {"op": "delete", "id": int}，依序套用；例如重新排序即多個只帶 order 的 update。
+    只寫入有變動的搜索，WATCH 確保其他請求同時修改時整批重算。
+    """
+    try:
+        with session_locks.lock(session_id):
+            if get_session(session_id) is None:
+                return None
+            results = apply_saved_search_changes(
+                session_id,
+                lambda searches, allocate_id: _apply_saved_search_operations(searches, operations, allocate_id)
+            )
+        succeeded = sum(1 for result in results if result["success"])
+        logger.info(f"批次處理 saved_search in {session_id}: {succeeded}/{len(results)} 成功")
+        return results
+    except Exception as e:
+        logger.error(f"批次處理 saved_search 時出錯: {str(e)} | redis_alive={is_redis_alive()}")
+        return None
+
+
+def _apply_saved_search_operations(
+    saved_searches: List[Dict[str, Any]],
+    operations: List[Any],
+    allocate_id: Callable[[], int]
+) -> List[Dict[str, Any]]:
+    """依序把 operations 套用到 saved_searches (直接修改列表)，allocate_id() 分配新搜索的 ID"""
+    results = []
+    for i, op in enumerate(operations):
+        error = _saved_search_operation_error(op)
+        if error is not None:
+            results.append({"index": i, "op": op.get("op") if isinstance(op, dict) else None, "success": False, "error": error})
+            continue
+        kind = op["op"]
+        if kind == "create":
+            order = max([s.get("order", 0) for s in saved_searches], default=0) + 1
+            record = _saved_search_record(allocate_id(), order, op)
+            saved_searches.append(record)
+            results.append({"index": i, "op": kind, "success": True, "search": copy.deepcopy(record)})
+            continue
+        position = next((j for j, s in enumerate(saved_searches) if s.get("id") == op["id"]), None)
+        if position is None:
+            results.append({"index": i, "op": kind, "success": False, "error": "搜索不存在"})
+        elif kind == "update":
+            _merge_saved_search(saved_searches[position], op)
+            results.append({"index": i, "op": kind, "success": True, "search": copy.deepcopy(saved_searches[position])})
+        else:
+            del saved_searches[position]
+            results.append({"index": i, "op": kind, "success": True})
+    return results
+
+
 def is_redis_alive() -> bool:
     try:
         r = get_redis_connection()
@@ -0,0 +1,125 @@
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from .redis import get_redis_connection, release_lock
+from .metrics import metrics
+from .utils import logger
+from .settings import SESSION_LOCK_LEASE, SESSION_LOCK_TIMEOUT, SESSION_LOCK_RETRY_INTERVAL
+
+
+class SessionLockTimeout(Exception):
+    """等待 session 鎖逾時"""
+
+
+class _LocalLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 持有或等待中的 thread 數，歸零時從表格移除
+        self.users = 0
+
+
+class SessionLockManager:
+    """跨 worker 的 session 鎖
+
+    - 同一個 worker 內先以 threading.Lock 排隊，只有排到的 thread 才向 Redis 取鎖
+    - 以 Redis 租約鎖 (SET NX PX + 隨機 token) 與其他 worker、其他機器互斥；
+      持有者中止時租約過期即自動釋放，不會永久鎖住 session
+    - 釋放時以 Lua script 比對 token 後才刪除 (compare-and-delete)，不會刪到租約過期後
+      其他 worker 取得的鎖
+    - 本地的鎖在沒有人持有或等待時立即移除，表格大小只與處理中的 session 數有關
+    Redis 無法使用時退回只有本地鎖 (與過去的行為相同)。
+    等待鎖時會阻塞目前的 thread，async 路由必須以 run_in_threadpool 呼叫持有鎖的函數。
+    """
+
+    def __init__(
+        self,
+        lease: float = SESSION_LOCK_LEASE,
+        timeout: float = SESSION_LOCK_TIMEOUT,
+        retry_interval: float = SESSION_LOCK_RETRY_INTERVAL
+    ):
+        self.lease = lease
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._locks: Dict[str, _LocalLock] = {}
+        self._table_lock = threading.Lock()
+
+    @staticmethod
+    def lock_key(session_id: str) -> str:
+        return f"session_lock:{session_id}"
+
+    @contextmanager
+    def lock(self, session_id: str) -> Iterator[None]:
+        """持有 session 鎖執行 with 區塊，timeout 秒內取不到時拋出 SessionLockTimeout"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        local = self._checkout(session_id)
+        try:
+            if not local.lock.acquire(timeout=self.timeout):
+                raise SessionLockTimeout(f"等待 session {session_id} 的鎖逾時")
+            try:
+                token = self._acquire(session_id, deadline)
+                metrics.observe("session_lock_wait_seconds", time.monotonic() - start)
+                try:
+                    yield
+                finally:
+                    if token is not None:
+                        self._release(session_id, token)
+            finally:
+                local.lock.release()
+        finally:
+            self._checkin(session_id, local)
+
+    def _checkout(self, session_id: str) -> _LocalLock:
+        with self._table_lock:
+            local = self._locks.get(session_id)
+            if local is None:
+                local = self._locks[session_id] = _LocalLock()
+            local.users += 1
+            return local
+
+    def _checkin(self, session_id: str, local: _LocalLock) -> None:
+        with self._table_lock:
+            local.users -= 1
+            if local.users == 0 and self._locks.get(session_id) is local:
+                del self._locks[session_id]
+
+    def _acquire(self, session_id: str, deadline: float) -> Optional[str]:
+        """取得 Redis 租約鎖，返回 token；Redis 出錯時返回 None (只靠本地鎖)"""
+        key = self.lock_key(session_id)
+        token = uuid.uuid4().hex
+        try:
+            r = get_redis_connection()
+            while not r.set(key, token, nx=True, px=int(self.lease * 1000)):
+                if time.monotonic() >= deadline:
+                    raise SessionLockTimeout(f"等待 session {session_id} 的鎖逾時 (其他 worker 持有)")
+                # 加上少量隨機延遲，避免多個 worker 同時重試
+                time.sleep(self.retry_interval * (1 + random.random()))
+            return token
+        except SessionLockTimeout:
+            raise
+        except Exception as e:
+            logger.error(f"取得 session {session_id} 的 Redis 鎖時出錯，只使用本地鎖: {str(e)}")
+            return None
+
+    def _release(self, session_id: str, token: str) -> None:
+        """token 相同時才刪除鎖"""
+        try:
+            if not release_lock(get_redis_connection(), self.lock_key(session_id), token):
+                logger.warning(f"session {session_id} 的鎖租約已過期，可能已被其他 worker 取得")
+        except Exception as e:
+            # 釋放失敗時鎖會在租約到期後自動釋放
+            logger.error(f"釋放 session {session_id} 的 Redis 鎖時出錯: {str(e)}")
+
+    def __len__(self) -> int:
+        """目前本地表格中的 session 數 (處理中或等待中)"""
+        with self._table_lock:
+            return len(self._locks)
+
+
+session_locks = SessionLockManager()
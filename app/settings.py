@@ -10,12 +10,104 @@ REDIS_PASSWORD = os.environ.get("ST_LLM_REDIS_PASSWORD", None)
 GEMINI_MODEL = os.environ.get("ST_LLM_GEMINI_MODEL", "gemini-2.0-flash")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 
+# LLM 後端設定 (gemini: Google Gemini, stub: 本地假後端，供測試與壓測)
+LLM_BACKEND = os.environ.get("ST_LLM_BACKEND", "gemini").lower()
+LLM_STUB_LATENCY_DISTRIBUTION = os.environ.get("ST_LLM_STUB_LATENCY_DISTRIBUTION", "lognormal").lower()  # fixed, uniform, normal, lognormal
+LLM_STUB_LATENCY_MS = float(os.environ.get("ST_LLM_STUB_LATENCY_MS", "800"))  # 首個 token 延遲 (lognormal 時為中位數)
+LLM_STUB_LATENCY_JITTER = float(os.environ.get("ST_LLM_STUB_LATENCY_JITTER", "0.5"))
+LLM_STUB_TOKENS_PER_SECOND = float(os.environ.get("ST_LLM_STUB_TOKENS_PER_SECOND", "100"))  # 0 表示不模擬輸出時間
+LLM_STUB_OUTPUT_TOKENS = int(os.environ.get("ST_LLM_STUB_OUTPUT_TOKENS", "200"))
+LLM_STUB_STREAM_CHUNK_TOKENS = int(os.environ.get("ST_LLM_STUB_STREAM_CHUNK_TOKENS", "20"))
+LLM_STUB_FAILURE_RATE = float(os.environ.get("ST_LLM_STUB_FAILURE_RATE", "0"))
+LLM_STUB_SEED = int(os.environ.get("ST_LLM_STUB_SEED", "42"))
+
 # 日誌設定
 LOG_DIR = "/tmp/st_llm_search_engine"
 LOG_MAX_SIZE = 10 * 1024 * 1024  # 10MB
 LOG_BACKUP_COUNT = 10
 LOG_LEVEL = os.environ.get("ST_LLM_LOG_LEVEL", "info").lower()
+LOG_FORMAT = os.environ.get("ST_LLM_LOG_FORMAT", "json").lower()  # json: 一行一筆 JSON, text: 純文字
+LOG_QUEUE_SIZE = 10000  # 背景寫入佇列的上限，滿了就丟棄日誌，不阻塞請求
+LOG_RATE_LIMIT_PER_SECOND = float(os.environ.get("ST_LLM_LOG_RATE_LIMIT_PER_SECOND", "10"))  # 同一行 debug 日誌每秒上限，0 表示不限制
+LOG_RATE_LIMIT_BURST = 20
 
 # Session 相關設定
 SESSION_EXPIRE = 60 * 60 * 24       # Session 過期時間 (1天)
+MESSAGE_MAX_PAGE_SIZE = 100         # 訊息分頁每頁上限
+MESSAGE_STREAM_HEARTBEAT = float(os.environ.get("ST_LLM_MESSAGE_STREAM_HEARTBEAT", "15"))  # SSE 沒有事件時的 keepalive 間隔 (秒)
+MESSAGE_LONG_POLL_TIMEOUT = 25      # long-poll 最長等待秒數
+BATCH_MAX_OPERATIONS = int(os.environ.get("ST_LLM_BATCH_MAX_OPERATIONS", "500"))  # 批次 API 每次最多幾個操作
+SESSION_LOCK_LEASE = float(os.environ.get("ST_LLM_SESSION_LOCK_LEASE", "10"))  # session 鎖的 Redis 租約 (秒)，持有者中止時最多鎖住這麼久
+SESSION_LOCK_TIMEOUT = float(os.environ.get("ST_LLM_SESSION_LOCK_TIMEOUT", "10"))  # 等待 session 鎖的上限 (秒)
+SESSION_LOCK_RETRY_INTERVAL = 0.02  # 其他 worker 持有鎖時的重試間隔 (秒)
+
+
+# Prompt 模板設定
+PROMPT_DIR = os.environ.get("ST_LLM_PROMPT_DIR", os.path.dirname(os.path.abspath(__file__)))
+PROMPT_RELOAD_INTERVAL = float(os.environ.get("ST_LLM_PROMPT_RELOAD_INTERVAL", "5"))  # 最多每 5 秒檢查一次檔案變動
+
+# LLM 回應緩存設定
+LLM_CACHE_ENABLED = os.environ.get("ST_LLM_LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL = int(os.environ.get("ST_LLM_LLM_CACHE_TTL", str(60 * 60)))  # 1 小時
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("ST_LLM_LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("ST_LLM_LLM_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))  # 256KB
+
+# LLM 資料上下文設定
+LLM_CONTEXT_TOKEN_BUDGET = int(os.environ.get("ST_LLM_CONTEXT_TOKEN_BUDGET", "30000"))
+LLM_CONTEXT_CONTENT_CHARS = int(os.environ.get("ST_LLM_CONTEXT_CONTENT_CHARS", "200"))  # 每篇貼文內容最多字數
+LLM_CONTEXT_SHORT_CONTENT_CHARS = int(os.environ.get("ST_LLM_CONTEXT_SHORT_CONTENT_CHARS", "40"))  # 預算不足時的截短字數
+LLM_CONTEXT_SHARE_WEIGHT = float(os.environ.get("ST_LLM_CONTEXT_SHARE_WEIGHT", "2.0"))  # 分享數相對互動數的權重
+LLM_CONTEXT_RECENCY_WEIGHT = float(os.environ.get("ST_LLM_CONTEXT_RECENCY_WEIGHT", "0.3"))
+LLM_CONTEXT_RECENCY_HALF_LIFE_HOURS = float(os.environ.get("ST_LLM_CONTEXT_RECENCY_HALF_LIFE_HOURS", "24"))
+KOL_DATA_ROW_CONTENT_CHARS = 500  # kol_data_rows 中每篇貼文內容最多保留字數
+KOL_DATA_MAX_PAGE_SIZE = int(os.environ.get("ST_LLM_KOL_DATA_MAX_PAGE_SIZE", "200"))  # /kol-data 分頁每頁上限
+
+# 關鍵字查詢的相關度排序 (BM25 + 互動數/發文時間加權)
+KOL_SEARCH_BM25_K1 = float(os.environ.get("ST_LLM_KOL_SEARCH_BM25_K1", "1.2"))
+KOL_SEARCH_BM25_B = float(os.environ.get("ST_LLM_KOL_SEARCH_BM25_B", "0.75"))
+KOL_SEARCH_ENGAGEMENT_WEIGHT = float(os.environ.get("ST_LLM_KOL_SEARCH_ENGAGEMENT_WEIGHT", "0.3"))
+KOL_SEARCH_RECENCY_WEIGHT = float(os.environ.get("ST_LLM_KOL_SEARCH_RECENCY_WEIGHT", "0.2"))
+KOL_SEARCH_RECENCY_HALF_LIFE_HOURS = float(os.environ.get("ST_LLM_KOL_SEARCH_RECENCY_HALF_LIFE_HOURS", "72"))
+KOL_SEARCH_TOP_K = int(os.environ.get("ST_LLM_KOL_SEARCH_TOP_K", "0"))  # 只保留最相關的 K 篇，0 為不限
+
+# 互動排行榜 (/api/redis/kol-leaderboard)
+LEADERBOARD_DEFAULT_K = 10
+LEADERBOARD_MAX_K = int(os.environ.get("ST_LLM_LEADERBOARD_MAX_K", "100"))  # 也是預先計算的名次數
+
+# LLM context cache 設定 (由 LLM 後端提供，gemini 使用 explicit context caching)
+LLM_CONTEXT_CACHE_ENABLED = os.environ.get("ST_LLM_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+LLM_CONTEXT_CACHE_TTL = int(os.environ.get("ST_LLM_CONTEXT_CACHE_TTL", str(10 * 60)))  # 與 kol_data_md 相同，10 分鐘
+LLM_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("ST_LLM_CONTEXT_CACHE_MIN_TOKENS", "4096"))  # 資料太小時不建立 cache
+
+# 對話紀錄壓縮設定
+HISTORY_RECENT_MESSAGES = int(os.environ.get("ST_LLM_HISTORY_RECENT_MESSAGES", "10"))  # 原樣保留的最近訊息數
+HISTORY_DIGEST_MAX_CHARS = int(os.environ.get("ST_LLM_HISTORY_DIGEST_MAX_CHARS", "4000"))  # 較早訊息節錄的總字數上限
+HISTORY_DIGEST_LINE_CHARS = 200  # 節錄中每則訊息保留的字數
+HISTORY_TABLE_MIN_CHARS = 1000  # 超過此長度的 Markdown 表格訊息會換成引用
+
+# 相同 LLM 請求合併設定
+LLM_COALESCE_ENABLED = os.environ.get("ST_LLM_LLM_COALESCE_ENABLED", "true").lower() == "true"
+LLM_COALESCE_LEASE = int(os.environ.get("ST_LLM_LLM_COALESCE_LEASE", "120"))  # leader 鎖的租期 (秒)，也是等待上限
+LLM_COALESCE_POLL_INTERVAL = 0.05  # 其他 worker 輪詢結果的間隔 (秒)
+LLM_COALESCE_RESULT_TTL = 30  # leader 結果保留時間 (秒)
+
+# sheet:* key 的 worker 本地快取 (值與版本戳記存在 Redis，跨 worker 以 pub/sub 通知失效)
+SHARED_CACHE_ENABLED = os.environ.get("ST_LLM_SHARED_CACHE_ENABLED", "true").lower() == "true"
+SHARED_CACHE_MAX_BYTES = int(os.environ.get("ST_LLM_SHARED_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64MB (以 JSON 長度估計)
+SHARED_CACHE_TTL = float(os.environ.get("ST_LLM_SHARED_CACHE_TTL", "300"))  # 本地副本最長保留時間 (秒)
+SHARED_CACHE_VALIDATE_INTERVAL = float(os.environ.get("ST_LLM_SHARED_CACHE_VALIDATE_INTERVAL", "5"))  # 訂閱失效通知時，本地副本比對版本戳記的間隔 (秒)
+
+# 指標 (/metrics) 設定
+METRICS_ENABLED = os.environ.get("ST_LLM_METRICS_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_INTERVAL = float(os.environ.get("ST_LLM_METRICS_FLUSH_INTERVAL", "15"))  # 每個 worker 寫入快照的間隔 (秒)
+METRICS_WORKER_TTL = int(os.environ.get("ST_LLM_METRICS_WORKER_TTL", "120"))  # worker 停止回報後快照保留時間 (秒)
+
+# 請求分析 (cProfile) 設定，關閉時不安裝 middleware
+PROFILING_ENABLED = os.environ.get("ST_LLM_PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_SAMPLE_RATE = float(os.environ.get("ST_LLM_PROFILING_SAMPLE_RATE", "0"))  # 隨機抽樣比例 (0~1)
+PROFILING_TOKEN = os.environ.get("ST_LLM_PROFILING_TOKEN", "")  # X-Profile header 的值，也用來保護查詢 API
+PROFILING_MAX_PROFILES = int(os.environ.get("ST_LLM_PROFILING_MAX_PROFILES", "50"))
+PROFILING_TTL = 24 * 60 * 60  # 保留 1 天
 
+# Server-Timing header (各處理階段的時間)，供前端在 devtools 查看
+SERVER_TIMING_ENABLED = os.environ.get("ST_LLM_SERVER_TIMING_ENABLED", "false").lower() == "true"
@@ -0,0 +1,289 @@
+import json
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import orjson
+
+from .redis import get_redis_connection, get_async_redis_connection, _record_payload
+from .metrics import metrics, add_timing
+from .utils import logger
+from .settings import (
+    SHARED_CACHE_ENABLED,
+    SHARED_CACHE_MAX_BYTES,
+    SHARED_CACHE_TTL,
+    SHARED_CACHE_VALIDATE_INTERVAL,
+)
+
+# 各 worker 共用、內容很少變動的 key (由 SheetManager 從 Google Sheet 更新)
+SHARED_KEYS = ("sheet:kol_info", "sheet:kol_data", "sheet:saved_searches")
+# 值更新時通知其他 worker 丟棄本地副本的 channel
+INVALIDATION_CHANNEL = "shared_cache:invalidate"
+# 訂閱中斷後重新連線的間隔 (秒)
+_RECONNECT_INTERVAL = 5
+
+
+def version_key(key: str) -> str:
+    """值的版本戳記 (每次寫入時換新的 uuid，與值同時過期)"""
+    return f"{key}:version"
+
+
+class _Entry:
+    __slots__ = ("value", "raw", "version", "size", "derived", "loaded_at", "validated_at")
+
+    def __init__(self, value: Any, raw: str, version: str, now: float):
+        self.value = value
+        self.raw = raw
+        self.version = version
+        # 解析後的值與原始 JSON 各算一份
+        self.size = 2 * len(raw)
+        # 由值衍生的結果 (例如已編碼的回應)，與副本同時失效
+        self.derived: Dict[str, Any] = {}
+        self.loaded_at = now
+        self.validated_at = now
+
+
+# key 不存在
+_MISSING = object()
+
+
+class SharedKeyCache:
+    """sheet:* key 的 worker 本地快取 (L1，Redis 為 L2)
+
+    - 以 LRU 限制總大小 (以 JSON 長度估計)，超過上限的值不放入本地
+    - 訂閱 INVALIDATION_CHANNEL 時，每 validate_interval 秒才比對一次 Redis 的版本戳記；
+      訂閱中斷時每次讀取都比對 (一次 GET 很小的 key，不必傳輸整個 JSON)
+    - 不論是否驗證過，超過 ttl 秒的值一律重新讀取
+    版本戳記不存在 (例如值不是經由 set 寫入) 時不放入本地，直接讀 Redis。
+    返回的值由同一個 worker 的所有請求共用，呼叫端不可修改。
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SHARED_CACHE_ENABLED,
+        max_bytes: int = SHARED_CACHE_MAX_BYTES,
+        ttl: float = SHARED_CACHE_TTL,
+        validate_interval: float = SHARED_CACHE_VALIDATE_INTERVAL,
+    ):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.validate_interval = validate_interval
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # 是否正在接收其他 worker 的失效通知
+        self.listening = False
+
+    def _record(self, key: str, result: str) -> None:
+        metrics.inc("shared_cache_requests_total", key=key, result=result)
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry.loaded_at >= self.ttl:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            logger.debug(f"本地快取超過上限，移除 {oldest}")
+
+    def _store(self, key: str, value: Any, raw: str, version: str) -> Optional[_Entry]:
+        entry = _Entry(value, raw, version, time.monotonic())
+        if entry.size > self.max_bytes:
+            return None
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._evict()
+        return entry
+
+    def _current(self, key: str) -> Tuple[Optional[_Entry], Any, Optional[str]]:
+        """(本地副本, 值, 原始 JSON)；沒有放入本地時副本為 None，key 不存在時值為 _MISSING"""
+        if not self.enabled:
+            return self._fetch(key, store=False)
+
+        entry = self._lookup(key)
+        if entry is not None:
+            now = time.monotonic()
+            if self.listening and now - entry.validated_at < self.validate_interval:
+                self._record(key, "hit")
+                return entry, entry.value, entry.raw
+            start = time.perf_counter()
+            try:
+                current = get_redis_connection().get(version_key(key))
+            except Exception as e:
+                logger.error(f"讀取 {key} 版本時出錯: {str(e)}")
+                current = None
+            add_timing("redis_fetch", time.perf_counter() - start)
+            if current is not None and current == entry.version:
+                entry.validated_at = now
+                self._record(key, "validated")
+                return entry, entry.value, entry.raw
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+
+        self._record(key, "miss")
+        return self._fetch(key, store=True)
+
+    def _fetch(self, key: str, store: bool) -> Tuple[Optional[_Entry], Any, Optional[str]]:
+        start = time.perf_counter()
+        try:
+            # 值與版本戳記在同一個 transaction 中讀取，兩者一定一致
+            with get_redis_connection().pipeline() as pipe:
+                pipe.get(key)
+                pipe.get(version_key(key))
+                raw, version = pipe.execute()
+        except Exception as e:
+            metrics.inc("redis_helper_errors_total", helper="shared_cache_get")
+            logger.error(f"獲取 Redis 鍵 {key} 時出錯: {str(e)}")
+            return None, _MISSING, None
+        fetched = time.perf_counter()
+        add_timing("redis_fetch", fetched - start)
+        if raw is None:
+            return None, _MISSING, None
+        _record_payload(key, "get", raw)
+        try:
+            value = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # 不是 JSON 的字串值，原始 JSON 改為編碼後的字串
+            value, raw = raw, json.dumps(raw)
+        add_timing("json_decode", time.perf_counter() - fetched)
+        entry = None
+        if store and version is not None:
+            entry = self._store(key, value, raw, version)
+        return entry, value, raw
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """讀取 key：本地副本有效時直接返回，否則從 Redis 讀取值與版本戳記"""
+        _, value, _ = self._current(key)
+        return default if value is _MISSING else value
+
+    def get_raw(self, key: str) -> Optional[str]:
+        """讀取 key 的原始 JSON (回應直接輸出，不必重新編碼)，key 不存在時返回 None"""
+        _, _, raw = self._current(key)
+        return raw
+
+    def derive(self, key: str, name: str, build: Callable[[Any], Any]) -> Any:
+        """以 key 的值計算 build(值)，結果與本地副本一起保留到副本失效
+
+        key 不存在時返回 None。結果為 bytes/str 時計入快取大小。
+        """
+        entry, value, _ = self._current(key)
+        if value is _MISSING:
+            return None
+        if entry is None:
+            return build(value)
+        with self._lock:
+            if name in entry.derived:
+                return entry.derived[name]
+        result = build(value)
+        with self._lock:
+            if self._entries.get(key) is entry and name not in entry.derived:
+                entry.derived[name] = result
+                if isinstance(result, (bytes, str)):
+                    entry.size += len(result)
+                    self._bytes += len(result)
+                    self._evict()
+        return result
+
+    def set(self, key: str, value: Any, expire: Optional[int] = None) -> Optional[str]:
+        """寫入值與新的版本戳記並通知其他 worker，同時更新本地副本
+
+        Returns:
+            新的版本戳記，寫入失敗時為 None
+        """
+        start = time.perf_counter()
+        raw = json.dumps(value)
+        version = uuid.uuid4().hex
+        encoded = time.perf_counter()
+        add_timing("json_encode", encoded - start)
+        try:
+            with get_redis_connection().pipeline() as pipe:
+                pipe.set(key, raw, ex=expire)
+                pipe.set(version_key(key), version, ex=expire)
+                pipe.publish(INVALIDATION_CHANNEL, json.dumps({"key": key, "version": version}))
+                pipe.execute()
+        except Exception as e:
+            metrics.inc("redis_helper_errors_total", helper="shared_cache_set")
+            logger.error(f"設置 Redis 鍵 {key} 時出錯: {str(e)}")
+            self.invalidate(key)
+            return None
+        add_timing("redis_write", time.perf_counter() - encoded)
+        _record_payload(key, "set", raw)
+        if self.enabled:
+            self._store(key, value, raw, version)
+        return version
+
+    def invalidate(self, key: Optional[str] = None, version: Optional[str] = None) -> None:
+        """丟棄本地副本 (key 為 None 時全部)；version 與本地相同時 (本 worker 寫入的) 保留"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            entry = self._entries.get(key)
+            if entry is not None and (version is None or entry.version != version):
+                self._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "listening": self.listening,
+            }
+
+    async def listen(self) -> None:
+        """背景工作：接收其他 worker 的失效通知，中斷時重新訂閱"""
+        while True:
+            r = get_async_redis_connection()
+            pubsub = r.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # 訂閱前可能錯過的更新，重新訂閱後全部重新驗證
+                self.invalidate()
+                self.listening = True
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None or message.get("type") != "message":
+                        continue
+                    try:
+                        payload = json.loads(message["data"])
+                        self.invalidate(payload.get("key"), payload.get("version"))
+                    except (json.JSONDecodeError, TypeError, AttributeError):
+                        self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"本地快取失效通知訂閱中斷: {str(e)}")
+            finally:
+                self.listening = False
+                try:
+                    await pubsub.aclose()
+                    await r.aclose()
+                except Exception as e:
+                    logger.debug(f"關閉失效通知訂閱時出錯: {str(e)}")
+            await asyncio.sleep(_RECONNECT_INTERVAL)
+
+
+shared_cache = SharedKeyCache()
@@ -1,7 +1,8 @@
 import os
 import json
+import time
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 import contextlib
 import gspread
 from google.oauth2 import service_account
@@ -9,15 +10,14 @@ import configparser
 
 # API 相關庫
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse
 import traceback
 
 # 從設定模組導入相關設定
 from .utils import get_logger
-from .redis import (
-    set_redis_key,
-    get_redis_key
-)
+from .metrics import metrics
+from .redis import set_redis_key
+from .shared_cache import shared_cache
+from .responses import JSONResponse, RawJSONResponse, json_object
 
 # 設置緩存過期時間
 SAVED_SEARCH_EXPIRY = 15 * 60  # 15 分鐘
@@ -60,17 +60,50 @@ class SheetConnector:
 
     def get_data(self) -> List[Dict[str, Any]]:
         """獲取工作表數據並轉換為字典列表"""
-        if not self._client:
-            if not self.connect():
-                return []
-
+        start = time.perf_counter()
         try:
-            sheet = self._client.open_by_key(self.sheet_id).worksheet(self.tab_name)
-            data = sheet.get_all_records()
-            return data
+            data = self._fetch()
         except Exception as e:
             logger.error(f"獲取 Sheet 數據失敗：{str(e)}")
+            data = None
+        metrics.observe("sheet_fetch_duration_seconds", time.perf_counter() - start, tab=self.tab_name)
+        if data is None:
+            metrics.inc("sheet_fetch_errors_total", tab=self.tab_name)
             return []
+        metrics.observe("sheet_fetch_rows", len(data), tab=self.tab_name)
+        return data
+
+    def _fetch(self) -> Optional[List[Dict[str, Any]]]:
+        """從 Google Sheet 讀取資料，無法連接時返回 None"""
+        if not self._client:
+            if not self.connect():
+                return None
+
+        sheet = self._client.open_by_key(self.sheet_id).worksheet(self.tab_name)
+        return sheet.get_all_records()
+
+
+class LocalSheetConnector(SheetConnector):
+    """本地 Google Sheet 替身 (測試、壓測使用)
+
+    get_data 返回預先給定的資料列 (格式與 get_all_records 相同)，
+    可模擬 Google Sheet API 的延遲，不需要網路與認證文件。
+    """
+
+    def __init__(self, records: List[Dict[str, Any]], tab_name: str = "local", latency: float = 0.0):
+        super().__init__("local", tab_name, "")
+        self.records = records
+        self.latency = latency
+        self.call_count = 0
+
+    def connect(self) -> bool:
+        return True
+
+    def _fetch(self) -> List[Dict[str, Any]]:
+        self.call_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return [dict(record) for record in self.records]
 
 
 class SheetManager:
@@ -105,24 +138,40 @@ class SheetManager:
     def fake_lock(*args, **kwargs):
         yield
 
+    def use_connectors(
+        self,
+        kol_info: SheetConnector = None,
+        saved_searches: SheetConnector = None,
+        kol_data: SheetConnector = None
+    ) -> None:
+        """替換資料來源 (例如 LocalSheetConnector)，未指定的維持原設定"""
+        if kol_info is not None:
+            self._kol_connector = kol_info
+        if saved_searches is not None:
+            self._saved_search_connector = saved_searches
+        if kol_data is not None:
+            self._kol_data_connector = kol_data
+
     def get_kol_data(self, force_refresh: bool = False) -> List[Dict[str, Any]]:
         """使用 Redis 緩存獲取 KOL 數據"""
         cache_key = "sheet:kol_data"
 
         if not force_refresh:
-            cached_data = get_redis_key(cache_key)
+            cached_data = shared_cache.get(cache_key)
             if cached_data:
                 if isinstance(cached_data, str):
                     cached_data = json.loads(cached_data)
                 logger.debug("使用緩存的 KOL 數據")
+                metrics.inc("sheet_cache_requests_total", sheet="kol_data", result="hit")
                 return cached_data
 
         with self.fake_lock("sheet:kol_data_lock", timeout=60):
             if not force_refresh:
-                cached_data = get_redis_key(cache_key)
+                cached_data = shared_cache.get(cache_key)
                 if cached_data:
                     if isinstance(cached_data, str):
                         cached_data = json.loads(cached_data)
+                    metrics.inc("sheet_cache_requests_total", sheet="kol_data", result="hit")
                     return cached_data
 
             if not self._kol_data_connector:
@@ -133,10 +182,17 @@ class SheetManager:
                 )
             
             logger.info("從 Google Sheet 獲取最新 KOL 數據")
+            metrics.inc("sheet_cache_requests_total", sheet="kol_data", result="refresh" if force_refresh else "miss")
             data = self._kol_data_connector.get_data()
 
             # 更新緩存
-            set_redis_key(cache_key, data, KOL_DATA_EXPIRY)
+            version = shared_cache.set(cache_key, data, KOL_DATA_EXPIRY)
+
+            # 直接以這份資料建立本 worker 的索引，其他 worker 依版本戳記自行重建
+            if data and version is not None:
+                # 使用延遲導入避免循環導入
+                from .kol_index import rebuild_kol_index
+                rebuild_kol_index(data, version)
 
             return data
 
@@ -145,19 +201,21 @@ class SheetManager:
         cache_key = "sheet:kol_info"
 
         if not force_refresh:
-            cached_data = get_redis_key(cache_key)
+            cached_data = shared_cache.get(cache_key)
             if cached_data:
                 if isinstance(cached_data, str):
                     cached_data = json.loads(cached_data)
                 logger.debug("使用緩存的 KOL 信息")
+                metrics.inc("sheet_cache_requests_total", sheet="kol_info", result="hit")
                 return cached_data
 
         with self.fake_lock("sheet:kol_info_lock", timeout=30):
             if not force_refresh:
-                cached_data = get_redis_key(cache_key)
+                cached_data = shared_cache.get(cache_key)
                 if cached_data:
                     if isinstance(cached_data, str):
                         cached_data = json.loads(cached_data)
+                    metrics.inc("sheet_cache_requests_total", sheet="kol_info", result="hit")
                     return cached_data
 
             if not self._kol_connector:
@@ -167,6 +225,7 @@ class SheetManager:
                 )
 
             logger.info("從 Google Sheet 獲取最新 KOL 信息")
+            metrics.inc("sheet_cache_requests_total", sheet="kol_info", result="refresh" if force_refresh else "miss")
             data = self._kol_connector.get_data()
 
             # 標準化欄位
@@ -188,7 +247,7 @@ class SheetManager:
                 standardized_data.append(new_record)
 
             # 更新緩存
-            set_redis_key(cache_key, standardized_data, KOL_EXPIRY)
+            shared_cache.set(cache_key, standardized_data, KOL_EXPIRY)
 
             return standardized_data
 
@@ -197,19 +256,21 @@ class SheetManager:
         cache_key = "sheet:saved_searches"
 
         if not force_refresh:
-            cached_data = get_redis_key(cache_key)
+            cached_data = shared_cache.get(cache_key)
             if cached_data:
                 if isinstance(cached_data, str):
                     cached_data = json.loads(cached_data)
                 logger.debug("使用緩存的已保存搜索")
+                metrics.inc("sheet_cache_requests_total", sheet="saved_searches", result="hit")
                 return cached_data
 
         with self.fake_lock("sheet:saved_searches_lock", timeout=30):
             if not force_refresh:
-                cached_data = get_redis_key(cache_key)
+                cached_data = shared_cache.get(cache_key)
                 if cached_data:
                     if isinstance(cached_data, str):
                         cached_data = json.loads(cached_data)
+                    metrics.inc("sheet_cache_requests_total", sheet="saved_searches", result="hit")
                     return cached_data
 
             if not self._saved_search_connector:
@@ -219,6 +280,7 @@ class SheetManager:
                 )
 
             logger.info("從 Google Sheet 獲取最新已保存搜索")
+            metrics.inc("sheet_cache_requests_total", sheet="saved_searches", result="refresh" if force_refresh else "miss")
             raw_data = self._saved_search_connector.get_data()
 
             # 轉換數據格式
@@ -250,7 +312,7 @@ class SheetManager:
                     continue
 
             # 更新緩存
-            set_redis_key(cache_key, formatted_data, SAVED_SEARCH_EXPIRY)
+            shared_cache.set(cache_key, formatted_data, SAVED_SEARCH_EXPIRY)
 
             return formatted_data
 
@@ -478,34 +540,50 @@ sheet_manager = SheetManager()
 #         logger.error(f"篩選KOL數據時出錯: {str(e)}")
 #         return JSONResponse({"error": str(e)}, status_code=500)
 
-@router.get("/kol-list")
-async def get_kol_list():
-    """獲取所有 KOL 的列表"""
-    try:
-        # 獲取 KOL 數據
-        kol_data = sheet_manager.get_kol_info()
+def _kol_list_body(kol_data: List[Dict[str, Any]]) -> Optional[bytes]:
+    """/kol-list 的回應內容 (已編碼)，沒有資料時返回 None"""
+    if not kol_data:
+        return None
+
+    # 提取需要的欄位
+    result = []
+    for kol in kol_data:
+        kol_id = kol.get('kol_id')
+        if not kol_id:
+            continue
+
+        # 構建基本數據
+        kol_info = {
+            "kol_id": kol_id,
+            "kol_name": kol.get('kol_name', kol.get('KOL', kol_id)),
+            "url": kol.get('url', '')
+        }
 
-        # 提取需要的欄位
-        result = []
-        for kol in kol_data:
-            kol_id = kol.get('kol_id')
-            if not kol_id:
-                continue
+        # 添加標籤
+        if 'tag' in kol:
+            kol_info['tag'] = kol['tag']
 
-            # 構建基本數據
-            kol_info = {
-                "kol_id": kol_id,
-                "kol_name": kol.get('kol_name', kol.get('KOL', kol_id)),
-                "url": kol.get('url', '')
-            }
+        result.append(kol_info)
 
-            # 添加標籤
-            if 'tag' in kol:
-                kol_info['tag'] = kol['tag']
+    return json_object(kols=result, total=len(result))
 
-            result.append(kol_info)
 
-        return JSONResponse({"kols": result, "total": len(result)})
+def _saved_searches_body(searches: List[Dict[str, Any]]) -> Optional[bytes]:
+    """/saved-searches 的回應內容 (已編碼)，沒有資料時返回 None"""
+    if not searches:
+        return None
+    return json_object(searches=searches, total=len(searches))
+
+
+@router.get("/kol-list")
+async def get_kol_list():
+    """獲取所有 KOL 的列表"""
+    try:
+        # 回應內容與本地快取的 sheet:kol_info 一起保留，資料更新前不重新組成與編碼
+        body = shared_cache.derive("sheet:kol_info", "kol_list", _kol_list_body)
+        if body is None:
+            body = _kol_list_body(sheet_manager.get_kol_info()) or json_object(kols=[], total=0)
+        return RawJSONResponse(body)
 
     except Exception as e:
         traceback.print_exc()
@@ -516,13 +594,11 @@ async def get_kol_list():
 async def get_saved_searches():
     """獲取已保存的搜索列表"""
     try:
-        # 獲取已保存搜索
-        searches = sheet_manager.get_saved_searches()
-
-        return JSONResponse({
-            "searches": searches,
-            "total": len(searches)
-        })
+        # 獲取已保存搜索 (已編碼的回應與本地快取一起保留)
+        body = shared_cache.derive("sheet:saved_searches", "saved_searches", _saved_searches_body)
+        if body is None:
+            body = _saved_searches_body(sheet_manager.get_saved_searches()) or json_object(searches=[], total=0)
+        return RawJSONResponse(body)
 
     except Exception as e:
         traceback.print_exc()
@@ -531,7 +607,7 @@ async def get_saved_searches():
 
 def get_system_saved_searches() -> list:
     """取得所有 account == '系統' 的全局 saved_searches"""
-    all_searches = get_redis_key("sheet:saved_searches", default=[])
+    all_searches = shared_cache.get("sheet:saved_searches", default=[])
     return [s for s in all_searches if s.get("account") == "系統"]
 
 
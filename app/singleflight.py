@@ -0,0 +1,138 @@
+import json
+import time
+import uuid
+import asyncio
+from typing import Any, Callable, Dict, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from .redis import get_async_redis_connection, async_release_lock
+from .utils import logger
+from .settings import (
+    LLM_COALESCE_ENABLED,
+    LLM_COALESCE_LEASE,
+    LLM_COALESCE_POLL_INTERVAL,
+    LLM_COALESCE_RESULT_TTL,
+)
+
+
+class SingleFlightError(Exception):
+    """合併呼叫的 leader 執行失敗"""
+
+
+class SingleFlight:
+    """合併相同 key 的並行呼叫，只執行一次並把結果分給所有等待者
+
+    同一個 worker 內以 asyncio.Future 合併；跨 worker 以 Redis 鎖選出 leader，
+    其他 worker 輪詢 leader 寫入的結果。fn 為同步函數，在 threadpool 中執行，
+    返回值必須可 JSON 序列化。
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        lease: int = LLM_COALESCE_LEASE,
+        poll_interval: float = LLM_COALESCE_POLL_INTERVAL,
+        result_ttl: int = LLM_COALESCE_RESULT_TTL
+    ):
+        self.namespace = namespace
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """執行或加入相同 key 的呼叫
+
+        Returns:
+            (結果, 是否共用了其他請求的呼叫)
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, shared = await self._do_distributed(key, fn)
+            future.set_result(value)
+            return value, shared
+        except Exception as e:
+            future.set_exception(e)
+            # 沒有其他等待者時避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _do_distributed(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        lock_key = f"singleflight:{self.namespace}:{key}:lock"
+        result_key = f"singleflight:{self.namespace}:{key}:result"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lease
+
+        # 等待結果時使用 asyncio 版連線，不阻塞 event loop
+        r = get_async_redis_connection()
+        try:
+            while True:
+                if await r.set(lock_key, token, nx=True, ex=self.lease):
+                    # 舊的結果不需刪除，leader 寫入時會覆蓋
+                    return await self._run_as_leader(r, fn, lock_key, result_key, token), False
+
+                # 其他 worker 正在執行，等待結果
+                while time.monotonic() < deadline:
+                    raw = await r.get(result_key)
+                    if raw is None and not await r.exists(lock_key):
+                        # leader 可能在兩次讀取之間寫入結果並釋放鎖，再確認一次結果
+                        raw = await r.get(result_key)
+                        if raw is None:
+                            # leader 已結束但沒有結果 (例如行程中止)，改由自己執行
+                            break
+                    if raw is not None:
+                        payload = json.loads(raw)
+                        if "error" in payload:
+                            raise SingleFlightError(payload["error"])
+                        return payload["value"], True
+                    await asyncio.sleep(self.poll_interval)
+                else:
+                    logger.warning(f"等待合併呼叫 {key} 逾時，改由自己執行")
+                    return await run_in_threadpool(fn), False
+        except SingleFlightError:
+            raise
+        except _LeaderError as e:
+            raise e.original
+        except Exception as e:
+            logger.error(f"合併呼叫 {key} 時 Redis 出錯，直接執行: {str(e)}")
+            return await run_in_threadpool(fn), False
+        finally:
+            await r.aclose()
+
+    async def _run_as_leader(self, r, fn, lock_key: str, result_key: str, token: str) -> Any:
+        try:
+            value = await run_in_threadpool(fn)
+        except Exception as e:
+            await self._publish(r, lock_key, result_key, token, {"error": str(e)})
+            raise _LeaderError(e)
+        await self._publish(r, lock_key, result_key, token, {"value": value})
+        return value
+
+    async def _publish(self, r, lock_key: str, result_key: str, token: str, payload: Dict[str, Any]) -> None:
+        """寫入結果並釋放鎖；失敗時等待者會在鎖過期後自行執行"""
+        try:
+            await r.set(result_key, json.dumps(payload, ensure_ascii=False), ex=self.result_ttl)
+            # 只釋放自己持有的鎖 (lease 過期後可能已被其他 leader 取得)
+            await async_release_lock(r, lock_key, token)
+        except Exception as e:
+            logger.error(f"寫入合併呼叫結果時出錯: {str(e)}")
+
+
+class _LeaderError(Exception):
+    """包裝 leader 執行 fn 時的例外，讓它不被當成 Redis 錯誤處理"""
+
+    def __init__(self, original: Exception):
+        super().__init__(str(original))
+        self.original = original
+
+
+# LLM 呼叫的全局合併器，ST_LLM_LLM_COALESCE_ENABLED=false 時為 None
+llm_singleflight = SingleFlight("llm") if LLM_COALESCE_ENABLED else None
@@ -1,9 +1,29 @@
 import os
+import re
 import sys
+import json
+import time
+import base64
+import binascii
+import uuid
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-
-from .settings import LOG_DIR, LOG_MAX_SIZE, LOG_BACKUP_COUNT, LOG_LEVEL
+import threading
+import contextvars
+from typing import Any, Dict, Optional
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+from .settings import (
+    LOG_DIR,
+    LOG_MAX_SIZE,
+    LOG_BACKUP_COUNT,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    LOG_RATE_LIMIT_PER_SECOND,
+    LOG_RATE_LIMIT_BURST,
+)
 
 # 確保日誌目錄存在
 os.makedirs(LOG_DIR, exist_ok=True)
@@ -11,6 +31,8 @@ os.makedirs(LOG_DIR, exist_ok=True)
 # 設置全局日誌配置
 LOGGER_INITIALIZED = False
 LOGGERS = {}
+# 背景寫入日誌的 listener
+_LOG_LISTENER = None
 
 # 日誌級別映射
 LOG_LEVELS = {
@@ -21,13 +43,138 @@ LOG_LEVELS = {
     "critical": logging.CRITICAL,
 }
 
+# 目前請求的關聯 ID (由 RequestIdMiddleware 設定，threadpool 中也看得到)
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """在每筆日誌加上目前請求的 request_id"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """限制同一行程式碼的 debug 日誌頻率 (token bucket)
+
+    超過頻率的日誌直接丟棄，下一筆放行的日誌會註明略過了幾筆。
+    """
+
+    def __init__(self, rate: float = LOG_RATE_LIMIT_PER_SECOND, burst: int = LOG_RATE_LIMIT_BURST, level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self._lock = threading.Lock()
+        # (pathname, lineno) -> [剩餘 token, 上次補充時間, 略過數]
+        self._buckets = {}
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} (略過 {suppressed} 筆相同來源的日誌)"
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一筆 JSON 的結構化日誌"""
+
+    def format(self, record):
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+    """佇列滿時丟棄日誌，而不是阻塞請求"""
+
+    def prepare(self, record):
+        # 在請求的執行緒中先組好訊息 (參數可能之後會被修改)，例外保留為 exc_text 讓 formatter 各自處理
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class RequestIdMiddleware:
+    """為每個請求設定 request_id (沿用 X-Request-ID header 或自動產生)，並回傳在回應 header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
+
 
 def reset_logging():
     """重置所有日誌配置，停用現有 handlers
 
-    這個函數將移除所有已設定的 logging handlers，使後續設定能重新配置日誌系統。
+    這個函數將移除所有已設定的 logging handlers，並停止背景寫入執行緒，
+    使後續設定能重新配置日誌系統。
     """
-    global LOGGER_INITIALIZED
+    global LOGGER_INITIALIZED, _LOG_LISTENER
+
+    # 先把佇列中的日誌寫完
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        for handler in _LOG_LISTENER.handlers:
+            handler.close()
+        _LOG_LISTENER = None
 
     # 獲取根日誌記錄器
     root_logger = logging.getLogger()
@@ -45,13 +192,62 @@ def reset_logging():
     return True
 
 
+# 行程結束前把佇列中的日誌寫完
+atexit.register(reset_logging)
+
+
+# 每個行程的日誌檔 (含輪替的備份)：st_llm_search_engine.{pid}.log[.N]
+_LOG_FILE_PATTERN = re.compile(r"^st_llm_search_engine\.(\d+)\.log(\.\d+)?$")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # 行程存在但屬於其他使用者
+        return True
+    return True
+
+
+def _prune_stale_logs() -> list:
+    """刪除已結束的行程留下的日誌檔
+
+    日誌檔名帶 pid，重啟或 worker 被回收後舊檔案不會再被寫入或輪替；啟動時刪除
+    pid 已不存在的檔案，目錄中只保留執行中的 worker 的日誌 (每個最多 1 + LOG_BACKUP_COUNT 個檔案)。
+
+    Returns:
+        刪除的檔名
+    """
+    removed = []
+    try:
+        names = os.listdir(LOG_DIR)
+    except OSError:
+        return removed
+    for name in names:
+        match = _LOG_FILE_PATTERN.match(name)
+        if not match or _pid_alive(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(LOG_DIR, name))
+            removed.append(name)
+        except OSError:
+            # 其他 worker 同時在清理
+            pass
+    return removed
+
+
 def configure_logging(level="info"):
     """配置全局日誌系統
 
+    logger 呼叫只把日誌放進佇列 (不做 I/O)，由背景執行緒 (QueueListener)
+    寫到 console 與本行程專屬的日誌檔；佇列滿時丟棄日誌而不阻塞請求。
+
     Args:
         level: 日誌級別 (debug, info, warning, error, critical)
     """
-    global LOGGER_INITIALIZED
+    global LOGGER_INITIALIZED, _LOG_LISTENER
 
     if LOGGER_INITIALIZED:
         return
@@ -66,35 +262,43 @@ def configure_logging(level="info"):
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
 
+    if LOG_FORMAT == "json":
+        console_format = file_format = JsonFormatter()
+    else:
+        console_format = logging.Formatter(
+            "%(asctime)s [%(levelname)s] [PID:%(process)d] [%(request_id)s] %(message)s"
+        )
+        file_format = logging.Formatter(
+            "%(asctime)s [%(levelname)s] [PID:%(process)d] [%(name)s] [%(request_id)s] %(message)s"
+        )
+
     # 創建控制台處理器
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(log_level)
-    console_format = logging.Formatter(
-        "%(asctime)s [%(levelname)s] [PID:%(process)d] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S,%f"
-    )
     console_handler.setFormatter(console_format)
-    root_logger.addHandler(console_handler)
-
-    # 創建文件處理器 - 使用單一日誌檔案
-    log_file = os.path.join(LOG_DIR, "st_llm_search_engine.log")
-
-    # 清空日誌檔案 - 每次重啟時都重新開始
-    with open(log_file, "w") as f:
-        f.write("")
 
+    # 創建文件處理器 - 每個行程 (uvicorn worker) 寫自己的檔案，避免多個行程同時輪替同一個檔案；
+    # 不再於啟動時清空，舊內容由輪替機制處理，已結束的行程留下的檔案在此刪除
+    removed_logs = _prune_stale_logs()
+    log_file = os.path.join(LOG_DIR, f"st_llm_search_engine.{os.getpid()}.log")
     file_handler = RotatingFileHandler(
         log_file,
         maxBytes=LOG_MAX_SIZE,
-        backupCount=LOG_BACKUP_COUNT
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8"
     )
     file_handler.setLevel(log_level)
-    file_format = logging.Formatter(
-        "%(asctime)s [%(levelname)s] [PID:%(process)d] [%(name)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S,%f"
-    )
     file_handler.setFormatter(file_format)
-    root_logger.addHandler(file_handler)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.setLevel(log_level)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(RateLimitFilter())
+    root_logger.addHandler(queue_handler)
+
+    _LOG_LISTENER = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    _LOG_LISTENER.start()
 
     # 定義關鍵 logger 名稱列表
     important_loggers = [
@@ -115,6 +319,8 @@ def configure_logging(level="info"):
 
     root_logger.info(f"日誌系統已配置，級別為 {level}")
     root_logger.info(f"所有日誌將寫入 {log_file}")
+    if removed_logs:
+        root_logger.info(f"已刪除 {len(removed_logs)} 個已結束行程的日誌檔")
 
 
 def get_logger(name):
@@ -146,3 +352,21 @@ def get_logger(name):
 logger = get_logger("root")
 
 
+def encode_cursor(payload: Dict[str, Any]) -> str:
+    """分頁 cursor：對客戶端不透明的 base64url 字串"""
+    raw = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict[str, Any]]:
+    """解析 encode_cursor 產生的 cursor，格式不正確時返回 None"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
@@ -0,0 +1,201 @@
+"""KOL 篩選 / Markdown 輸出 benchmark
+
+以 fakeredis 與合成資料執行 /api/redis/kol-data-count 與 /api/redis/kol-data，
+記錄每個情境的延遲百分位數、峰值記憶體與呼叫後殘留的記憶體，結果寫成 JSON
+方便不同版本比較。
+
+使用方式:
+    poetry run python -m benchmarks.bench_filters --sizes 10000 100000 1000000
+    poetry run python -m benchmarks.bench_filters --sizes 10000 --repeats 20 --output /tmp/bench.json
+"""
+import os
+import sys
+import json
+import time
+import gc
+import asyncio
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from typing import Any, Dict, List
+
+# benchmark 不需要逐筆的 info 日誌
+os.environ.setdefault("ST_LLM_LOG_LEVEL", "warning")
+
+import httpx  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from app import redis as app_redis  # noqa: E402
+from app.app import app  # noqa: E402
+from app.kol_index import get_kol_index, time_window  # noqa: E402
+from app.shared_cache import shared_cache  # noqa: E402
+from benchmarks.stats import summarize  # noqa: E402
+from benchmarks.synthetic import TAGS, generate_dataset  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results", "bench_filters.json")
+
+# (名稱, endpoint, request body)
+SCENARIOS = [
+    ("count_all_last7", "/api/redis/kol-data-count", {"tags": ["All"], "time": 2, "n": 7}),
+    ("count_tag_yesterday", "/api/redis/kol-data-count", {"tags": [TAGS[0]], "time": 0}),
+    ("count_tags_last30", "/api/redis/kol-data-count", {"tags": TAGS[:3], "time": 2, "n": 30}),
+    # 列出所有 tag：有兩個 tag 的 KOL 兩個都會選到 (貼文只能計一次)
+    ("count_every_tag", "/api/redis/kol-data-count", {"tags": TAGS, "time": 3}),
+    ("data_tag_today", "/api/redis/kol-data", {"tags": [TAGS[0]], "time": 1}),
+    ("data_tag_last7", "/api/redis/kol-data", {"tags": [TAGS[1]], "time": 2, "n": 7}),
+    ("data_all_last7", "/api/redis/kol-data", {"tags": ["All"], "time": 2, "n": 7}),
+]
+
+
+def seed_redis(n_posts: int, seed: int) -> None:
+    """以新的 fakeredis 實例載入合成資料"""
+    app_redis.use_fake_redis()
+    kol_info, kol_data = generate_dataset(n_posts, seed=seed)
+    # 與 SheetManager 相同，經由本地快取寫入 (帶版本戳記)
+    shared_cache.invalidate()
+    shared_cache.set("sheet:kol_info", kol_info)
+    shared_cache.set("sheet:kol_data", kol_data)
+    shared_cache.set("sheet:saved_searches", [{
+        "id": 1,
+        "title": "benchmark",
+        "account": "系統",
+        "order": 1,
+        "query": {"title": "benchmark", "time": 2, "source": 0, "tags": ["All"], "query": "", "n": 7, "range": None},
+        "created_at": "",
+    }])
+
+
+def expected_count(body: Dict[str, Any]) -> int:
+    """以索引逐篇篩選算出的貼文數，用來核對 kol-data-count (每日彙總表) 的結果
+
+    tag 換算成不重複的 kol_id，同一個 KOL 有多個 tag 時貼文只計一次。
+    """
+    kol_info = shared_cache.get("sheet:kol_info", default=[])
+    tags = body.get("tags")
+    kol_ids = None
+    if tags and tags != ["All"]:
+        kol_ids = list({info["kol_id"] for info in kol_info if info.get("tag") in tags})
+    window = time_window(body.get("time"), int(body.get("n", 1) or 1))
+    return len(get_kol_index().select(time_range=window[:2] if window else None, kol_ids=kol_ids))
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    session_id: str,
+    endpoint: str,
+    body: Dict[str, Any],
+    repeats: int
+) -> Dict[str, Any]:
+    params = {"session_id": session_id, "search_id": 1} if endpoint.endswith("/kol-data") else None
+
+    async def call():
+        response = await client.post(endpoint, params=params, json=body)
+        response.raise_for_status()
+        return response.json()
+
+    # 暖身一次 (不計時)
+    payload = await call()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await call()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # 記憶體量測另跑一次，避免 tracemalloc 影響計時
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    await call()
+    _, peak = tracemalloc.get_traced_memory()
+    # 先回收循環參照的垃圾，只留下呼叫後仍存活的物件 (快取等)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # 呼叫前後仍存活的區塊數與 bytes 的淨變化，並非呼叫期間的總配置次數
+    diff = after.compare_to(before, "filename")
+    retained_blocks = sum(stat.count_diff for stat in diff)
+    retained_bytes = sum(stat.size_diff for stat in diff)
+
+    if "count" in payload:
+        rows = payload["count"]
+    else:
+        rows = max(payload.get("markdown", "").count("\n") - 3, 0)
+
+    return {
+        "repeats": repeats,
+        "rows": rows,
+        **summarize(latencies),
+        "peak_bytes": peak,
+        "retained_blocks": retained_blocks,
+        "retained_bytes": retained_bytes,
+    }
+
+
+async def run(sizes: List[int], repeats: int, seed: int, scenarios: List[str]) -> List[Dict[str, Any]]:
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for size in sizes:
+            start = time.perf_counter()
+            seed_redis(size, seed)
+            print(f"[{size:>9,} posts] 資料準備 {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            session_id = (await client.get("/api/session")).json()["session_id"]
+            # 大資料量時減少重複次數
+            size_repeats = repeats if size < 1_000_000 else max(3, repeats // 4)
+            for name, endpoint, body in SCENARIOS:
+                if scenarios and name not in scenarios:
+                    continue
+                result = await run_scenario(client, session_id, endpoint, body, size_repeats)
+                result.update({"size": size, "scenario": name, "endpoint": endpoint})
+                if endpoint.endswith("/kol-data-count"):
+                    expected = expected_count(body)
+                    if result["rows"] != expected:
+                        raise RuntimeError(f"{name}: kol-data-count 返回 {result['rows']}，逐篇篩選為 {expected}")
+                results.append(result)
+                print(
+                    f"[{size:>9,} posts] {name:<22} rows={result['rows']:<8} "
+                    f"p50={result['p50_ms']:>9.1f}ms p95={result['p95_ms']:>9.1f}ms "
+                    f"p99={result['p99_ms']:>9.1f}ms peak={result['peak_bytes'] / 1e6:>8.1f}MB",
+                    file=sys.stderr
+                )
+    return results
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="KOL 篩選 endpoint benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="貼文數 (可多個)")
+    parser.add_argument("--repeats", type=int, default=10, help="每個情境的計時次數")
+    parser.add_argument("--seed", type=int, default=0, help="合成資料的 seed")
+    parser.add_argument("--scenario", action="append", default=[], help="只執行指定情境 (可重複)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="結果 JSON 檔路徑")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.sizes, args.repeats, args.seed, args.scenario))
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""整個 API 的行程內壓測
+
+每個 worker 是獨立的行程，行程內啟動 FastAPI app，搭配本地 Google Sheet 替身
+(LocalSheetConnector) 與 stub LLM，同時執行多個使用者旅程：
+
+    建立 session → 列出 saved searches → kol-data-count → kol-data
+    → 詢問 LLM 數次 (kol-data-llm) → 追問一次 (message/llm) → 刪除 session
+
+所有 worker 連到同一個 Redis，與部署時相同地共用 sheet 資料、LLM 快取、session 鎖
+與 pub/sub 失效通知：指定 --redis 時使用既有的 Redis，否則每一輪啟動一個新的
+redis-server (PATH 中有時)，沒有時改在主行程啟動 fakeredis 的 TCP server。
+
+輸出每種 worker 數下的吞吐量、各路由的 p50 / p95 / p99 與錯誤率，以及
+event loop 延遲 (同步阻塞的程式碼會讓它上升)，結果寫成 JSON。
+
+注意：負載產生器與 app 在同一行程內共用 CPU，fakeredis TCP server 也比真正的 Redis 慢，
+數字適合用來比較版本與估算 worker 數的擴展性，而非代表真實部署的絕對值。
+
+使用方式:
+    poetry run python -m benchmarks.load_test --workers 1 2 4 --users 20 --journeys 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import platform
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from benchmarks.stats import summarize
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), "results", "load_test.json")
+
+QUESTIONS = [
+    "這段期間討論度最高的主題是什麼？",
+    "幫我整理互動數最高的五篇貼文",
+    "有哪些 KOL 在談論美食？",
+    "整體情緒偏正面還是負面？",
+    "分享數最多的貼文在說什麼？",
+    "請用三點摘要這些貼文",
+]
+
+# event loop 延遲取樣間隔 (秒)
+_LAG_INTERVAL = 0.01
+
+
+def _is_error(response) -> bool:
+    """API 的錯誤可能是 HTTP 狀態碼，也可能是 200 + error 欄位"""
+    if response.status_code >= 400:
+        return True
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return isinstance(body, dict) and ("error" in body or body.get("status") == "error")
+
+
+class _Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def call(self, client, route: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except Exception:
+            self.latencies[route].append((time.perf_counter() - start) * 1000)
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append((time.perf_counter() - start) * 1000)
+        if _is_error(response):
+            self.errors[route] += 1
+            return None
+        return response.json()
+
+
+async def _journey(client, recorder: _Recorder, rng: random.Random, questions: int) -> bool:
+    body = await recorder.call(client, "GET /api/session", "GET", "/api/session")
+    if not body or not body.get("session_id"):
+        return False
+    session_id = body["session_id"]
+
+    try:
+        searches = await recorder.call(
+            client, "GET /api/saved_search", "GET", "/api/saved_search", params={"session_id": session_id}
+        )
+        if not searches:
+            return False
+        search = rng.choice(searches)
+        query = search.get("query", {})
+        filters = {"tags": query.get("tags", ["All"]), "time": query.get("time", 2), "n": query.get("n") or 7}
+
+        await recorder.call(client, "POST /api/redis/kol-data-count", "POST", "/api/redis/kol-data-count", json=filters)
+        params = {"session_id": session_id, "search_id": search["id"]}
+        data = await recorder.call(
+            client, "POST /api/redis/kol-data", "POST", "/api/redis/kol-data", params=params, json=filters
+        )
+        if data is None:
+            return False
+
+        for _ in range(questions):
+            await recorder.call(
+                client, "POST /api/message/kol-data-llm", "POST", "/api/message/kol-data-llm",
+                params=params, json={"query": rng.choice(QUESTIONS)}
+            )
+
+        # 以對話記錄追問一次
+        await recorder.call(
+            client, "POST /api/message/llm", "POST", "/api/message/llm",
+            params=params, json={"query": rng.choice(QUESTIONS)}
+        )
+        return True
+    finally:
+        await recorder.call(client, "DELETE /api/session", "DELETE", "/api/session", params={"session_id": session_id})
+
+
+async def _monitor_loop_lag(samples: List[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(_LAG_INTERVAL)
+        samples.append(max(0.0, (time.perf_counter() - start - _LAG_INTERVAL) * 1000))
+
+
+async def _run_worker(worker_id: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    import httpx
+    from app.app import app
+    from app.llm import StubProvider, set_llm_provider
+    from app.sheet import LocalSheetConnector, sheet_manager
+    from benchmarks.synthetic import generate_dataset, generate_saved_search_rows
+
+    kol_info, kol_data = generate_dataset(options["posts"], seed=options["seed"])
+    sheet_latency = options["sheet_latency_ms"] / 1000
+    sheet_manager.use_connectors(
+        kol_info=LocalSheetConnector(kol_info, "kol_info", sheet_latency),
+        saved_searches=LocalSheetConnector(generate_saved_search_rows(seed=options["seed"]), "saved_search", sheet_latency),
+        kol_data=LocalSheetConnector(kol_data, "kol_data", sheet_latency),
+    )
+    set_llm_provider(StubProvider(
+        latency_ms=options["llm_latency_ms"],
+        tokens_per_second=options["llm_tokens_per_second"],
+        failure_rate=options["llm_failure_rate"],
+        seed=options["seed"] + worker_id,
+    ))
+    # httpx 的 ASGITransport 不會觸發 startup 事件，手動執行預熱
+    await app.router.startup()
+
+    recorder = _Recorder()
+    lag_samples: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_monitor_loop_lag(lag_samples, stop))
+    completed = 0
+
+    async def user(user_id: int):
+        nonlocal completed
+        rng = random.Random(options["seed"] * 100003 + worker_id * 1009 + user_id)
+        for _ in range(options["journeys"]):
+            if await _journey(client, recorder, rng, options["questions"]):
+                completed += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(options["users"])))
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    return {
+        "worker_id": worker_id,
+        "elapsed": elapsed,
+        "journeys": completed,
+        "latencies": dict(recorder.latencies),
+        "errors": dict(recorder.errors),
+        "loop_lag_ms": lag_samples,
+    }
+
+
+def _worker_main(worker_id: int, options: Dict[str, Any], redis_address: Tuple[str, int]) -> Dict[str, Any]:
+    os.environ.setdefault("ST_LLM_LOG_LEVEL", "warning")
+    # app.settings 在 import app 時讀取，必須在 _run_worker 之前設定
+    os.environ["ST_LLM_REDIS_HOST"], port = redis_address
+    os.environ["ST_LLM_REDIS_PORT"] = str(port)
+    return asyncio.run(_run_worker(worker_id, options))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_redis(host: str, port: int, timeout: float = 10) -> None:
+    import redis
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            redis.Redis(host=host, port=port, socket_timeout=1).ping()
+            return
+        except redis.ConnectionError:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"無法連線到 Redis {host}:{port}")
+            time.sleep(0.05)
+
+
+def _start_shared_redis(address: Optional[str]) -> Tuple[Tuple[str, int], Callable[[], None], str]:
+    """啟動 (或連到) 所有 worker 共用的 Redis
+
+    Returns:
+        ((host, port), 停止函數, 種類)
+    """
+    if address:
+        host, _, port = address.rpartition(":")
+        host, port = host or "127.0.0.1", int(port)
+        _wait_for_redis(host, port)
+        return (host, port), lambda: None, "external"
+
+    host, port = "127.0.0.1", _free_port()
+    if shutil.which("redis-server"):
+        process = subprocess.Popen(
+            ["redis-server", "--bind", host, "--port", str(port), "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        def stop():
+            process.terminate()
+            process.wait()
+
+        _wait_for_redis(host, port)
+        return (host, port), stop, "redis-server"
+
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer((host, port))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    _wait_for_redis(host, port)
+    return (host, port), stop, "fakeredis-tcp"
+
+
+def run(workers: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    """以指定的 worker 數執行一輪壓測並彙總結果"""
+    redis_address, stop_redis, redis_kind = _start_shared_redis(options["redis"])
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            outputs = list(pool.map(
+                _worker_main, range(workers), [options] * workers, [redis_address] * workers
+            ))
+    finally:
+        stop_redis()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lag: List[float] = []
+    for output in outputs:
+        for route, values in output["latencies"].items():
+            latencies[route].extend(values)
+        for route, count in output["errors"].items():
+            errors[route] += count
+        lag.extend(output["loop_lag_ms"])
+
+    elapsed = max(output["elapsed"] for output in outputs)
+    total_requests = sum(len(values) for values in latencies.values())
+    total_errors = sum(errors.values())
+    routes = {}
+    for route, values in latencies.items():
+        routes[route] = {
+            "requests": len(values),
+            "errors": errors.get(route, 0),
+            "error_rate": round(errors.get(route, 0) / len(values), 4),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            **summarize(values),
+        }
+
+    return {
+        "workers": workers,
+        "users_per_worker": options["users"],
+        "redis": redis_kind,
+        "elapsed_s": round(elapsed, 3),
+        "journeys": sum(output["journeys"] for output in outputs),
+        "journeys_per_s": round(sum(output["journeys"] for output in outputs) / elapsed, 2),
+        "requests": total_requests,
+        "throughput_rps": round(total_requests / elapsed, 2),
+        "errors": total_errors,
+        "error_rate": round(total_errors / total_requests, 4) if total_requests else 0.0,
+        "loop_lag": summarize(lag),
+        "routes": routes,
+    }
+
+
+def _print_summary(result: Dict[str, Any]) -> None:
+    print(
+        f"\nworkers={result['workers']} users/worker={result['users_per_worker']} redis={result['redis']} "
+        f"elapsed={result['elapsed_s']:.1f}s journeys/s={result['journeys_per_s']:.2f} "
+        f"req/s={result['throughput_rps']:.1f} errors={result['error_rate']:.2%} "
+        f"loop_lag_p99={result['loop_lag']['p99_ms']:.1f}ms max={result['loop_lag']['max_ms']:.1f}ms",
+        file=sys.stderr
+    )
+    for route, stats in sorted(result["routes"].items()):
+        print(
+            f"  {route:<34} n={stats['requests']:<6} p50={stats['p50_ms']:>8.1f}ms "
+            f"p95={stats['p95_ms']:>8.1f}ms p99={stats['p99_ms']:>8.1f}ms err={stats['error_rate']:.2%}",
+            file=sys.stderr
+        )
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="整個 API 的行程內壓測")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker 行程數 (可多個)")
+    parser.add_argument("--users", type=int, default=20, help="每個 worker 的同時使用者數")
+    parser.add_argument("--journeys", type=int, default=5, help="每個使用者執行的旅程數")
+    parser.add_argument("--questions", type=int, default=2, help="每個旅程詢問 LLM 的次數")
+    parser.add_argument("--posts", type=int, default=20000, help="每個 worker 的合成貼文數")
+    parser.add_argument("--sheet-latency-ms", type=float, default=0, help="模擬 Google Sheet API 延遲")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="stub LLM 首個 token 延遲中位數")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=100, help="stub LLM 輸出速度")
+    parser.add_argument("--llm-failure-rate", type=float, default=0, help="stub LLM 模擬失敗機率")
+    parser.add_argument("--seed", type=int, default=0, help="隨機數 seed")
+    parser.add_argument(
+        "--redis", default=None,
+        help="所有 worker 共用的既有 Redis (host:port，會寫入資料，請使用獨立的實例)；"
+             "未指定時每一輪啟動新的 redis-server 或 fakeredis TCP server"
+    )
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="結果 JSON 檔路徑")
+    args = parser.parse_args(argv)
+
+    options = {
+        "users": args.users,
+        "journeys": args.journeys,
+        "questions": args.questions,
+        "posts": args.posts,
+        "sheet_latency_ms": args.sheet_latency_ms,
+        "llm_latency_ms": args.llm_latency_ms,
+        "llm_tokens_per_second": args.llm_tokens_per_second,
+        "llm_failure_rate": args.llm_failure_rate,
+        "seed": args.seed,
+        "redis": args.redis,
+    }
+    results = []
+    for workers in args.workers:
+        result = run(workers, options)
+        _print_summary(result)
+        results.append(result)
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "options": options,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已寫入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""benchmark 共用的統計函數"""
+import math
+from typing import Dict, List
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """nearest-rank 百分位數：排序後第 ceil(pct / 100 * n) 個值"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[k]
+
+
+def summarize(latencies_ms: List[float]) -> Dict[str, float]:
+    """延遲 (毫秒) 的平均值與 p50 / p95 / p99"""
+    if not latencies_ms:
+        return {"mean_ms": 0.0, "min_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 3),
+        "min_ms": round(min(latencies_ms), 3),
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+        "max_ms": round(max(latencies_ms), 3),
+    }
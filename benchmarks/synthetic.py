@@ -0,0 +1,148 @@
+"""合成 KOL 資料產生器
+
+產生與 Google Sheet 格式一致的 kol_info / kol_data：
+- KOL 發文量呈 Zipf 分布 (少數 KOL 貢獻大部分貼文)
+- 貼文內容為繁體中文為主，夾雜英文、數字、hashtag、emoji 與換行
+- 每篇貼文帶多個 tag (tag_names)，來源混合 Facebook 與 Threads
+- 約一成的 KOL 在 kol_info 中有第二個 tag (同一個 KOL 兩列)
+- saved_search 工作表的系統搜索 (原始欄位格式)
+- 相同 seed 永遠產生相同資料
+"""
+import json
+import time
+import random
+from typing import Any, Dict, List, Tuple
+
+TAGS = ["美食", "旅遊", "政治", "財經", "科技", "娛樂", "運動", "親子", "健康", "時尚"]
+
+_PHRASES = [
+    "今天去了一家新開的餐廳", "台北的天氣越來越熱", "大家覺得這次的政策如何", "股市今天又創新高",
+    "週末帶小孩去公園走走", "新手機開箱心得分享", "這部電影真的太好看了", "早上跑步五公里",
+    "推薦一間很棒的咖啡廳", "立法院今天通過了新法案", "颱風即將來襲請注意安全", "夜市小吃排行榜",
+    "出國旅遊必備清單", "健身房的新課程", "央行宣布升息半碼", "演唱會門票秒殺",
+    "壽司吃到飽", "拉麵名店排隊兩小時", "AI 工具改變工作方式", "電動車補助延長",
+    "選舉倒數三十天", "花蓮太魯閣一日遊", "高雄港邊散步", "台中歌劇院展覽",
+]
+_EXTRAS = ["😂", "👍", "🔥", "❤️", "!!", "？", "...", "#台灣", "#週末", "#推薦", "hello", "2024", "NT$500"]
+
+
+def _content(rng: random.Random) -> str:
+    # 長度接近對數常態：多數短文，少數長文
+    n = max(1, min(int(rng.lognormvariate(1.2, 0.8)), 40))
+    parts = []
+    for _ in range(n):
+        parts.append(rng.choice(_PHRASES))
+        if rng.random() < 0.3:
+            parts.append(rng.choice(_EXTRAS))
+        if rng.random() < 0.1:
+            parts.append("\n")
+    return "，".join(parts)
+
+
+def generate_kol_info(n_kols: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """產生 sheet:kol_info 格式的 KOL 列表 (每 10 個 KOL 有一個多一列，tag 為 TAGS 中的下一個)"""
+    rng = random.Random(seed)
+    kol_info = [
+        {
+            "kol_id": f"kol_{i:05d}",
+            "kol_name": f"KOL{i:05d}",
+            "KOL": f"KOL{i:05d}",
+            "url": f"https://www.facebook.com/kol{i}",
+            "tag": rng.choice(TAGS),
+        }
+        for i in range(n_kols)
+    ]
+    for info in kol_info[::10]:
+        kol_info.append(dict(info, tag=TAGS[(TAGS.index(info["tag"]) + 1) % len(TAGS)]))
+    return kol_info
+
+
+def generate_kol_data(
+    n_posts: int,
+    kol_info: List[Dict[str, Any]],
+    days: int = 90,
+    seed: int = 0,
+    now: int = None
+) -> List[Dict[str, Any]]:
+    """產生 sheet:kol_data 格式的貼文列表
+
+    Args:
+        n_posts: 貼文數
+        kol_info: generate_kol_info 的結果
+        days: 貼文時間分布在最近幾天內 (越近期越多)
+        seed: 隨機數 seed
+        now: 基準時間 (預設為目前時間)
+    """
+    rng = random.Random(seed)
+    now = int(now if now is not None else time.time())
+    # 同一個 KOL 可能有多列，以第一列為主要 tag
+    primary = {}
+    for k in kol_info:
+        primary.setdefault(k["kol_id"], k)
+    kols = list(primary)
+    kol_names = {kol_id: k["kol_name"] for kol_id, k in primary.items()}
+    primary_tags = {kol_id: k["tag"] for kol_id, k in primary.items()}
+    # Zipf 權重：排名第 r 的 KOL 權重為 1 / r^1.1
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(kols))]
+    chosen = rng.choices(kols, weights=weights, k=n_posts)
+
+    data = []
+    span = days * 86400
+    for i, kol_id in enumerate(chosen):
+        # 貼文時間偏向近期
+        age = int(span * rng.random() ** 1.5)
+        tags = {primary_tags[kol_id]}
+        while rng.random() < 0.4:
+            tags.add(rng.choice(TAGS))
+        reactions = int(rng.paretovariate(1.2) * 10)
+        if rng.random() < 0.5:
+            post_url = f"https://www.facebook.com/{kol_id}/posts/{i}"
+        else:
+            post_url = f"https://www.threads.net/@{kol_id}/post/{i}"
+        data.append({
+            "doc_id": f"doc_{i:08d}",
+            "tag_names": ",".join(sorted(tags)),
+            "kol_id": kol_id,
+            "kol_name": kol_names[kol_id],
+            "timestamp": now - age,
+            "post_url": post_url,
+            "content": _content(rng),
+            "reaction_count": reactions,
+            "share_count": int(reactions * rng.random() * 0.2),
+        })
+    return data
+
+
+def generate_dataset(n_posts: int, n_kols: int = None, days: int = 90, seed: int = 0) -> Tuple[list, list]:
+    """產生 (kol_info, kol_data)，KOL 數預設隨貼文數成長"""
+    if n_kols is None:
+        n_kols = max(50, min(n_posts // 200, 5000))
+    kol_info = generate_kol_info(n_kols, seed=seed)
+    return kol_info, generate_kol_data(n_posts, kol_info, days=days, seed=seed)
+
+
+def generate_saved_search_rows(n_searches: int = 5, seed: int = 0) -> List[Dict[str, Any]]:
+    """產生 saved_search 工作表的原始資料列 (欄位名稱與 Google Sheet 相同)"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(1, n_searches + 1):
+        time_type = rng.choice([0, 1, 2])
+        tags = ["All"] if i == 1 else rng.sample(TAGS, rng.randint(1, 3))
+        title = "全部 KOL" if i == 1 else "、".join(tags)
+        rows.append({
+            "id": i,
+            "標題": title,
+            "帳號": "系統",
+            "順序": i,
+            "查詢值": json.dumps({
+                "title": title,
+                "time": time_type,
+                "source": 0,
+                "tags": tags,
+                "query": "",
+                "n": rng.choice([3, 7, 14]) if time_type == 2 else "",
+                "range": None,
+            }, ensure_ascii=False),
+            "新增時間": "2024-01-01 00:00:00",
+        })
+    return rows